@@ -0,0 +1,456 @@
+import os
+import sys
+import time
+import json
+import shlex
+import shutil
+import argparse
+import platform
+import resource
+import tempfile
+import subprocess
+import numpy as np
+import torch
+import nibabel as nib
+
+import mri_easyreg_new as easyreg
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Micro-benchmarks for EasyReg", epilog='\n')
+    subparsers = parser.add_subparsers(dest='command')
+
+    parser_sym = subparsers.add_parser('symmetric', help="Symmetric registration model: two directional passes vs one batch-2 pass")
+    parser_sym.add_argument("--model", help="(optional) Registration model weights. Default is $FREESURFER_HOME/models/easyreg_v10_230103.h5")
+    parser_sym.add_argument("--batch", type=int, default=1, help="(optional) Number of pairs per call. Default is 1")
+    parser_sym.add_argument("--repeats", type=int, default=3, help="(optional) Number of timed calls. Default is 3")
+    parser_sym.add_argument("--threads", type=int, default=1, help="(optional) Number of cores to be used. Default is 1. You can use -1 to use all available cores")
+
+    parser_startup = subparsers.add_parser('startup', help="Startup time and memory of mri_easyreg_new.py (--help, --affine_only path, networks path), each in a fresh process")
+    parser_startup.add_argument("--repeats", type=int, default=3, help="(optional) Number of timed runs of each case. Default is 3")
+
+    parser_kernels = subparsers.add_parser('kernels', help="Numeric kernels (interpolation, resampling, postprocessing, centroids, reorientation) on synthetic volumes; needs no models")
+    parser_kernels.add_argument("--resolutions", type=float, nargs='+', default=[1.0, 0.7, 0.5], help="(optional) Voxel sizes (in mm) of the synthetic volumes. Default is 1 0.7 0.5")
+    parser_kernels.add_argument("--fov", type=float, default=256, help="(optional) Field of view (in mm) of the synthetic volumes, which are cubes. Default is 256")
+    parser_kernels.add_argument("--threads", type=int, nargs='+', default=[1], help="(optional) Numbers of threads to run each kernel with. Default is 1")
+    parser_kernels.add_argument("--kernels", nargs='+', help="(optional) Kernels to run. Default is all of them: %s" % ' '.join(KERNELS))
+    parser_kernels.add_argument("--repeats", type=int, default=3, help="(optional) Number of timed calls. Default is 3")
+    parser_kernels.add_argument("--output", help="(optional) JSON file with the results")
+    parser_kernels.add_argument("--baseline", help="(optional) JSON file with the results of an earlier run (e.g., another commit) to compare with")
+
+    parser_pipe = subparsers.add_parser('pipeline', help="End-to-end batch registration of synthetic phantom pairs with randomly initialized models; needs no FreeSurfer")
+    parser_pipe.add_argument("--pairs", type=int, default=4, help="(optional) Number of pairs. Default is 4")
+    parser_pipe.add_argument("--fov", type=float, default=192, help="(optional) Field of view (in mm) of the phantoms, which are cubes. Default is 192")
+    parser_pipe.add_argument("--resolution", type=float, default=1.0, help="(optional) Voxel size (in mm) of the phantoms. Default is 1")
+    parser_pipe.add_argument("--synthseg", action="store_true", help="(optional) Segment the phantoms with (random) SynthSeg instead of providing their segmentations. The random segmentations have no usable labels, so the pairs then fail in the affine stage: use it to time reading and segmentation")
+    parser_pipe.add_argument("--threads", type=int, default=1, help="(optional) Number of cores to be used. Default is 1")
+    parser_pipe.add_argument("--easyreg_args", default='', help="(optional) Further arguments of mri_easyreg_new.py, e.g., \"--pipeline --reg_batch 2\"")
+    parser_pipe.add_argument("--dir", help="(optional) Working directory; models and phantoms already there are reused. Default is a temporary directory, deleted at the end")
+    parser_pipe.add_argument("--output", help="(optional) JSON file with the results")
+
+    args = parser.parse_args()
+    if args.command is None:
+        parser.print_help()
+        sys.exit(1)
+
+    if args.command == 'startup':
+        benchmark_startup(args)
+        return
+    if args.command == 'kernels':
+        benchmark_kernels(args)
+        return
+    if args.command == 'pipeline':
+        benchmark_pipeline(args)
+        return
+
+    if args.threads < 0:
+        args.threads = os.cpu_count()
+    easyreg.set_num_threads(args.threads)
+
+    if args.command == 'symmetric':
+        benchmark_symmetric(args)
+
+
+def build_two_pass_reg_model(model_file, atlas_volsize):
+    # symmetric model as it was before the two directions were batched: one U-Net pass per direction
+
+    easyreg.load_frameworks()
+    tf, KL, vxm = easyreg.tf, easyreg.KL, easyreg.vxm
+    source = tf.keras.Input(shape=(*atlas_volsize, 1))
+    target = tf.keras.Input(shape=(*atlas_volsize, 1))
+
+    config = {'name': 'vxm_dense', 'fill_value': None, 'input_model': None, 'unet_half_res': True, 'trg_feats': 1,
+     'src_feats': 1, 'use_probs': False, 'bidir': False, 'int_downsize': 2, 'int_steps': 10,
+     'nb_unet_conv_per_level': 1, 'unet_feat_mult': 1, 'nb_unet_levels': None,
+     'nb_unet_features': [[256, 256, 256, 256], [256, 256, 256, 256, 256, 256]], 'inshape': atlas_volsize}
+    cnn = vxm.networks.VxmDense(**config)
+    cnn.load_weights(model_file, by_name=True)
+    svf1 = cnn([source, target])[1]
+    svf2 = cnn([target, source])[1]
+    pos_svf = KL.Lambda(lambda x: 0.5 * x[0] - 0.5 * x[1])([svf1, svf2])
+    neg_svf = KL.Lambda(lambda x: -x)(pos_svf)
+    pos_def = vxm.layers.RescaleTransform(2)(vxm.layers.VecInt(method='ss', int_steps=10)(pos_svf))
+    neg_def = vxm.layers.RescaleTransform(2)(vxm.layers.VecInt(method='ss', int_steps=10)(neg_svf))
+    model = tf.keras.Model(inputs=[source, target], outputs=[pos_def, neg_def])
+    model.load_weights(model_file)
+
+    return model
+
+
+def time_calls(fn, repeats, setup=None):
+    # returns the output of the first (warm-up) call and the median wall-clock time of the timed calls; setup, if
+    # given, returns the arguments of each call (e.g., fresh copies of inputs that fn modifies) and is not timed
+    out = fn(*(() if setup is None else setup()))
+    times = []
+    for _ in range(repeats):
+        inputs = () if setup is None else setup()
+        t0 = time.time()
+        fn(*inputs)
+        times.append(time.time() - t0)
+    return out, float(np.median(times))
+
+
+def benchmark_symmetric(args):
+
+    model_file = args.model
+    if model_file is None:
+        if not os.environ.get('FREESURFER_HOME'):
+            easyreg.sf.system.fatal('FREESURFER_HOME must be set (or use --model)')
+        model_file = os.environ.get('FREESURFER_HOME') + '/models/easyreg_v10_230103.h5'
+    atlas_volsize = [160, 160, 192]
+
+    rng = np.random.default_rng(0)
+    source = rng.random((args.batch, *atlas_volsize, 1), dtype=np.float32)
+    target = rng.random((args.batch, *atlas_volsize, 1), dtype=np.float32)
+
+    results = {}
+    for name, build in [('two-pass', build_two_pass_reg_model), ('batch-2', easyreg.build_reg_model)]:
+        model = build(model_file, atlas_volsize)
+        results[name] = time_calls(lambda: model.predict([source, target], batch_size=args.batch, verbose=0), args.repeats)
+        del model
+
+    (ref_pos, ref_neg), t_ref = results['two-pass']
+    (pos, neg), t_new = results['batch-2']
+    print('Symmetric registration model, %d pair(s) per call, %d thread(s)' % (args.batch, args.threads))
+    print('  two-pass: %.2f s' % t_ref)
+    print('  batch-2:  %.2f s (%.2fx)' % (t_new, t_ref / t_new))
+    print('  max abs difference in the fields: %.2e (pos) %.2e (neg)' % (np.abs(pos - ref_pos).max(), np.abs(neg - ref_neg).max()))
+
+
+# code run in a fresh interpreter by benchmark_startup for each case; it prints the peak RSS (in MB) and whether
+# TensorFlow was imported. Wall-clock time is measured from outside, so it includes the interpreter startup
+STARTUP_CASES = {
+    # argument parsing only
+    'help': """
+import runpy
+sys.argv = [SCRIPT, '--help']
+try:
+    runpy.run_path(SCRIPT, run_name='__main__')
+except SystemExit:
+    pass
+""",
+    # what the --affine_only path with existing segmentations loads: the script and the interpolation kernels
+    'affine_only': """
+import torch, mri_easyreg_new as easyreg
+easyreg.set_num_threads(1)
+X = torch.rand(32, 32, 32)
+II, JJ, KK = easyreg.affine_coordinates(np.eye(4), X.shape)
+easyreg.InterpPlan(II, JJ, KK, X.shape).interpolate(X, 'linear')
+""",
+    # what a run that builds a network pays on top of that
+    'networks': """
+import mri_easyreg_new as easyreg
+easyreg.set_num_threads(1)
+easyreg.load_frameworks()
+""",
+}
+
+
+def benchmark_startup(args):
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mri_easyreg_new.py')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(script), os.environ.get('PYTHONPATH', '')]))
+
+    print('Startup of mri_easyreg_new.py, median of %d fresh process(es)' % args.repeats)
+    for name, code in STARTUP_CASES.items():
+        code = 'import sys, json, resource\nimport numpy as np\nSCRIPT = %r\n' % script + code + \
+               '\nprint(json.dumps([resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, "tensorflow" in sys.modules]))\n'
+        times = []
+        for _ in range(args.repeats):
+            t0 = time.time()
+            output = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True)
+            times.append(time.time() - t0)
+            if output.returncode != 0:
+                easyreg.sf.system.fatal('startup case %s failed:\n%s' % (name, output.stderr))
+        rss, tf_loaded = json.loads(output.stdout.strip().splitlines()[-1])
+        print('  %-12s %.2f s  %6.0f MB peak RSS  TensorFlow %s' % (name, float(np.median(times)), rss, 'loaded' if tf_loaded else 'not loaded'))
+
+
+# SynthSeg 2.0 label lists (normally read from $FREESURFER_HOME/models), for the synthetic posteriors
+SYNTHSEG_LABELS = np.array([0, 2, 3, 4, 5, 7, 8, 10, 11, 12, 13, 14, 15, 16, 17, 18, 24, 26, 28,
+                            41, 42, 43, 44, 46, 47, 49, 50, 51, 52, 53, 54, 58, 60])
+PARCELLATION_LABELS = np.array([0] + [l for l in range(1001, 1036) if l != 1004] + [l for l in range(2001, 2036) if l != 2004])
+
+
+def phantom_affine(shape, resolution, rng):
+    # vox2ras matrix of a LIA volume (as from a scanner) centred around the origin, slightly rotated and shifted
+    aff = np.eye(4)
+    aff[:3, :3] = np.array([[-1, 0, 0], [0, 0, 1], [0, -1, 0]]) * resolution
+    angles = rng.normal(0, 0.05, 3)
+    for i, j, angle in [(1, 2, angles[0]), (0, 2, angles[1]), (0, 1, angles[2])]:
+        rotation = np.eye(4)
+        rotation[[i, i, j, j], [i, j, i, j]] = [np.cos(angle), -np.sin(angle), np.sin(angle), np.cos(angle)]
+        aff = rotation @ aff
+    aff[:3, 3] = -aff[:3, :3] @ ((np.array(shape) - 1) / 2) + rng.normal(0, 3, 3)
+    return aff
+
+
+def synthetic_segmentation(shape, aff, rng, radius=4.0):
+    # labelled phantom: a "white matter" ellipsoid (label 2) holding a sphere of radius mm around the atlas centroid of
+    # each of the labels easyreg estimates the affine transform from
+    resolution = np.sqrt(np.sum(aff[:3, :3] ** 2, axis=0))
+    axes = [((np.arange(n, dtype='float32') - (n - 1) / 2) / (0.4 * n)) ** 2 for n in shape]
+    seg = np.zeros(shape, dtype='int32')
+    seg[(axes[0][:, None, None] + axes[1][None, :, None] + axes[2][None, None, :]) < 1] = 2
+
+    centroids = np.linalg.inv(aff) @ np.concatenate([easyreg.ATLAS_COG, np.ones([1, easyreg.ATLAS_COG.shape[1]])])
+    r = np.ceil(radius / resolution).astype(int)
+    for label, c in zip(easyreg.ATLAS_LABELS, centroids[:3].T + rng.normal(0, 1, (centroids.shape[1], 3))):
+        lo = np.maximum(np.round(c).astype(int) - r, 0)
+        hi = np.minimum(np.round(c).astype(int) + r + 1, shape)
+        if np.any(hi <= lo):
+            continue
+        i, j, k = [(np.arange(lo[d], hi[d]) - c[d]) * resolution[d] for d in range(3)]
+        inside = (i[:, None, None] ** 2 + j[None, :, None] ** 2 + k[None, None, :] ** 2) < radius ** 2
+        seg[lo[0]:hi[0], lo[1]:hi[1], lo[2]:hi[2]][inside] = label
+    return seg
+
+
+def synthetic_image(seg, rng):
+    # intensities that differ between labels, plus noise
+    image = (seg > 0) * 50 + (seg % 97) + rng.normal(0, 2, seg.shape).astype('float32')
+    return np.maximum(image, 0).astype('float32')
+
+
+def synthetic_posteriors(seg, rng):
+    # SynthSeg-like posteriors (segmentation and parcellation networks) of a phantom segmentation: the cortical
+    # parcels of the phantom are cortex (3 / 42) for the segmentation, and parcels for the parcellation
+    lut = np.zeros(np.max(seg) + 1, dtype='int32')
+    lut[SYNTHSEG_LABELS] = np.arange(len(SYNTHSEG_LABELS))
+    lut[2] = 1
+    lut[1000:2000] = np.where(SYNTHSEG_LABELS == 3)[0][0]
+    lut[2000:] = np.where(SYNTHSEG_LABELS == 42)[0][0]
+    parc_lut = np.zeros(np.max(seg) + 1, dtype='int32')
+    parc_lut[PARCELLATION_LABELS] = np.arange(len(PARCELLATION_LABELS))
+
+    posteriors = []
+    for classes, n_classes in [(lut[seg], len(SYNTHSEG_LABELS)), (parc_lut[seg], len(PARCELLATION_LABELS))]:
+        post = rng.random((*seg.shape, n_classes), dtype='float32') * 0.05
+        np.put_along_axis(post, classes[..., np.newaxis], 1.0, axis=-1)
+        posteriors.append(post[np.newaxis])
+    return posteriors
+
+
+def centroids_and_affine(seg, aff):
+    # the affine estimation of easyreg's affine stage
+    COG, ok = easyreg.get_label_centroids(seg, easyreg.ATLAS_LABELS)
+    COG = np.matmul(aff, COG)[:-1, :]
+    return easyreg.getM(easyreg.ATLAS_COG[:, ok > 0], COG[:, ok > 0])
+
+
+# kernels of benchmark_kernels: name -> function that builds the inputs of a volume of the given shape and voxel size,
+# and returns (kernel, setup) as taken by time_calls. postprocess (and its lean version, used by registration) always
+# runs on the 1 mm grid of SynthSeg
+KERNELS = ['interp_linear', 'interp_nearest', 'interp_field', 'resample_volume', 'postprocess', 'postprocess_lean',
+           'centroids_getM', 'align_volume_to_ref']
+
+
+def kernel_inputs(name, shape, resolution, rng):
+
+    aff = phantom_affine(shape, resolution, rng)
+    if name in ['interp_linear', 'interp_nearest']:
+        # resampling to a slightly rotated grid of the same size, as in the affine stage
+        volume = synthetic_image(synthetic_segmentation(shape, aff, rng), rng) if name == 'interp_linear' \
+            else synthetic_segmentation(shape, aff, rng)
+        X = easyreg.as_torch(volume)
+        II, JJ, KK = easyreg.affine_coordinates(np.linalg.inv(aff) @ phantom_affine(shape, resolution, rng), shape)
+        mode = name.split('_')[1]
+        return (lambda: easyreg.fast_3D_interp_torch(X, II, JJ, KK, mode)), None
+    if name == 'interp_field':
+        # atlas-space field sampled at every voxel of the image, as in the warp stage
+        field = easyreg.as_torch(rng.normal(0, 2, (*easyreg.ATLAS_VOLSIZE, 3)).astype('float32'))
+        II, JJ, KK = easyreg.affine_coordinates(np.linalg.inv(easyreg.ATLAS_AFF) @ aff, shape)
+        return (lambda: easyreg.fast_3D_interp_field_torch(field, II, JJ, KK)), None
+    if name == 'resample_volume':
+        # to 1 mm, as in preprocess
+        volume = synthetic_image(synthetic_segmentation(shape, aff, rng), rng)
+        return (lambda: easyreg.resample_volume(volume, aff, [1.0, 1.0, 1.0])), None
+    if name in ['postprocess', 'postprocess_lean']:
+        seg = synthetic_segmentation(shape, aff, rng)
+        post_seg, post_parc = synthetic_posteriors(seg, rng)
+        pad_idx = np.array([0, 0, 0, *shape])
+        kernel = lambda post_seg, post_parc: easyreg.postprocess(post_seg, post_parc, shape, pad_idx, None, SYNTHSEG_LABELS,
+                                                                 PARCELLATION_LABELS, aff, np.ones(3), lean=name == 'postprocess_lean')
+        # postprocess works in place on the posteriors
+        return kernel, lambda: (post_seg.copy(), post_parc.copy())
+    if name == 'centroids_getM':
+        seg = synthetic_segmentation(shape, aff, rng)
+        return (lambda: centroids_and_affine(seg, aff)), None
+    if name == 'align_volume_to_ref':
+        volume = synthetic_image(synthetic_segmentation(shape, aff, rng), rng)
+        return (lambda: easyreg.align_volume_to_ref(volume, aff, aff_ref=np.eye(4), n_dims=3)), None
+    easyreg.sf.system.fatal('unknown kernel %s' % name)
+
+
+def benchmark_kernels(args):
+
+    kernels = KERNELS if args.kernels is None else args.kernels
+    for name in kernels:
+        if name not in KERNELS:
+            easyreg.sf.system.fatal('unknown kernel %s; the kernels are: %s' % (name, ' '.join(KERNELS)))
+
+    results = []
+    print('%-22s %6s %17s %8s %10s %14s' % ('kernel', 'res', 'shape', 'threads', 'time (s)', 'peak RSS (MB)'))
+    for name in kernels:
+        for resolution in ([1.0] if name.startswith('postprocess') else args.resolutions):
+            shape = [int(round(args.fov / resolution))] * 3
+            kernel, setup = kernel_inputs(name, shape, resolution, np.random.default_rng(0))
+            for threads in args.threads:
+                easyreg.set_num_threads(threads)
+                with easyreg.timed({}, name) as record:
+                    _, seconds = time_calls(kernel, args.repeats, setup)
+                results.append({'kernel': name, 'resolution': resolution, 'shape': shape, 'threads': threads,
+                                'seconds': seconds, 'peak_rss_mb': record['peak_rss_mb']})
+                print('%-22s %6.2f %17s %8d %10.3f %14.0f' % (name, resolution, 'x'.join(map(str, shape)), threads, seconds, record['peak_rss_mb']))
+            del kernel, setup
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ''
+    report = {'benchmark': 'kernels', 'commit': commit, 'machine': platform.machine(), 'processor': platform.processor(),
+              'cpu_count': os.cpu_count(), 'python': platform.python_version(), 'numpy': np.__version__,
+              'torch': torch.__version__, 'fov': args.fov, 'repeats': args.repeats, 'results': results}
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=1)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        times = {(r['kernel'], r['resolution'], r['threads']): r['seconds'] for r in baseline['results']}
+        print('Speedup with respect to %s (commit %s):' % (args.baseline, baseline.get('commit', '?')))
+        for r in results:
+            key = (r['kernel'], r['resolution'], r['threads'])
+            if key in times:
+                print('  %-22s %6.2f mm %3d threads: %.2fx' % (r['kernel'], r['resolution'], r['threads'], times[key] / r['seconds']))
+
+
+def write_random_models(fs_home):
+    # $FREESURFER_HOME/models as read by easyreg, with the exact networks of build_seg_model and build_reg_model, but
+    # randomly initialized weights
+    models = os.path.join(fs_home, 'models')
+    easyreg.mkdir(models)
+    np.save(os.path.join(models, 'synthseg_segmentation_labels_2.0.npy'), SYNTHSEG_LABELS)
+    np.save(os.path.join(models, 'synthseg_parcellation_labels.npy'), PARCELLATION_LABELS)
+
+    easyreg.load_frameworks()
+    easyreg.tf.keras.utils.set_random_seed(0)
+    # the segmentation and parcellation U-Nets are loaded by layer name, so both can read the weights of the whole net
+    net = easyreg.seg_model_architecture(np.unique(SYNTHSEG_LABELS), np.unique(PARCELLATION_LABELS))[-1]
+    net.save_weights(os.path.join(models, 'synthseg_2.0.h5'))
+    shutil.copyfile(os.path.join(models, 'synthseg_2.0.h5'), os.path.join(models, 'synthseg_parc_2.0.h5'))
+    del net
+    model = easyreg.reg_model_architecture(easyreg.ATLAS_VOLSIZE)[-1]
+    model.save_weights(os.path.join(models, 'easyreg_v10_230103.h5'))
+    del model
+
+
+def benchmark_pipeline(args):
+
+    work_dir = args.dir if args.dir is not None else tempfile.mkdtemp(prefix='easyreg_benchmark_')
+    try:
+        run_pipeline_benchmark(args, work_dir)
+    finally:
+        if args.dir is None:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_pipeline_benchmark(args, work_dir):
+
+    # models
+    fs_home = os.path.join(work_dir, 'freesurfer')
+    if not os.path.isfile(os.path.join(fs_home, 'models', 'easyreg_v10_230103.h5')):
+        print('Writing randomly initialized models to %s' % fs_home)
+        write_random_models(fs_home)
+
+    # phantoms: pair i registers phantom i + 1 to phantom i
+    phantom_dir = os.path.join(work_dir, 'phantoms_%gmm_%gmm' % (args.fov, args.resolution))
+    easyreg.mkdir(phantom_dir)
+    shape = [int(round(args.fov / args.resolution))] * 3
+    for i in range(args.pairs + 1):
+        if not os.path.isfile(os.path.join(phantom_dir, 'seg%d.nii.gz' % i)):
+            rng = np.random.default_rng(i)
+            aff = phantom_affine(shape, args.resolution, rng)
+            seg = synthetic_segmentation(shape, aff, rng)
+            nib.save(nib.Nifti1Image(synthetic_image(seg, rng), aff), os.path.join(phantom_dir, 'im%d.nii.gz' % i))
+            nib.save(nib.Nifti1Image(seg, aff), os.path.join(phantom_dir, 'seg%d.nii.gz' % i))
+
+    # list files of the batch
+    run_dir = tempfile.mkdtemp(prefix='run_', dir=work_dir)
+    lists = {name: [] for name in ['ref', 'flo', 'ref_seg', 'flo_seg', 'ref_reg', 'flo_reg', 'fwd_field', 'bak_field']}
+    for i in range(args.pairs):
+        lists['ref'].append(os.path.join(phantom_dir, 'im%d.nii.gz' % i))
+        lists['flo'].append(os.path.join(phantom_dir, 'im%d.nii.gz' % (i + 1)))
+        for name, j in [('ref_seg', i), ('flo_seg', i + 1)]:
+            lists[name].append(os.path.join(run_dir if args.synthseg else phantom_dir, 'seg%d.nii.gz' % j))
+        for name in ['ref_reg', 'flo_reg', 'fwd_field', 'bak_field']:
+            lists[name].append(os.path.join(run_dir, '%s_%d.nii.gz' % (name, i)))
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mri_easyreg_new.py')]
+    for name, paths in lists.items():
+        with open(os.path.join(run_dir, name + '.txt'), 'w') as f:
+            f.write('\n'.join(paths) + '\n')
+        command += ['--' + name, os.path.join(run_dir, name + '.txt')]
+    timings_path = os.path.join(run_dir, 'timings.jsonl')
+    command += ['--threads', str(args.threads), '--timings', timings_path] + shlex.split(args.easyreg_args)
+
+    # run the batch
+    print('Registering %d pairs of %s phantoms (%g mm), log in %s' % (args.pairs, 'x'.join(map(str, shape)), args.resolution,
+                                                                    os.path.join(run_dir, 'easyreg.log')))
+    t0 = time.time()
+    with open(os.path.join(run_dir, 'easyreg.log'), 'w') as log:
+        returncode = subprocess.run(command, env=dict(os.environ, FREESURFER_HOME=fs_home), stdout=log, stderr=subprocess.STDOUT).returncode
+    seconds = time.time() - t0
+    peak_rss_mb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+    # report
+    results = []
+    if os.path.isfile(timings_path):
+        with open(timings_path) as f:
+            results = [json.loads(line) for line in f]
+    n_ok = sum(r['ok'] for r in results)
+    stages = {}
+    for r in results:
+        for t in r['timings']:
+            stages.setdefault(t['step'], []).append(t)
+    report_stages = {step: {'n': len(records), 'mean_seconds': float(np.mean([t['wall'] for t in records])),
+                            'total_seconds': float(np.sum([t['wall'] for t in records])),
+                            'peak_rss_mb': max(t['peak_rss_mb'] for t in records)} for step, records in stages.items()}
+    peak_rss_mb = max([peak_rss_mb] + [stage['peak_rss_mb'] for stage in report_stages.values()])
+    print('%d of %d pairs registered in %.1f seconds (exit code %d): %.1f pairs/hour, peak RSS %.0f MB' %
+          (n_ok, args.pairs, seconds, returncode, 3600 * n_ok / seconds, peak_rss_mb))
+    easyreg.print_timings_table(results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump({'benchmark': 'pipeline', 'pairs': args.pairs, 'ok': n_ok, 'shape': shape, 'resolution': args.resolution,
+                       'threads': args.threads, 'easyreg_args': args.easyreg_args, 'synthseg': args.synthseg,
+                       'seconds': seconds, 'pairs_per_hour': 3600 * n_ok / seconds, 'peak_rss_mb': peak_rss_mb,
+                       'stages': report_stages}, f, indent=1)
+
+
+# execute script
+if __name__ == '__main__':
+    main()
@@ -1,24 +1,40 @@
 import os
+import sys
+import json
+import time
+import shutil
+import resource
+import contextlib
+import hashlib
+import queue
 import argparse
+import threading
+import multiprocessing
+import concurrent.futures
 import numpy as np
-import voxelmorph as vxm
 import torch
 import surfa as sf
 import nibabel as nib
-from scipy.ndimage import gaussian_filter, binary_dilation, binary_erosion, distance_transform_edt, binary_fill_holes
+from scipy.ndimage import gaussian_filter1d, binary_dilation, binary_erosion, distance_transform_edt, binary_fill_holes
 from scipy.ndimage import label as scipy_label
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
 os.environ['CUDA_VISIBLE_DEVICES'] = '-1'
-import tensorflow as tf
-import keras
-import keras.backend as K
-import keras.layers as KL
 
-
-# set tensorflow logging
-tf.get_logger().setLevel('ERROR')
-K.set_image_data_format('channels_last')
+# TensorFlow, Keras and voxelmorph take seconds (and hundreds of MB) to import, and are only needed by the networks,
+# so they are imported by load_frameworks when the first network is built (see build_seg_model and build_reg_model)
+tf = None
+keras = None
+K = None
+KL = None
+vxm = None
+_frameworks_lock = threading.Lock()
+_num_threads = None
+# the threads that may preprocess images at the same time (e.g., those of the segment stage of run_batch_pipeline)
+# share the _num_threads budget, and one thread pool (see map_slabs)
+_preprocessing_threads = 1
+_preprocessing_pool = None
+_preprocessing_lock = threading.Lock()
 
 
 def main():
@@ -26,7 +42,7 @@ def main():
     parser = argparse.ArgumentParser(description="EasyReg: deep learning registration simple and easy", epilog='\n')
 
     # input/outputs
-    parser.add_argument("--ref", help="Reference image .")
+    parser.add_argument("--ref", help="Reference image . If it lists a single reference (and segmentation) for several floating images, all of them are registered to it, and its segmentation, affine alignment and grid are only computed once")
     parser.add_argument("--ref_seg", help="Reference SynthSeg segmentation (will be created if it does not exist).")
     parser.add_argument("--flo", help="Floating image.")
     parser.add_argument("--flo_seg", help="Floating SynthSeg segmentation (will be created if it does not exist).")
@@ -37,50 +53,45 @@ def main():
     parser.add_argument("--affine_only", action="store_true", help="(optional) Skips nonlinear part")
     parser.add_argument("--autocrop", action="store_true", help="(optional) Ignore background voxels in FOV.")
     parser.add_argument("--threads", type=int, default=1, help="(optional) Number of cores to be used. Default is 1. You can use -1 to use all available cores")
+    parser.add_argument("--workers", type=int, default=1, help="(optional) Number of worker processes the subjects are shared across; the threads are split evenly between them. Default is 1")
+    parser.add_argument("--precision", default='float32', choices=['float32', 'float64'], help="(optional) Precision of the computations and of the output fields. Default is float32")
+    parser.add_argument("--seg_tile", type=int, help="(optional) Run SynthSeg on overlapping tiles of this many voxels per side (a multiple of 32), which bounds its memory use on large inputs. Default is the whole image at once")
+    parser.add_argument("--seg_tile_overlap", type=int, default=32, help="(optional) Overlap in voxels between SynthSeg tiles; each voxel takes the labels of the tile in which it is the most central. Default is 32")
+    parser.add_argument("--reg_batch", type=int, default=1, help="(optional) Number of affinely aligned pairs registered together in one call to the CNN. Default is 1")
+    parser.add_argument("--pipeline", action="store_true", help="(optional) Run the stages (read, segment, affine, cnn, warp, write) as a pipeline, overlapping consecutive subjects.")
+    parser.add_argument("--stage_threads", default='', help="(optional) Threads per pipeline stage, e.g., read=2,write=2. Stages not listed get 1")
+    parser.add_argument("--seg_cache", help="(optional) Directory of a cache of SynthSeg segmentations, shared by all the pairs (and runs) that use the same images")
+    parser.add_argument("--seg_cache_size", type=float, default=20, help="(optional) Maximum size of the segmentation cache in GB; least recently used entries are evicted first. Default is 20")
+    parser.add_argument("--affine_cache", help="(optional) Directory of a cache of the affine alignment of each image to the atlas (transform and atlas-space volume), shared by all the pairs (and runs) that use the same image and segmentation")
+    parser.add_argument("--affine_cache_size", type=float, default=20, help="(optional) Maximum size of the affine alignment cache in GB; least recently used entries are evicted first. Default is 20")
+    parser.add_argument("--timings", help="(optional) JSON Lines file with the wall time, CPU time and peak memory of every stage (and step) of every subject")
+    parser.add_argument("--max_in_flight", type=int, default=3, help="(optional) Maximum number of subjects held in memory by the pipeline. Default is 3")
+    parser.add_argument("--group_images", help="(optional) Images of a group, to be registered once each to a common template (the mean of their affinely aligned images), which is stored in --group_dir")
+    parser.add_argument("--group_segs", help="(optional) SynthSeg segmentations of the images of --group_images (will be created if they do not exist).")
+    parser.add_argument("--group_dir", help="(optional) Directory of the registrations of a group to its template. Pairs of --ref and --flo whose images (and segmentations) are both in the group are registered by composing theirs, without running the CNN")
 
     # parse commandline
     main_args = parser.parse_args()
 
-    with open(main_args.ref, 'r') as file:
-        all_ref_files = []
-        for line in file:
-            all_ref_files.append(line.strip())  # .strip() removes any extra whitespace/newline characters
-
-    with open(main_args.flo, 'r') as file:
-        all_flo_files = []
-        for line in file:
-            all_flo_files.append(line.strip())  # .strip() removes any extra whitespace/newline characters
-
-    with open(main_args.ref_seg, 'r') as file:
-        all_ref_seg_files = []
-        for line in file:
-            all_ref_seg_files.append(line.strip())  # .strip() removes any extra whitespace/newline characters
-
-    with open(main_args.flo_seg, 'r') as file:
-        all_flo_seg_files = []
-        for line in file:
-            all_flo_seg_files.append(line.strip())  # .strip() removes any extra whitespace/newline characters
-
-    with open(main_args.ref_reg, 'r') as file:
-        all_ref_reg_files = []
-        for line in file:
-            all_ref_reg_files.append(line.strip())  # .strip() removes any extra whitespace/newline characters
-
-    with open(main_args.flo_reg, 'r') as file:
-        all_flo_reg_files = []
-        for line in file:
-            all_flo_reg_files.append(line.strip())  # .strip() removes any extra whitespace/newline characters
-
-    with open(main_args.fwd_field, 'r') as file:
-        all_fwd_field_files = []
-        for line in file:
-            all_fwd_field_files.append(line.strip())  # .strip() removes any extra whitespace/newline characters
-
-    with open(main_args.bak_field, 'r') as file:
-        all_bak_field_files = []
-        for line in file:
-            all_bak_field_files.append(line.strip())  # .strip() removes any extra whitespace/newline characters
-            
+    if (main_args.ref is None) and (main_args.group_images is None):
+        sf.system.fatal('Please provide the lists of pairs (--ref, --flo, ...) and/or the images of a group (--group_images)')
+    all_ref_files = read_list(main_args.ref)
+    all_flo_files = read_list(main_args.flo)
+    all_ref_seg_files = read_list(main_args.ref_seg)
+    all_flo_seg_files = read_list(main_args.flo_seg)
+    all_ref_reg_files = read_list(main_args.ref_reg)
+    all_flo_reg_files = read_list(main_args.flo_reg)
+    all_fwd_field_files = read_list(main_args.fwd_field)
+    all_bak_field_files = read_list(main_args.bak_field)
+
+    # one reference for many floating images (fan-out): a single reference (and segmentation) is paired with every
+    # floating image, and the work that only depends on it is done once (see EasyRegContext.shared_reference)
+    if len(all_ref_files) == 1 and len(all_flo_files) > 1:
+        print('Registering %d floating images to reference %s' % (len(all_flo_files), all_ref_files[0]))
+        all_ref_files = all_ref_files * len(all_flo_files)
+        if len(all_ref_seg_files) == 1:
+            all_ref_seg_files = all_ref_seg_files * len(all_flo_files)
+
     assert len(all_ref_files) == len(all_flo_files), "Length mismatch"
     assert len(all_ref_files) == len(all_ref_seg_files), "Length mismatch"
     assert len(all_ref_files) == len(all_flo_seg_files), "Length mismatch"
@@ -89,10 +100,38 @@ def main():
     assert len(all_ref_files) == len(all_fwd_field_files), "Length mismatch"
     assert len(all_ref_files) == len(all_bak_field_files), "Length mismatch"
 
+    all_group_images, all_group_segs = read_group_lists(main_args.group_images, main_args.group_segs)
+    if (main_args.group_images is not None) and (main_args.group_dir is None):
+        sf.system.fatal('--group_images requires --group_dir')
+
+    if main_args.reg_batch < 1:
+        sf.system.fatal('--reg_batch must be at least 1')
+    if main_args.max_in_flight < 1:
+        sf.system.fatal('--max_in_flight must be at least 1')
+
+    if main_args.seg_tile is not None:
+        if main_args.seg_tile <= 0 or main_args.seg_tile % 32 != 0:
+            sf.system.fatal('--seg_tile must be a positive multiple of 32')
+        if not 0 <= main_args.seg_tile_overlap < main_args.seg_tile:
+            sf.system.fatal('--seg_tile_overlap must be at least 0 and smaller than --seg_tile')
+
+    # Very first thing: we require FreeSurfer
+    if not os.environ.get('FREESURFER_HOME'):
+        sf.system.fatal('FREESURFER_HOME is not set. Please source freesurfer.')
+    fs_home = os.environ.get('FREESURFER_HOME')
+
+    # limit the number of threads to be used if running on CPU
+    if main_args.threads == 1:
+        print('using 1 thread')
+    elif main_args.threads<0:
+        main_args.threads = os.cpu_count()
+        print('using all available threads ( %s )' % main_args.threads)
+    else:
+        print('using %s threads' % main_args.threads)
+
+    all_args = []
     for pat_i in range(len(all_ref_files)):
 
-	
-        print("now doing", pat_i, all_ref_files[pat_i])
         parser_i = argparse.ArgumentParser(description="EasyReg: deep learning registration simple and easy", epilog='\n')
 
         # input/outputs
@@ -107,271 +146,472 @@ def main():
         parser_i.add_argument("--affine_only", action="store_true", help="(optional) Skips nonlinear part")
         parser_i.add_argument("--autocrop", action="store_true", help="(optional) Ignore background voxels in FOV.")
         parser_i.add_argument("--threads", type=int, default=1, help="(optional) Number of cores to be used. Default is 1. You can use -1 to use all available cores")
-
-        # Simulate command-line arguments
-        args = parser_i.parse_args(["--ref", all_ref_files[pat_i],
-                                    "--flo", all_flo_files[pat_i],
-                                    "--ref_seg", all_ref_seg_files[pat_i],
-                                    "--flo_seg", all_flo_seg_files[pat_i],
-                                    "--ref_reg", all_ref_reg_files[pat_i],
-                                    "--flo_reg", all_flo_reg_files[pat_i],
-                                    "--fwd_field", all_fwd_field_files[pat_i],
-                                    "--bak_field", all_bak_field_files[pat_i]])
-
-        #############
-
-        # Very first thing: we require FreeSurfer
-        if not os.environ.get('FREESURFER_HOME'):
-            sf.system.fatal('FREESURFER_HOME is not set. Please source freesurfer.')
-        fs_home = os.environ.get('FREESURFER_HOME')
-
-        if args.ref is None:
-            sf.system.fatal('Reference image must be provided')
-        if args.flo is None:
-            sf.system.fatal('Floating image must be provided')
-        if args.ref_seg is None:
-            sf.system.fatal('Reference segmentation must be provided')
-        if args.flo_seg is None:
-            sf.system.fatal('Floating segmentation must be provided')
-        if (args.ref_reg is None) and (args.flo_reg is None) and (args.fwd_field is None) and (args.bak_field is None):
-            sf.system.fatal('Please provide at least one of: registered reference, registered floating, forward field, or backward field')
-
-        # limit the number of threads to be used if running on CPU
-        if args.threads == 1:
-            print('using 1 thread')
-        elif args.threads<0:
-            args.threads = os.cpu_count()
-            print('using all available threads ( %s )' % args.threads)
+        parser_i.add_argument("--precision", default='float32', choices=['float32', 'float64'], help="(optional) Precision of the computations and of the output fields. Default is float32")
+        parser_i.add_argument("--seg_tile", type=int, help="(optional) Run SynthSeg on overlapping tiles of this many voxels per side (a multiple of 32), which bounds its memory use on large inputs. Default is the whole image at once")
+        parser_i.add_argument("--seg_tile_overlap", type=int, default=32, help="(optional) Overlap in voxels between SynthSeg tiles; each voxel takes the labels of the tile in which it is the most central. Default is 32")
+
+        # Simulate command-line arguments (run-wide flags are forwarded to every subject)
+        argv_i = ["--ref", all_ref_files[pat_i],
+                  "--flo", all_flo_files[pat_i],
+                  "--ref_seg", all_ref_seg_files[pat_i],
+                  "--flo_seg", all_flo_seg_files[pat_i],
+                  "--ref_reg", all_ref_reg_files[pat_i],
+                  "--flo_reg", all_flo_reg_files[pat_i],
+                  "--fwd_field", all_fwd_field_files[pat_i],
+                  "--bak_field", all_bak_field_files[pat_i],
+                  "--threads", str(main_args.threads),
+                  "--precision", main_args.precision]
+        if main_args.affine_only:
+            argv_i.append("--affine_only")
+        if main_args.autocrop:
+            argv_i.append("--autocrop")
+        if main_args.seg_tile is not None:
+            argv_i += ["--seg_tile", str(main_args.seg_tile), "--seg_tile_overlap", str(main_args.seg_tile_overlap)]
+        all_args.append(parser_i.parse_args(argv_i))
+
+    # the images of a group go through the same steps as references (see build_group)
+    group_args = [argparse.Namespace(ref=image, ref_seg=seg, flo=None, flo_seg=None, affine_only=False,
+                                     autocrop=main_args.autocrop, threads=main_args.threads,
+                                     precision=main_args.precision, seg_tile=main_args.seg_tile,
+                                     seg_tile_overlap=main_args.seg_tile_overlap)
+                  for image, seg in zip(all_group_images, all_group_segs)]
+
+    cache_options = {'seg_cache_dir': main_args.seg_cache, 'seg_cache_gb': main_args.seg_cache_size,
+                     'affine_cache_dir': main_args.affine_cache, 'affine_cache_gb': main_args.affine_cache_size,
+                     'group_dir': main_args.group_dir}
+    context = None
+    group_results = []
+    if len(group_args) > 0:
+        set_num_threads(main_args.threads)
+        context = EasyRegContext(fs_home, **cache_options)
+        group_results = build_group(group_args, context, main_args.reg_batch)
+        print_batch_summary(group_results)
+
+    if len(all_args) == 0:
+        results = []
+    elif main_args.workers > 1:
+        if main_args.pipeline:
+            sf.system.fatal('--pipeline cannot be combined with --workers')
+        results = run_batch_workers(all_args, fs_home, main_args.workers, main_args.threads, main_args.reg_batch, cache_options)
+    else:
+        if context is None:
+            set_num_threads(main_args.threads)
+            # label lists, atlas constants, networks and caches are shared by all the subjects of the batch
+            context = EasyRegContext(fs_home, **cache_options)
+        context.share_references(all_args)
+        if main_args.pipeline:
+            stage_threads = parse_stage_threads(main_args.stage_threads)
+            results = run_batch_pipeline(all_args, context, stage_threads, main_args.max_in_flight, main_args.reg_batch)
         else:
-            print('using %s threads' % args.threads)
-        tf.config.threading.set_inter_op_parallelism_threads(args.threads)
-        tf.config.threading.set_intra_op_parallelism_threads(args.threads)
-        torch.set_num_threads(args.threads)
+            results = []
+            for i in range(0, len(all_args), main_args.reg_batch):
+                results += run_subjects([(pat_i, all_args[pat_i]) for pat_i in range(i, min(i + main_args.reg_batch, len(all_args)))], context)
+        print('Networks set up in %.1f seconds, shared by the %d subjects of the batch' % (context.setup_seconds, len(all_args)))
+
+    if len(all_args) > 0:
+        print_batch_summary(results)
+    print_timings_table(group_results + results)
+    if main_args.timings is not None:
+        write_timings(group_results + results, main_args.timings)
+    if any(not r['ok'] for r in group_results + results):
+        sys.exit(1)
+
+
+def read_list(path):
+    # paths listed in a text file, one per line (none if the file is not given)
+    all_files = []
+    if path is not None:
+        with open(path, 'r') as file:
+            for line in file:
+                all_files.append(line.strip())  # .strip() removes any extra whitespace/newline characters
+    return all_files
+
+
+def read_group_lists(path_images, path_segs):
+    # images of a group and their segmentations (see build_group), with every pair listed only once
+    if (path_images is not None) and (path_segs is None):
+        sf.system.fatal('--group_images requires --group_segs (where the segmentations that do not exist yet are written)')
+    if (path_segs is not None) and (path_images is None):
+        sf.system.fatal('--group_segs requires --group_images')
+    all_images = read_list(path_images)
+    all_segs = read_list(path_segs)
+    if len(all_images) != len(all_segs):
+        sf.system.fatal('--group_images and --group_segs must list the same number of files')
+
+    images, segs, seen = [], [], set()
+    for image, seg in zip(all_images, all_segs):
+        pair = (os.path.abspath(image), os.path.abspath(seg))
+        if pair in seen:
+            print('%s (with segmentation %s) is listed more than once in the group; using it once' % (image, seg))
+            continue
+        seen.add(pair)
+        images.append(image)
+        segs.append(seg)
+    return images, segs
+
+
+def run_subjects(tasks, context):
+    """Registers a group of subjects of the batch, given as (index, args) pairs. Each subject goes through the stages
+    of PIPELINE_STAGES one after the other, except for the CNN, which runs once for the whole group so that the pairs
+    are stacked along the batch axis. Returns one result (see subject_result) per subject."""
+
+    subjects = [{'index': pat_i, 'args': args, 'error': None} for pat_i, args in tasks]
+    c = [name for name, _ in PIPELINE_STAGES].index('cnn')
+    for subject in subjects:
+        print("now doing", subject['index'], subject['args'].ref)
+        subject['t0'] = time.time()
+        for name, stage in PIPELINE_STAGES[:c]:
+            run_stage(name, stage, [subject], context)
+    run_stage(*PIPELINE_STAGES[c], subjects, context)
+    for subject in subjects:
+        for name, stage in PIPELINE_STAGES[c + 1:]:
+            run_stage(name, stage, [subject], context)
+        context.release_reference(subject)
+
+    return [subject_result(subject) for subject in subjects]
+
+
+def run_stage(name, stage, subjects, context):
+    """Runs one stage on the subjects that have not failed yet (all at once for the cnn stage, which takes a list).
+    Failures, including sf.system.fatal, are recorded in the subjects rather than stopping the whole batch."""
+
+    subjects = [subject for subject in subjects if subject['error'] is None]
+    groups = [subjects] if name == 'cnn' else [[subject] for subject in subjects]
+    for group in groups:
+        if len(group) == 0:
+            continue
+        try:
+            with timed(group, name):
+                stage(group if name == 'cnn' else group[0], context)
+        except (Exception, SystemExit) as e:
+            for subject in group:
+                subject['error'] = '%s: %s' % (type(e).__name__, e)
+                print('Subject %d failed in %s stage (%s)' % (subject['index'], name, subject['error']))
+
+
+def subject_result(subject):
+    args = subject['args']
+    return {'index': subject['index'], 'ref': args.ref, 'flo': args.flo, 'ok': subject['error'] is None,
+            'error': subject['error'], 'seconds': time.time() - subject['t0'], 'cache': subject.get('cache', {}),
+            'timings': subject.get('timings', [])}
+
+
+def read_stage(subject, context):
+
+    args = subject['args']
+    if args.ref is None:
+        sf.system.fatal('Reference image must be provided')
+    if args.flo is None:
+        sf.system.fatal('Floating image must be provided')
+    if args.ref_seg is None:
+        sf.system.fatal('Reference segmentation must be provided')
+    if args.flo_seg is None:
+        sf.system.fatal('Floating segmentation must be provided')
+    if (args.ref_reg is None) and (args.flo_reg is None) and (args.fwd_field is None) and (args.bak_field is None):
+        sf.system.fatal('Please provide at least one of: registered reference, registered floating, forward field, or backward field')
+
+    def read_reference():
+        print('  Reading reference image')
+        with timed(subject, 'read/ref'):
+            R, Raff, Rh = load_volume(args.ref, im_only=False, squeeze=True, dtype=args.precision, aff_ref=None)
+        return as_torch(R), Raff, Rh
 
-        # path models
-        path_model_segmentation = fs_home + '/models/synthseg_2.0.h5'
-        path_model_parcellation = fs_home + '/models/synthseg_parc_2.0.h5'
-        path_model_registration_trained = fs_home + '/models/easyreg_v10_230103.h5'
+    subject['R'], subject['Raff'], subject['Rh'] = context.shared_reference(subject, 'image', read_reference)
 
-        # path labels
-        labels_segmentation = fs_home +  '/models/synthseg_segmentation_labels_2.0.npy'
-        labels_parcellation = fs_home +  '/models/synthseg_parcellation_labels.npy'
-        atlas_volsize = [160, 160, 192]
-        atlas_aff = np.matrix([[-1, 0, 0, 79], [0, 0, 1, -104], [0, -1, 0, 79], [0, 0, 0, 1]])
+    print('  Reading floating image')
+    with timed(subject, 'read/flo'):
+        F, Faff, Fh = load_volume(args.flo, im_only=False, squeeze=True, dtype=args.precision, aff_ref=None)
+    subject['F'] = as_torch(F)
+    subject['Faff'] = Faff
+    subject['Fh'] = Fh
 
-        # get label lists
-        labels_segmentation, _ = get_list_labels(label_list=labels_segmentation)
-        labels_segmentation, unique_idx = np.unique(labels_segmentation, return_index=True)
-        labels_parcellation, _ = np.unique(get_list_labels(labels_parcellation)[0], return_index=True)
-
-        # Segment if needed
-        if (args.ref_seg is not None) and os.path.exists(args.ref_seg):
-            print('Segmentation of reference image already exists; reading from disk')
-            ref_seg_buffer, ref_seg_aff, ref_h = load_volume(args.ref_seg, im_only=False, squeeze=True, dtype=None, aff_ref=None)
-            if np.sum(ref_seg_buffer>1000)==0:
-                sf.system.fatal('No cortical labels found; does the segmentation include cortical parcels?')
-            segmentation_net = None
-            # even nearest neighbour interpolation can cause issues with matching labels,
-            # so we need to handle the segmentation values
-            if np.issubdtype( ref_seg_buffer.dtype, float ):
-                ref_seg_buffer = np.round(ref_seg_buffer).astype(int)
-        else:
-            print('Segmenting reference image')
-            print('   Reading reference image')
-            ref_image, ref_aff, ref_h, ref_im_res, ref_shape, ref_pad_idx, ref_crop_idx = preprocess(path_image=args.ref,
-                                                                                                     crop=None, min_pad=128,
-                                                                                                     path_resample=None,
-                                                                                                     autocrop=args.autocrop)
-            print('   Setting up segmentation net')
-            segmentation_net = build_seg_model(model_file_segmentation=path_model_segmentation,
-                                               model_file_parcellation=path_model_parcellation,
-                                               labels_segmentation=labels_segmentation,
-                                               labels_parcellation=labels_parcellation)
+
+def segment_stage(subject, context):
+
+    args = subject['args']
+
+    # Both images in the group of --group_dir: they are already segmented and registered to its template
+    entries = (context.group_entry(args.ref, args.ref_seg, args), context.group_entry(args.flo, args.flo_seg, args))
+    if None not in entries:
+        print('Both images are in the group of %s; composing their registrations to its template' % context.group.directory)
+        subject['group_entries'] = entries
+        return
+
+    # Segment if needed. A reference shared by several subjects is segmented and aligned to the atlas only once, by
+    # the first subject that gets here (see EasyRegContext.shared_reference)
+    if context.is_shared_reference(args):
+        ref_aligned = context.shared_reference(subject, 'alignment', lambda: reference_alignment(subject, context))
+        ref_seg_buffer, ref_seg_aff = None, None
+    else:
+        ref_aligned, ref_seg_buffer, ref_seg_aff = segment_image(subject, 'ref', args.ref, args.ref_seg, context)
+    flo_aligned, flo_seg_buffer, flo_seg_aff = segment_image(subject, 'flo', args.flo, args.flo_seg, context)
+
+    subject['ref_aligned'] = ref_aligned
+    subject['ref_seg_buffer'] = ref_seg_buffer
+    subject['ref_seg_aff'] = ref_seg_aff
+    subject['flo_aligned'] = flo_aligned
+    subject['flo_seg_buffer'] = flo_seg_buffer
+    subject['flo_seg_aff'] = flo_seg_aff
+
+
+def segment_image(subject, side, path_image, path_seg, context):
+    """Segmentation of one image (side 'ref' or 'flo' of the subject): read from path_seg if it exists (or from the
+    segmentation cache), and otherwise computed with SynthSeg and saved there. Returns (aligned, seg_buffer, seg_aff),
+    where aligned is the affine alignment of the image found in the affine cache, if any, in which case the
+    segmentation is not even read (and seg_buffer and seg_aff are None)."""
+
+    args = subject['args']
+    name = {'ref': 'reference', 'flo': 'floating'}[side]
+
+    seg_key = None
+    if (path_seg is not None) and (not os.path.exists(path_seg)) and (context.seg_cache is not None):
+        seg_key = fetch_cached_segmentation(context, subject, path_image, path_seg)
+    aligned = None
+    if (path_seg is not None) and os.path.exists(path_seg) and (context.affine_cache is not None):
+        aligned = fetch_cached_alignment(context, subject, path_image, path_seg)
+    if aligned is not None:
+        print('Affine alignment of %s image found in cache' % name)
+        seg_buffer, seg_aff = None, None
+    elif (path_seg is not None) and os.path.exists(path_seg):
+        print('Segmentation of %s image already exists; reading from disk' % name)
+        with timed(subject, 'segment/%s load' % side):
+            seg_buffer, seg_aff, seg_h = load_volume(path_seg, im_only=False, squeeze=True, dtype=None, aff_ref=None)
+        if np.sum(seg_buffer>1000)==0:
+            sf.system.fatal('No cortical labels found; does the segmentation include cortical parcels?')
+        # even nearest neighbour interpolation can cause issues with matching labels,
+        # so we need to handle the segmentation values
+        if np.issubdtype( seg_buffer.dtype, float ):
+            seg_buffer = np.round(seg_buffer).astype(int)
+    else:
+        with timed(subject, 'segment/%s synthseg' % side):
+            print('Segmenting %s image' % name)
+            print('   Reading %s image' % name)
+            image, aff, h, im_res, shape, pad_idx, crop_idx = preprocess(path_image=path_image,
+                                                                         crop=None, min_pad=128,
+                                                                         path_resample=None,
+                                                                         autocrop=args.autocrop,
+                                                                         dtype=args.precision)
             print('   Inference / segmentation')
-            post_patch_segmentation, post_patch_parcellation = segmentation_net.predict(ref_image)
+            post_patch_segmentation, post_patch_parcellation = predict_segmentation(context.segmentation_net, image,
+                                                                                    args.seg_tile, args.seg_tile_overlap)
             print('   Postprocessing')
-            ref_seg_buffer, _, _ = postprocess(post_patch_seg=post_patch_segmentation,
-                                               post_patch_parc=post_patch_parcellation,
-                                               shape=ref_shape,
-                                               pad_idx=ref_pad_idx,
-                                               crop_idx=ref_crop_idx,
-                                               labels_segmentation=labels_segmentation,
-                                               labels_parcellation=labels_parcellation,
-                                               aff=ref_aff,
-                                               im_res=ref_im_res)
+            seg_buffer, _, _ = postprocess(post_patch_seg=post_patch_segmentation,
+                                           post_patch_parc=post_patch_parcellation,
+                                           shape=shape,
+                                           pad_idx=pad_idx,
+                                           crop_idx=crop_idx,
+                                           labels_segmentation=context.labels_segmentation,
+                                           labels_parcellation=context.labels_parcellation,
+                                           aff=aff,
+                                           im_res=im_res,
+                                           lean=True)
             print('   Saving result')
-            ref_seg_aff = ref_aff
-            save_volume(ref_seg_buffer, ref_seg_aff, ref_h, args.ref_seg, dtype='int32')
-
-        if (args.flo_seg is not None) and os.path.exists(args.flo_seg):
-            print('Segmentation of floating image already exists; reading from disk')
-            flo_seg_buffer, flo_seg_aff, flo_h = load_volume(args.flo_seg, im_only=False, squeeze=True, dtype=None, aff_ref=None)
-            if np.sum(flo_seg_buffer>1000)==0:
-                sf.system.fatal('No cortical labels found; does the segmentation include cortical parcels?')
-            # even nearest neighbour interpolation can cause issues with matching labels,
-            # so we need to handle the segmentation values
-            if np.issubdtype( flo_seg_buffer.dtype, float ):
-                flo_seg_buffer = np.round(flo_seg_buffer).astype(int)
+            seg_aff = aff
+            save_volume(seg_buffer, seg_aff, h, path_seg, dtype='int32', atomic=True)
+            if seg_key is not None:
+                context.seg_cache.put(seg_key, volume_suffix(path_seg), path_seg)
+
+    return aligned, seg_buffer, seg_aff
+
+
+def reference_alignment(subject, context):
+    # (Mref, Rlin) of the reference of the subject: its segmentation and affine alignment in one go, for references
+    # shared by several subjects (see segment_stage) and for the images of a group (see build_group)
+
+    args = subject['args']
+    aligned, seg_buffer, seg_aff = segment_image(subject, 'ref', args.ref, args.ref_seg, context)
+    if aligned is None:
+        aligned = align_to_atlas(subject, 'ref', subject['R'], subject['Raff'], seg_buffer, seg_aff, context,
+                                 getattr(torch, args.precision))
+        if context.affine_cache is not None:
+            store_cached_alignment(context, subject, args.ref, args.ref_seg, *aligned)
+
+    return aligned
+
+
+def fetch_cached_segmentation(context, subject, path_image, path_seg):
+    # materializes the cached segmentation of the image, if any, at path_seg; returns the cache key
+
+    key = context.segmentation_key(path_image, subject['args'])
+    cached = context.seg_cache.get(key, volume_suffix(path_seg))
+    hit = False
+    if cached is not None:
+        mkdir(os.path.dirname(path_seg))
+        try:
+            copy_file(cached, path_seg)
+            hit = True
+            print('Segmentation of %s found in cache' % path_image)
+        except FileNotFoundError:  # evicted in the meantime: it is segmented again
+            pass
+    count_cache(subject, 'segmentation', hit)
+
+    return key
+
+
+def fetch_cached_alignment(context, subject, path_image, path_seg):
+    # (M, atlas-space volume) of the image from the cache, or None; invalid or unreadable entries are discarded
+
+    key = context.alignment_key(path_image, path_seg, subject['args'])
+    path = context.affine_cache.get(key, '.npz')
+    if path is None:
+        return None
+    try:
+        with np.load(path, allow_pickle=False) as entry:
+            if str(entry['key']) != key:
+                raise ValueError('key mismatch')
+            M, lin = entry['M'], entry['lin']
+        if M.shape != (4, 4) or not np.all(np.isfinite(M)) or list(lin.shape) != context.atlas_volsize \
+                or lin.dtype != np.dtype(subject['args'].precision):
+            raise ValueError('unexpected contents')
+    except FileNotFoundError:  # evicted in the meantime
+        return None
+    except Exception as e:
+        print('Discarding invalid entry %s of the affine alignment cache (%s)' % (path, e))
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return None
+    count_cache(subject, 'affine', True)
+
+    return M, as_torch(lin)
+
+
+def store_cached_alignment(context, subject, path_image, path_seg, M, lin):
+
+    key = context.alignment_key(path_image, path_seg, subject['args'])
+    count_cache(subject, 'affine', False)
+    context.affine_cache.write(key, '.npz', lambda f: np.savez(f, key=np.array(key), M=np.asarray(M), lin=lin.numpy()))
+
+
+def affine_stage(subject, context):
+
+    args = subject['args']
+
+    if 'group_entries' in subject:
+        # the group has the affine transforms of both images (see segment_stage)
+        subject['Mref'], subject['Mflo'] = [context.group.transform(entry) for entry in subject['group_entries']]
+        subject['Rlin'], subject['Flin'] = None, None
+        return
+
+    R, Raff = subject['R'], subject['Raff']
+    F, Faff = subject['F'], subject['Faff']
+    ref_aligned, flo_aligned = subject.pop('ref_aligned'), subject.pop('flo_aligned')
+    ref_seg_buffer, ref_seg_aff = subject.pop('ref_seg_buffer'), subject.pop('ref_seg_aff')
+    flo_seg_buffer, flo_seg_aff = subject.pop('flo_seg_buffer'), subject.pop('flo_seg_aff')
+    dtype = getattr(torch, args.precision)
+
+    # Now the linear registration part
+    print('Linear registration')
+
+    if ref_aligned is None:
+        ref_aligned = align_to_atlas(subject, 'ref', R, Raff, ref_seg_buffer, ref_seg_aff, context, dtype)
+        if context.affine_cache is not None:
+            store_cached_alignment(context, subject, args.ref, args.ref_seg, *ref_aligned)
+
+    if flo_aligned is None:
+        flo_aligned = align_to_atlas(subject, 'flo', F, Faff, flo_seg_buffer, flo_seg_aff, context, dtype)
+        if context.affine_cache is not None:
+            store_cached_alignment(context, subject, args.flo, args.flo_seg, *flo_aligned)
+
+    subject['Mref'], subject['Rlin'] = ref_aligned
+    subject['Mflo'], subject['Flin'] = flo_aligned
+
+
+def align_to_atlas(subject, side, image, aff, seg_buffer, seg_aff, context, dtype):
+    """Affine alignment of one image (side 'ref' or 'flo' of the subject) to the atlas. Returns the transform M estimated from the label centroids of the
+    segmentation, and the image resampled to the atlas grid, masked by its (resampled) segmentation and normalized.
+    Both only depend on the image and its segmentation, which makes them cacheable (see fetch_cached_alignment)."""
+
+    name = {'ref': 'reference', 'flo': 'floating'}[side]
+    print('  Computing centroids and estimating affine transform (%s)' % name)
+    with timed(subject, 'affine/%s centroids' % side):
+        COG, ok = get_label_centroids(seg_buffer, context.labels)
+        COG = np.matmul(seg_aff, COG)[:-1, :]
+        M = getM(context.atlasCOG[:, ok > 0], COG[:, ok > 0])
+
+    with timed(subject, 'affine/%s deform' % side):
+        print('  Deforming %s image to reference space' % name)
+        atlas_volsize = context.atlas_volsize
+        atlas_aff = context.atlas_aff
+        II2, JJ2, KK2 = affine_coordinates(np.matmul(np.linalg.inv(aff), np.matmul(M, atlas_aff)), atlas_volsize, dtype=dtype)
+        # the image and its segmentation normally share the affine (and shape), and then an interpolation plan
+        shared = np.array_equal(aff, seg_aff) and tuple(image.shape) == seg_buffer.shape
+        if shared:
+            plan = InterpPlan(II2, JJ2, KK2, image.shape)
+            lin = plan.interpolate(image, 'linear')
         else:
-            print('Segmenting floating image')
-            print('   Reading floating image')
-            flo_image, flo_aff, flo_h, flo_im_res, flo_shape, ref_pad_idx, ref_crop_idx = preprocess(path_image=args.flo,
-                                                                                                     crop=None, min_pad=128,
-                                                                                                     path_resample=None,
-                                                                                                     autocrop=args.autocrop)
-            if segmentation_net is None:
-                print('   Setting up segmentation net')
-                segmentation_net = build_seg_model(model_file_segmentation=path_model_segmentation,
-                                                   model_file_parcellation=path_model_parcellation,
-                                                   labels_segmentation=labels_segmentation,
-                                                   labels_parcellation=labels_parcellation)
-            print('   Inference / segmentation')
-            post_patch_segmentation, post_patch_parcellation = segmentation_net.predict(flo_image)
-            print('   Postprocessing')
-            flo_seg_buffer, _, _ = postprocess(post_patch_seg=post_patch_segmentation,
-                                               post_patch_parc=post_patch_parcellation,
-                                               shape=flo_shape,
-                                               pad_idx=ref_pad_idx,
-                                               crop_idx=ref_crop_idx,
-                                               labels_segmentation=labels_segmentation,
-                                               labels_parcellation=labels_parcellation,
-                                               aff=flo_aff,
-                                               im_res=flo_im_res)
-            print('   Saving result')
-            flo_seg_aff = flo_aff
-            save_volume(flo_seg_buffer, flo_seg_aff, flo_h, args.flo_seg, dtype='int32')
-
-        # Now the linear registration part
-        print('Linear registration')
-
-        print('  Computing centroids and estimating affine transform')
-        labels = np.array([2,4,5,7,8,10,11,12,13,14,15,16,17,18,26,28,41,43,44,46,47,49,50,51,52,53,54,58,60,
-                                        1001,1002,1003,1005,1006,1007,1008,1009,1010,1011,1012,1013,1014,1015,1016,1017,1018,1019,1020,1021,1022,1023,1024,1025,1026,1027,1028,1029,1030,1031,1032,1033,1034,1035,
-                                        2001,2002,2003,2005,2006,2007,2008,2009,2010,2011,2012,2013,2014,2015,2016,2017,2018,2019,2020,2021,2022,2023,2024,2025,2026,2027,2028,2029,2030,2031,2032,2033,2034,2035])
-        nlab = len(labels)
-        atlasCOG = np.array([[-28.,-18.,-37.,-19.,-27.,-19.,-23.,-31.,-26.,-2.,-3.,-3.,-29.,-26.,-14.,-14.,24.,14.,31.,12.,18.,14.,19.,26.,21.,25.,22.,11.,8.,-52.,-6.,-36.,-7.,-24.,-37.,-39.,-52.,-9.,-27.,-26.,-14.,-8.,-59.,-28.,-7.,-49.,-43.,-47.,-12.,-46.,-6.,-43.,-10.,-7.,-33.,-11.,-23.,-55.,-50.,-10.,-29.,-46.,-38.,48.,4.,31.,3.,21.,33.,37.,47.,3.,24.,20.,8.,4.,54.,21.,5.,45.,38.,46.,8.,45.,3.,38.,6.,4.,29.,9.,19.,51.,49.,10.,24.,43.,33.],
-                            [-30.,-17.,-13.,-36.,-40.,-22.,-3.,-5.,-9.,-14.,-31.,-21.,-15.,-1.,3.,-16.,-32.,-20.,-14.,-37.,-42.,-24.,-3.,-6.,-10.,-15.,-2.,3.,-17.,-44.,-5.,-15.,-71.,2.,-29.,-70.,-23.,-44.,-73.,22.,-57.,27.,-19.,-23.,-45.,4.,31.,20.,-68.,-38.,-33.,-26.,-60.,23.,22.,0.,-72.,-12.,-49.,49.,17.,-25.,-3.,-42.,-1.,-16.,-76.,0.,-34.,-69.,-16.,-44.,-73.,22.,-56.,28.,-18.,-25.,-45.,-3.,30.,14.,-69.,-37.,-32.,-30.,-60.,21.,21.,0.,-72.,-11.,-49.,48.,15.,-27.,-3.],
-                            [12.,14.,-13.,-41.,-51.,1.,13.,3.,1.,0.,-40.,-28.,-15.,-10.,2.,-7.,11.,14.,-12.,-40.,-51.,2.,14.,4.,2.,-14.,-10.,4.,-7.,-8.,32.,40.,-14.,-21.,-28.,-4.,-28.,-3.,-35.,3.,-29.,4.,-17.,-21.,35.,18.,9.,20.,-24.,28.,25.,34.,7.,18.,35.,48.,16.,-5.,12.,22.,-18.,1.,4.,-12.,32.,43.,-11.,-21.,-29.,-3.,-27.,0.,-34.,3.,-25.,6.,-18.,-20.,36.,18.,11.,20.,-20.,26.,25.,34.,4.,24.,34.,47.,17.,-5.,10.,20.,-18.,0.,4.]])
-
-        refCOG = np.zeros([4, nlab])
-        ok = np.ones(nlab)
-        for l in range(nlab):
-            aux = np.where(ref_seg_buffer == labels[l])
-            if len(aux[0]) > 50:
-                refCOG[0, l] = np.median(aux[0])
-                refCOG[1, l] = np.median(aux[1])
-                refCOG[2, l] = np.median(aux[2])
-                refCOG[3, l] = 1
-            else:
-                ok[l] = 0
-        refCOG = np.matmul(ref_seg_aff, refCOG)[:-1, :]
-        Mref = getM(atlasCOG[:, ok > 0], refCOG[:, ok > 0])
-
-        floCOG = np.zeros([4, nlab])
-        ok = np.ones(nlab)
-        for l in range(nlab):
-            aux = np.where(flo_seg_buffer == labels[l])
-            if len(aux[0]) > 50:
-                floCOG[0, l] = np.median(aux[0])
-                floCOG[1, l] = np.median(aux[1])
-                floCOG[2, l] = np.median(aux[2])
-                floCOG[3, l] = 1
-            else:
-                ok[l] = 0
-        floCOG = np.matmul(flo_seg_aff, floCOG)[:-1, :]
-        Mflo = getM(atlasCOG[:, ok > 0], floCOG[:, ok > 0])
+            lin = fast_3D_interp_torch(image, II2, JJ2, KK2, 'linear')
 
-        print('  Reading reference image')
-        R, Raff, Rh = load_volume(args.ref, im_only=False, squeeze=True, dtype=None, aff_ref=None)
-        R = torch.tensor(R, device='cpu')
-        print('  Deforming reference image to reference space')
-        II, JJ, KK = np.meshgrid(np.arange(atlas_volsize[0]), np.arange(atlas_volsize[1]), np.arange(atlas_volsize[2]), indexing='ij')
-        II = torch.tensor(II, device='cpu')
-        JJ = torch.tensor(JJ, device='cpu')
-        KK = torch.tensor(KK, device='cpu')
-        affine = torch.tensor(np.matmul(np.linalg.inv(Raff), np.matmul(Mref, atlas_aff)), device='cpu')
-        II2 = affine[0, 0] * II + affine[0, 1] * JJ + affine[0, 2] * KK + affine[0, 3]
-        JJ2 = affine[1, 0] * II + affine[1, 1] * JJ + affine[1, 2] * KK + affine[1, 3]
-        KK2 = affine[2, 0] * II + affine[2, 1] * JJ + affine[2, 2] * KK + affine[2, 3]
-        Rlin = fast_3D_interp_torch(R, II2, JJ2, KK2, 'linear')
-
-        print('  Deforming reference segmentation to reference space')
-        affine = torch.tensor(np.matmul(np.linalg.inv(ref_seg_aff), np.matmul(Mref, atlas_aff)), device='cpu')
-        II2 = affine[0, 0] * II + affine[0, 1] * JJ + affine[0, 2] * KK + affine[0, 3]
-        JJ2 = affine[1, 0] * II + affine[1, 1] * JJ + affine[1, 2] * KK + affine[1, 3]
-        KK2 = affine[2, 0] * II + affine[2, 1] * JJ + affine[2, 2] * KK + affine[2, 3]
-        RSlin = fast_3D_interp_torch(torch.tensor(ref_seg_buffer.copy(), device='cpu'), II2, JJ2, KK2, 'nearest')
-
-        print('  Normalizing intensities of reference image')
-        Rlin[RSlin == 0] = 0
-        Rlin = Rlin / torch.max(Rlin)
-
-        print('  Reading floating image')
-        F, Faff, Fh = load_volume(args.flo, im_only=False, squeeze=True, dtype=None, aff_ref=None)
-        F = torch.tensor(F, device='cpu')
-        print('  Deforming floating image to reference space')
-        affine = torch.tensor(np.matmul(np.linalg.inv(Faff), np.matmul(Mflo, atlas_aff)), device='cpu')
-        II2 = affine[0, 0] * II + affine[0, 1] * JJ + affine[0, 2] * KK + affine[0, 3]
-        JJ2 = affine[1, 0] * II + affine[1, 1] * JJ + affine[1, 2] * KK + affine[1, 3]
-        KK2 = affine[2, 0] * II + affine[2, 1] * JJ + affine[2, 2] * KK + affine[2, 3]
-        Flin = fast_3D_interp_torch(F, II2, JJ2, KK2, 'linear')
-
-        print('  Deforming floating segmentation to reference space')
-        affine = torch.tensor(np.matmul(np.linalg.inv(flo_seg_aff), np.matmul(Mflo, atlas_aff)), device='cpu')
-        II2 = affine[0, 0] * II + affine[0, 1] * JJ + affine[0, 2] * KK + affine[0, 3]
-        JJ2 = affine[1, 0] * II + affine[1, 1] * JJ + affine[1, 2] * KK + affine[1, 3]
-        KK2 = affine[2, 0] * II + affine[2, 1] * JJ + affine[2, 2] * KK + affine[2, 3]
-        FSlin = fast_3D_interp_torch(torch.tensor(flo_seg_buffer.copy(), device='cpu'), II2, JJ2, KK2, 'nearest')
-
-        print('  Normalizing intensities of floating image')
-        Flin[FSlin == 0] = 0
-        Flin = Flin / torch.max(Flin)
+        print('  Deforming %s segmentation to reference space' % name)
+        if shared:
+            Slin = plan.interpolate(as_torch(seg_buffer), 'nearest')
+        else:
+            II2, JJ2, KK2 = affine_coordinates(np.matmul(np.linalg.inv(seg_aff), np.matmul(M, atlas_aff)), atlas_volsize, dtype=dtype)
+            Slin = fast_3D_interp_torch(as_torch(seg_buffer), II2, JJ2, KK2, 'nearest')
+
+        print('  Normalizing intensities of %s image' % name)
+        lin[Slin == 0] = 0
+        lin = lin / torch.max(lin)
+
+    return M, lin
+
+
+def cnn_stage(subjects, context):
+    """Nonlinear registration. After the affine stage all the pairs live on the atlas grid, so the pairs of all the
+    given subjects are stacked along the batch axis and go through the registration model in a single call."""
+
+    batch = []
+    for subject in subjects:
+        Rlin, Flin = subject.pop('Rlin'), subject.pop('Flin')
 
         # Now the nonlinear registration part (if needed)
-        if args.affine_only:
+        if subject['args'].affine_only:
             print('Skipping nonlinear registration')
-
+        elif 'group_entries' in subject:
+            # both images are in the group (see segment_stage): ref -> template -> flo, and back
+            with timed(subject, 'cnn/compose'):
+                print('  Composing fields through the group template')
+                ref_entry, flo_entry = subject['group_entries']
+                subject['f2r_field'] = compose_fields(context.group.field(ref_entry, 'to_template'),
+                                                      context.group.field(flo_entry, 'from_template'))
+                subject['r2f_field'] = compose_fields(context.group.field(flo_entry, 'to_template'),
+                                                      context.group.field(ref_entry, 'from_template'))
         else:
-
-            source = tf.keras.Input(shape=(*atlas_volsize, 1))
-            target = tf.keras.Input(shape=(*atlas_volsize, 1))
-
-            config = {'name': 'vxm_dense', 'fill_value': None, 'input_model': None, 'unet_half_res': True, 'trg_feats': 1,
-             'src_feats': 1, 'use_probs': False, 'bidir': False, 'int_downsize': 2, 'int_steps': 10,
-             'nb_unet_conv_per_level': 1, 'unet_feat_mult': 1, 'nb_unet_levels': None,
-             'nb_unet_features': [[256, 256, 256, 256], [256, 256, 256, 256, 256, 256]], 'inshape': atlas_volsize}
-            cnn = vxm.networks.VxmDense(**config)
-            cnn.load_weights(path_model_registration_trained, by_name=True)
-            svf1 = cnn([source, target])[1]
-            svf2 = cnn([target, source])[1]
-            pos_svf = KL.Lambda(lambda x: 0.5 * x[0] - 0.5 * x[1])([svf1, svf2])
-            neg_svf = KL.Lambda(lambda x: -x)(pos_svf)
-            pos_def_small = vxm.layers.VecInt(method='ss', int_steps=10)(pos_svf)
-            neg_def_small = vxm.layers.VecInt(method='ss', int_steps=10)(neg_svf)
-            pos_def = vxm.layers.RescaleTransform(2)(pos_def_small)
-            neg_def = vxm.layers.RescaleTransform(2)(neg_def_small)
-            model = tf.keras.Model(inputs=[source, target],
-                                          outputs=[pos_def, neg_def])
-            model.load_weights(path_model_registration_trained)
-
-            pred = model.predict([Rlin.detach().numpy()[np.newaxis, ..., np.newaxis], Flin.detach().numpy()[np.newaxis, ..., np.newaxis]])
-
-            r2f_field = torch.tensor(np.squeeze(pred[0]))
-            f2r_field = torch.tensor(np.squeeze(pred[1]))
-
-        # concatenate transforms and save outputs
-        print('Deforming and writing to disk')
-
-        if (args.fwd_field is not None) or (args.flo_reg is not None):
+            batch.append((subject, Rlin, Flin))
+
+    if len(batch) > 0:
+        model = context.registration_model
+        with timed([subject for subject, _, _ in batch], 'cnn/predict'):
+            pred = model.predict([np.stack([Rlin.detach().numpy() for _, Rlin, _ in batch])[..., np.newaxis],
+                                  np.stack([Flin.detach().numpy() for _, _, Flin in batch])[..., np.newaxis]],
+                                 batch_size=len(batch))
+        for b, (subject, _, _) in enumerate(batch):
+            subject['r2f_field'] = as_torch(pred[0][b], getattr(torch, subject['args'].precision))
+            subject['f2r_field'] = as_torch(pred[1][b], getattr(torch, subject['args'].precision))
+
+
+def warp_stage(subject, context):
+
+    args = subject['args']
+    R, Raff, Rh = subject.pop('R'), subject['Raff'], subject['Rh']
+    F, Faff, Fh = subject.pop('F'), subject['Faff'], subject['Fh']
+    Mref, Mflo = subject['Mref'], subject['Mflo']
+    atlas_aff = context.atlas_aff
+    dtype = getattr(torch, args.precision)
+    if not args.affine_only:
+        r2f_field, f2r_field = subject.pop('r2f_field'), subject.pop('f2r_field')
+
+    # concatenate transforms; outputs are saved to disk in write_stage
+    print('Deforming and writing to disk')
+    outputs = []
+
+    if (args.fwd_field is not None) or (args.flo_reg is not None):
+        with timed(subject, 'warp/forward field'):
             print('  Computing forward field')
-            II, JJ, KK = np.meshgrid(np.arange(R.shape[0]), np.arange(R.shape[1]), np.arange(R.shape[2]), indexing='ij')
-            II = torch.tensor(II, device='cpu')
-            JJ = torch.tensor(JJ, device='cpu')
-            KK = torch.tensor(KK, device='cpu')
-            affine = torch.tensor(np.matmul(np.linalg.inv(atlas_aff), np.matmul(np.linalg.inv(Mref), Raff)), device='cpu')
-            II2 = affine[0, 0] * II + affine[0, 1] * JJ + affine[0, 2] * KK + affine[0, 3]
-            JJ2 = affine[1, 0] * II + affine[1, 1] * JJ + affine[1, 2] * KK + affine[1, 3]
-            KK2 = affine[2, 0] * II + affine[2, 1] * JJ + affine[2, 2] * KK + affine[2, 3]
+            # atlas coordinates of the reference grid (which only depend on the reference)
+            II2, JJ2, KK2 = context.shared_reference(subject, 'grid', lambda: affine_coordinates(
+                np.matmul(np.linalg.inv(atlas_aff), np.matmul(np.linalg.inv(Mref), Raff)), R.shape, dtype=dtype))
             if args.affine_only:
                 II3 = II2
                 JJ3 = JJ2
@@ -385,29 +625,22 @@ def main():
             RAS_X = affine[0, 0] * II3 + affine[0, 1] * JJ3 + affine[0, 2] * KK3 + affine[0, 3]
             RAS_Y = affine[1, 0] * II3 + affine[1, 1] * JJ3 + affine[1, 2] * KK3 + affine[1, 3]
             RAS_Z = affine[2, 0] * II3 + affine[2, 1] * JJ3 + affine[2, 2] * KK3 + affine[2, 3]
-            if args.fwd_field is not None:
-                print('  Saving forward field')
-                save_volume(torch.stack([RAS_X, RAS_Y, RAS_Z], axis=-1), Raff, Rh, args.fwd_field, n_dims=3)
-            if args.flo_reg is not None:
+        if args.fwd_field is not None:
+            outputs.append(('fwd_field', '  Saving forward field', torch.stack([RAS_X, RAS_Y, RAS_Z], axis=-1).numpy(), Raff, Rh, args.fwd_field, args.precision))
+        if args.flo_reg is not None:
+            with timed(subject, 'warp/flo_reg'):
                 print('  Deforming floating image')
                 affine = torch.tensor(np.linalg.inv(Faff), device='cpu')
                 II4 = affine[0, 0] * RAS_X + affine[0, 1] * RAS_Y + affine[0, 2] * RAS_Z + affine[0, 3]
                 JJ4 = affine[1, 0] * RAS_X + affine[1, 1] * RAS_Y + affine[1, 2] * RAS_Z + affine[1, 3]
                 KK4 = affine[2, 0] * RAS_X + affine[2, 1] * RAS_Y + affine[2, 2] * RAS_Z + affine[2, 3]
                 registered = fast_3D_interp_torch(F, II4, JJ4, KK4, 'linear')
-                print('  Saving deformed floating image')
-                save_volume(registered, Raff, Rh, args.flo_reg)
+            outputs.append(('flo_reg', '  Saving deformed floating image', registered.numpy(), Raff, Rh, args.flo_reg, None))
 
-        if (args.bak_field is not None) or (args.ref_reg is not None):
+    if (args.bak_field is not None) or (args.ref_reg is not None):
+        with timed(subject, 'warp/backward field'):
             print('  Computing backward field')
-            II, JJ, KK = np.meshgrid(np.arange(F.shape[0]), np.arange(F.shape[1]), np.arange(F.shape[2]), indexing='ij')
-            II = torch.tensor(II, device='cpu')
-            JJ = torch.tensor(JJ, device='cpu')
-            KK = torch.tensor(KK, device='cpu')
-            affine = torch.tensor(np.matmul(np.linalg.inv(atlas_aff), np.matmul(np.linalg.inv(Mflo), Faff)), device='cpu')
-            II2 = affine[0, 0] * II + affine[0, 1] * JJ + affine[0, 2] * KK + affine[0, 3]
-            JJ2 = affine[1, 0] * II + affine[1, 1] * JJ + affine[1, 2] * KK + affine[1, 3]
-            KK2 = affine[2, 0] * II + affine[2, 1] * JJ + affine[2, 2] * KK + affine[2, 3]
+            II2, JJ2, KK2 = affine_coordinates(np.matmul(np.linalg.inv(atlas_aff), np.matmul(np.linalg.inv(Mflo), Faff)), F.shape, dtype=dtype)
             if args.affine_only:
                 II3 = II2
                 JJ3 = JJ2
@@ -421,26 +654,453 @@ def main():
             RAS_X = affine[0, 0] * II3 + affine[0, 1] * JJ3 + affine[0, 2] * KK3 + affine[0, 3]
             RAS_Y = affine[1, 0] * II3 + affine[1, 1] * JJ3 + affine[1, 2] * KK3 + affine[1, 3]
             RAS_Z = affine[2, 0] * II3 + affine[2, 1] * JJ3 + affine[2, 2] * KK3 + affine[2, 3]
-            if args.bak_field is not None:
-                print('  Saving backward field')
-                save_volume(torch.stack([RAS_X, RAS_Y, RAS_Z], axis=-1), Faff, Fh, args.bak_field, n_dims=3)
-            if args.ref_reg is not None:
+        if args.bak_field is not None:
+            outputs.append(('bak_field', '  Saving backward field', torch.stack([RAS_X, RAS_Y, RAS_Z], axis=-1).numpy(), Faff, Fh, args.bak_field, args.precision))
+        if args.ref_reg is not None:
+            with timed(subject, 'warp/ref_reg'):
                 print('  Deforming reference image')
                 affine = torch.tensor(np.linalg.inv(Raff), device='cpu')
                 II4 = affine[0, 0] * RAS_X + affine[0, 1] * RAS_Y + affine[0, 2] * RAS_Z + affine[0, 3]
                 JJ4 = affine[1, 0] * RAS_X + affine[1, 1] * RAS_Y + affine[1, 2] * RAS_Z + affine[1, 3]
                 KK4 = affine[2, 0] * RAS_X + affine[2, 1] * RAS_Y + affine[2, 2] * RAS_Z + affine[2, 3]
                 registered = fast_3D_interp_torch(R, II4, JJ4, KK4, 'linear')
-                print('  Saving deformed reference image')
-                save_volume(registered, Faff, Fh, args.ref_reg)
-
-        print('All done')
-        print(' ')
-        print('If you use EasyReg in your analysis, please cite:')
-        print('A ready-to-use machine learning tool for symmetric multi-modality registration of brain MRI.')
-        print('JE Iglesias. Scientific Reports, accepted for publication.')
-        print('https://www.nature.com/articles/s41598-023-33781-0')
-        print(' ')
+            outputs.append(('ref_reg', '  Saving deformed reference image', registered.numpy(), Faff, Fh, args.ref_reg, None))
+
+    subject['outputs'] = outputs
+
+
+def write_stage(subject, context):
+
+    for name, message, volume, aff, header, path, dtype in subject.pop('outputs'):
+        print(message)
+        with timed(subject, 'write/' + name):
+            save_volume(volume, aff, header, path, dtype=dtype)
+
+    print('All done')
+    print(' ')
+    print('If you use EasyReg in your analysis, please cite:')
+    print('A ready-to-use machine learning tool for symmetric multi-modality registration of brain MRI.')
+    print('JE Iglesias. Scientific Reports, accepted for publication.')
+    print('https://www.nature.com/articles/s41598-023-33781-0')
+    print(' ')
+
+
+# stages of the registration of one subject, in order (see run_subjects and run_batch_pipeline)
+PIPELINE_STAGES = [('read', read_stage), ('segment', segment_stage), ('affine', affine_stage),
+                   ('cnn', cnn_stage), ('warp', warp_stage), ('write', write_stage)]
+
+
+def parse_stage_threads(spec):
+    stage_threads = {name: 1 for name, _ in PIPELINE_STAGES}
+    for item in [i for i in spec.split(',') if i]:
+        name, n = item.split('=')
+        if name not in stage_threads:
+            sf.system.fatal('unknown pipeline stage %s; stages are %s' % (name, ', '.join(stage_threads)))
+        stage_threads[name] = int(n)
+        if stage_threads[name] < 1:
+            sf.system.fatal('every pipeline stage needs at least 1 thread, had %s=%s' % (name, n))
+    return stage_threads
+
+
+def run_batch_pipeline(all_args, context, stage_threads, max_in_flight, reg_batch=1):
+    """Runs the stages of PIPELINE_STAGES as a pipeline: every stage has its own threads, and consecutive stages
+    hand subjects over through bounded queues. Decoding subject i+1 and writing subject i-1 can then overlap with
+    the CNN on subject i, which waits for up to reg_batch subjects and registers them in one call. At most
+    max_in_flight subjects are held in memory at any time, but at least as many as all the cnn threads can hold
+    while they fill their batches (otherwise they could all wait for subjects that are not let in)."""
+
+    min_in_flight = stage_threads['cnn'] * reg_batch
+    if max_in_flight < min_in_flight:
+        print('Holding up to %d subjects in memory (rather than %d), so that the %d cnn threads can fill their batches of %d'
+              % (min_in_flight, max_in_flight, stage_threads['cnn'], reg_batch))
+    in_flight = threading.Semaphore(max(max_in_flight, min_in_flight))
+    set_preprocessing_threads(stage_threads['segment'])
+    queues = [queue.Queue(maxsize=1) for _ in range(len(PIPELINE_STAGES) + 1)]
+    results = []
+
+    def stage_worker(s, counter):
+        name, stage = PIPELINE_STAGES[s]
+        while True:
+            subject = queues[s].get()
+            if subject is None:
+                # end of the batch: pass it on to the other threads of this stage, and then to the next stage
+                queues[s].put(None)
+                with counter['lock']:
+                    counter['running'] -= 1
+                    last = counter['running'] == 0
+                if last:
+                    queues[s + 1].put(None)
+                return
+            group = [subject]
+            while name == 'cnn' and len(group) < reg_batch:
+                subject = queues[s].get()
+                if subject is None:
+                    queues[s].put(None)  # run the incomplete batch, the end of the batch is handled next time
+                    break
+                group.append(subject)
+            run_stage(name, stage, group, context)
+            for subject in group:
+                queues[s + 1].put(subject)
+
+    def feeder():
+        for pat_i, args in enumerate(all_args):
+            in_flight.acquire()
+            print("now doing", pat_i, args.ref)
+            queues[0].put({'index': pat_i, 'args': args, 'error': None, 't0': time.time()})
+        queues[0].put(None)
+
+    threads = [threading.Thread(target=feeder, daemon=True)]
+    for s, (name, _) in enumerate(PIPELINE_STAGES):
+        counter = {'lock': threading.Lock(), 'running': stage_threads[name]}
+        threads += [threading.Thread(target=stage_worker, args=(s, counter), daemon=True) for _ in range(stage_threads[name])]
+    for thread in threads:
+        thread.start()
+
+    while True:
+        subject = queues[-1].get()
+        if subject is None:
+            break
+        results.append(subject_result(subject))
+        context.release_reference(subject)
+        in_flight.release()
+    set_preprocessing_threads(1)
+
+    return sorted(results, key=lambda r: r['index'])
+
+
+def set_preprocessing_threads(threads):
+    # number of threads that preprocess images at the same time; each of them gets an equal share of the budget of
+    # set_num_threads for its blurring and normalisation (see map_slabs)
+    global _preprocessing_threads
+    _preprocessing_threads = max(1, threads)
+
+
+def set_num_threads(threads):
+    # TensorFlow gets the same budget when (and if) it is loaded (see load_frameworks), and so does the preprocessing
+    # (see map_slabs)
+    global _num_threads, _preprocessing_pool
+    with _preprocessing_lock:
+        _num_threads = threads
+        if _preprocessing_pool is not None:
+            _preprocessing_pool.shutdown()
+            _preprocessing_pool = None
+    if tf is not None:
+        tf.config.threading.set_inter_op_parallelism_threads(threads)
+        tf.config.threading.set_intra_op_parallelism_threads(threads)
+    torch.set_num_threads(threads)
+
+
+def load_frameworks():
+    # imports TensorFlow, Keras and voxelmorph (once), and defines the Keras layers that depend on them
+
+    global tf, keras, K, KL, vxm
+    with _frameworks_lock:
+        if vxm is not None:
+            return
+        import tensorflow as tf
+        import keras
+        import keras.backend as K
+        import keras.layers as KL
+
+        # set tensorflow logging and threads
+        tf.get_logger().setLevel('ERROR')
+        K.set_image_data_format('channels_last')
+        if _num_threads is not None:
+            tf.config.threading.set_inter_op_parallelism_threads(_num_threads)
+            tf.config.threading.set_intra_op_parallelism_threads(_num_threads)
+        define_keras_layers()
+
+        import voxelmorph as vxm
+
+
+# state of the worker processes of run_batch_workers (one context per worker, kept for its whole life)
+_worker_context = None
+
+
+def _init_worker(fs_home, threads, cores, counter, cache_options):
+
+    global _worker_context
+
+    # pin the worker to its own share of the cores
+    with counter.get_lock():
+        rank = counter.value
+        counter.value += 1
+    if cores is not None and hasattr(os, 'sched_setaffinity'):
+        # a worker that replaces one that died gets a new rank, past the last share: the shares are reused in turn
+        share = rank % (len(cores) // threads)
+        os.sched_setaffinity(0, cores[share * threads:(share + 1) * threads])
+
+    set_num_threads(threads)
+    _worker_context = EasyRegContext(fs_home, **cache_options)
+
+
+def _run_subjects_in_worker(chunk):
+    # a chunk of tasks (see shard_tasks), registered reg_batch subjects at a time; the references shared by several of
+    # its subjects are released by the end of the chunk
+    tasks, reg_batch = chunk
+    _worker_context.share_references([args for _, args in tasks])
+    results = []
+    for i in range(0, len(tasks), reg_batch):
+        results += run_subjects(tasks[i:i + reg_batch], _worker_context)
+    for result in results:
+        result['worker'] = os.getpid()
+    return results
+
+
+def run_batch_workers(all_args, fs_home, workers, threads, reg_batch=1, cache_options={}):
+    """Shards the subjects of the batch across a pool of long-lived worker processes, in chunks of reg_batch
+    subjects, or more for the subjects of a shared reference (see shard_tasks). Each worker gets a fixed budget of threads // workers threads (TF, torch and BLAS) and, where
+    supported, is pinned to as many cores."""
+
+    workers, threads_per_worker = split_threads(workers, threads, len(all_args))
+    print('using %d workers with %d threads each' % (workers, threads_per_worker))
+
+    # BLAS / OpenMP pools are sized when numpy is imported, so the budget must be in the environment of the workers
+    for var in ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'VECLIB_MAXIMUM_THREADS', 'NUMEXPR_NUM_THREADS']:
+        os.environ[var] = str(threads_per_worker)
+
+    cores = None
+    if hasattr(os, 'sched_getaffinity'):
+        available = sorted(os.sched_getaffinity(0))
+        if len(available) >= workers * threads_per_worker:
+            cores = available
+
+    # spawn rather than fork: TensorFlow is not fork-safe
+    mp_context = multiprocessing.get_context('spawn')
+    counter = mp_context.Value('i', 0)
+    results = []
+    with mp_context.Pool(processes=workers, initializer=_init_worker,
+                         initargs=(fs_home, threads_per_worker, cores, counter, cache_options)) as pool:
+        chunks = shard_tasks(list(enumerate(all_args)), workers, reg_batch)
+        for group_results in pool.imap_unordered(_run_subjects_in_worker, [(chunk, reg_batch) for chunk in chunks]):
+            for result in group_results:
+                print('Finished subject %d (%s) in %.1f seconds' % (result['index'], 'ok' if result['ok'] else 'FAILED', result['seconds']))
+            results += group_results
+
+    return sorted(results, key=lambda r: r['index'])
+
+
+def split_threads(workers, threads, n_subjects):
+    # (workers, threads per worker): no more workers than subjects, nor than threads, which they share evenly
+    workers = min(workers, n_subjects)
+    if workers > threads:
+        print('Warning: %d workers would need at least %d threads; using %d workers (see --threads)' % (workers, workers, threads))
+        workers = max(1, threads)
+    return workers, max(1, threads // workers)
+
+
+def shard_tasks(tasks, workers, reg_batch):
+    """Splits the (index, args) tasks of the batch into the chunks handed to the workers. The subjects of a reference
+    shared by several of them stay together, in at most one chunk per worker (of a multiple of reg_batch subjects),
+    so that each worker computes the reference-side data once per chunk and frees them at its end (see
+    EasyRegContext.shared_reference). The other subjects go reg_batch at a time. Chunks are in the order of the batch."""
+
+    by_reference = {}
+    for task in tasks:
+        by_reference.setdefault(EasyRegContext.reference_key(task[1]), []).append(task)
+    chunks = []
+    single = []
+    for group in by_reference.values():
+        if len(group) == 1:
+            single += group
+        else:
+            size = reg_batch * int(np.ceil(len(group) / (workers * reg_batch)))
+            chunks += [group[i:i + size] for i in range(0, len(group), size)]
+    single.sort(key=lambda task: task[0])
+    chunks += [single[i:i + reg_batch] for i in range(0, len(single), reg_batch)]
+
+    return sorted(chunks, key=lambda chunk: chunk[0][0])
+
+
+def build_group(all_args, context, reg_batch=1):
+    """Registers every image of a group (one args per image, with the image and its segmentation as ref and ref_seg)
+    to a common template, the mean of their affinely aligned images, and stores the results in the group of the
+    context (see RegistrationGroup). This takes one CNN run per image (in batches of reg_batch), after which the
+    registration of any two images of the group is a composition of fields. Returns one result (see subject_result)
+    per image."""
+
+    subjects = [{'index': i, 'args': args, 'error': None, 't0': time.time()} for i, args in enumerate(all_args)]
+
+    # affine alignment to the atlas, kept on disk until the template is known
+    print('Aligning the %d images of the group to the atlas' % len(subjects))
+    for subject in subjects:
+        print("now doing", subject['index'], subject['args'].ref)
+        run_stage('affine', group_align_stage, [subject], context)
+    # images with the same key (e.g., identical files) are only registered once, as the first of them
+    first = {}
+    for subject in subjects:
+        if subject['error'] is None:
+            first.setdefault(subject['key'], subject)
+    aligned = list(first.values())
+
+    if len(aligned) > 0:
+        print('Computing the template of the group')
+        template = np.zeros(context.atlas_volsize, dtype=aligned[0]['args'].precision)
+        for subject in aligned:
+            with np.load(subject['aligned'], allow_pickle=False) as entry:
+                template += entry['lin']
+        template /= len(aligned)
+        template_id = hash_files([], prefix=template.tobytes())
+
+        print('Registering the images of the group to the template')
+        for i in range(0, len(aligned), reg_batch):
+            run_stage('cnn', lambda batch, context: register_to_template(batch, template, template_id, context),
+                      aligned[i:i + reg_batch], context)
+
+        # from now on, the new entries are the group
+        context.group.write('template', id=np.array(template_id), template=template)
+        context.group = RegistrationGroup(context.group.directory)
+        print('Stored %d registrations to the template in %s' % (sum(s['error'] is None for s in aligned), context.group.directory))
+
+    for subject in subjects:
+        if subject['error'] is None:
+            subject['error'] = first[subject['key']]['error']
+        if 'aligned' in subject:
+            try:
+                os.remove(subject['aligned'])
+            except FileNotFoundError:
+                pass
+
+    results = [subject_result(subject) for subject in subjects]
+    for result in results:
+        result['group'] = True
+    return results
+
+
+def group_align_stage(subject, context):
+
+    args = subject['args']
+    print('  Reading image')
+    with timed(subject, 'read/ref'):
+        R, Raff, _ = load_volume(args.ref, im_only=False, squeeze=True, dtype=args.precision, aff_ref=None)
+    subject['R'], subject['Raff'] = as_torch(R), Raff
+    M, lin = reference_alignment(subject, context)
+    del subject['R']
+    subject['key'] = context.group_key(args.ref, args.ref_seg, args)
+    name = '.aligned_%d_%s' % (subject['index'], subject['key'])
+    context.group.write(name, M=np.asarray(M), lin=lin.numpy())
+    subject['aligned'] = context.group.path(name)
+
+
+def register_to_template(subjects, template, template_id, context):
+    # nonlinear registration of aligned images of the group (all in one call, as in cnn_stage) to the template, which
+    # gives the entries of the group
+
+    lins = []
+    for subject in subjects:
+        with np.load(subject['aligned'], allow_pickle=False) as entry:
+            lins.append(entry['lin'])
+    model = context.registration_model
+    with timed(subjects, 'cnn/predict'):
+        pred = model.predict([np.stack([template] * len(subjects))[..., np.newaxis], np.stack(lins)[..., np.newaxis]],
+                             batch_size=len(subjects))
+    for b, subject in enumerate(subjects):
+        precision = subject['args'].precision
+        with np.load(subject['aligned'], allow_pickle=False) as entry:
+            M = entry['M']
+        with timed(subject, 'write/entry'):
+            # the template is the reference: pred[0] goes from the image to the template, and pred[1] back
+            context.group.write(subject['key'], template=np.array(template_id), M=M,
+                                to_template=np.asarray(pred[0][b], dtype=precision),
+                                from_template=np.asarray(pred[1][b], dtype=precision))
+
+
+def print_batch_summary(results):
+
+    n_failed = sum(not r['ok'] for r in results)
+    print('Batch summary: %d subjects, %d succeeded, %d failed, %.1f seconds of registration' %
+          (len(results), len(results) - n_failed, n_failed, sum(r['seconds'] for r in results)))
+    for r in results:
+        if not r['ok']:
+            print('   subject %d (%s, %s): %s' % (r['index'], r['ref'], r['flo'], r['error']))
+    for name in sorted(set(name for r in results for name in r['cache'])):
+        hits = sum(r['cache'][name][0] for r in results if name in r['cache'])
+        misses = sum(r['cache'][name][1] for r in results if name in r['cache'])
+        print('%s cache: %d hits, %d misses' % (name.capitalize(), hits, misses))
+
+
+def print_timings_table(results):
+    # mean (over the subjects that went through it) wall time, CPU time and peak RSS of every stage and step;
+    # the steps of a stage are listed, indented, after it
+    steps = {}
+    for r in results:
+        for t in r['timings']:
+            steps.setdefault(t['step'], []).append(t)
+    if len(steps) == 0:
+        return
+    stages = [name for name, _ in PIPELINE_STAGES]
+    order = sorted(steps, key=lambda step: (stages.index(step.split('/')[0]) if step.split('/')[0] in stages else len(stages), '/' in step))
+    print('Timings (mean per subject; the cnn stage is shared by the subjects of a --reg_batch group):')
+    print('  %-28s %5s %10s %10s %14s' % ('stage / step', 'n', 'wall (s)', 'cpu (s)', 'peak RSS (MB)'))
+    for step in order:
+        records = steps[step]
+        print('  %-28s %5d %10.2f %10.2f %14.0f' % (('  ' + step.split('/', 1)[1]) if '/' in step else step, len(records),
+                                                 np.mean([t['wall'] for t in records]), np.mean([t['cpu'] for t in records]),
+                                                 max(t['peak_rss_mb'] for t in records)))
+
+
+def write_timings(results, path):
+    # one JSON line per subject, with all its timing records
+    mkdir(os.path.dirname(os.path.abspath(path)))
+    with open(path, 'w') as f:
+        for r in results:
+            f.write(json.dumps({key: r[key] for key in ['index', 'group', 'ref', 'flo', 'ok', 'error', 'seconds', 'worker', 'timings'] if key in r}) + '\n')
+
+
+# timing records of the stages (and steps) currently running, in any thread; see timed
+_open_timings = []
+_timings_lock = threading.Lock()
+
+
+@contextlib.contextmanager
+def timed(subjects, step):
+    """Records the wall time, CPU time and peak RSS of the enclosed code as {'step', 'wall', 'cpu', 'peak_rss_mb'} in
+    subject['timings'] of the subject (or list of subjects). CPU time and peak RSS are those of the whole process, so
+    with --pipeline they include the stages of other subjects that run at the same time."""
+
+    subjects = subjects if isinstance(subjects, list) else [subjects]
+    record = {'step': step, 'wall': 0.0, 'cpu': 0.0, 'peak_rss_mb': 0.0}
+    with _timings_lock:
+        # the peak is reset for every record, so the records already open take theirs first
+        update_peak_rss(_open_timings)
+        _open_timings.append(record)
+        reset_peak_rss()
+    wall0, cpu0 = time.perf_counter(), time.process_time()
+    try:
+        yield record
+    finally:
+        record['wall'] = time.perf_counter() - wall0
+        record['cpu'] = time.process_time() - cpu0
+        with _timings_lock:
+            update_peak_rss(_open_timings)
+            _open_timings.remove(record)
+        for subject in subjects:
+            subject.setdefault('timings', []).append(record)
+
+
+def reset_peak_rss():
+    # resets the peak RSS of the process (VmHWM) on Linux; elsewhere, the peak is that of the whole run
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def update_peak_rss(records):
+    # peak RSS (in MB) since the last reset_peak_rss, taken into the given timing records
+    peak = None
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if peak is None:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 ** 2 if sys.platform == 'darwin' else 1024)
+    for record in records:
+        record['peak_rss_mb'] = max(record['peak_rss_mb'], peak)
 
 
 #######################
@@ -448,6 +1108,350 @@ def main():
 #######################
 
 
+# atlas space (the grid of the registration network), and the labels used to estimate the affine transforms to the
+# atlas, with their centroids in atlas space
+ATLAS_VOLSIZE = [160, 160, 192]
+ATLAS_AFF = np.matrix([[-1, 0, 0, 79], [0, 0, 1, -104], [0, -1, 0, 79], [0, 0, 0, 1]])
+ATLAS_LABELS = np.array([2,4,5,7,8,10,11,12,13,14,15,16,17,18,26,28,41,43,44,46,47,49,50,51,52,53,54,58,60,
+                         1001,1002,1003,1005,1006,1007,1008,1009,1010,1011,1012,1013,1014,1015,1016,1017,1018,1019,1020,1021,1022,1023,1024,1025,1026,1027,1028,1029,1030,1031,1032,1033,1034,1035,
+                         2001,2002,2003,2005,2006,2007,2008,2009,2010,2011,2012,2013,2014,2015,2016,2017,2018,2019,2020,2021,2022,2023,2024,2025,2026,2027,2028,2029,2030,2031,2032,2033,2034,2035])
+ATLAS_COG = np.array([[-28.,-18.,-37.,-19.,-27.,-19.,-23.,-31.,-26.,-2.,-3.,-3.,-29.,-26.,-14.,-14.,24.,14.,31.,12.,18.,14.,19.,26.,21.,25.,22.,11.,8.,-52.,-6.,-36.,-7.,-24.,-37.,-39.,-52.,-9.,-27.,-26.,-14.,-8.,-59.,-28.,-7.,-49.,-43.,-47.,-12.,-46.,-6.,-43.,-10.,-7.,-33.,-11.,-23.,-55.,-50.,-10.,-29.,-46.,-38.,48.,4.,31.,3.,21.,33.,37.,47.,3.,24.,20.,8.,4.,54.,21.,5.,45.,38.,46.,8.,45.,3.,38.,6.,4.,29.,9.,19.,51.,49.,10.,24.,43.,33.],
+                     [-30.,-17.,-13.,-36.,-40.,-22.,-3.,-5.,-9.,-14.,-31.,-21.,-15.,-1.,3.,-16.,-32.,-20.,-14.,-37.,-42.,-24.,-3.,-6.,-10.,-15.,-2.,3.,-17.,-44.,-5.,-15.,-71.,2.,-29.,-70.,-23.,-44.,-73.,22.,-57.,27.,-19.,-23.,-45.,4.,31.,20.,-68.,-38.,-33.,-26.,-60.,23.,22.,0.,-72.,-12.,-49.,49.,17.,-25.,-3.,-42.,-1.,-16.,-76.,0.,-34.,-69.,-16.,-44.,-73.,22.,-56.,28.,-18.,-25.,-45.,-3.,30.,14.,-69.,-37.,-32.,-30.,-60.,21.,21.,0.,-72.,-11.,-49.,48.,15.,-27.,-3.],
+                     [12.,14.,-13.,-41.,-51.,1.,13.,3.,1.,0.,-40.,-28.,-15.,-10.,2.,-7.,11.,14.,-12.,-40.,-51.,2.,14.,4.,2.,-14.,-10.,4.,-7.,-8.,32.,40.,-14.,-21.,-28.,-4.,-28.,-3.,-35.,3.,-29.,4.,-17.,-21.,35.,18.,9.,20.,-24.,28.,25.,34.,7.,18.,35.,48.,16.,-5.,12.,22.,-18.,1.,4.,-12.,32.,43.,-11.,-21.,-29.,-3.,-27.,0.,-34.,3.,-25.,6.,-18.,-20.,36.,18.,11.,20.,-20.,26.,25.,34.,4.,24.,34.,47.,17.,-5.,10.,20.,-18.,0.,4.]])
+
+
+class EasyRegContext:
+    """Run-scoped state shared by all the subjects of a batch: label lists, atlas constants and the networks.
+    The networks are only built (and their weights loaded) the first time they are needed, and are then reused."""
+
+    def __init__(self, fs_home, seg_cache_dir=None, seg_cache_gb=20, affine_cache_dir=None, affine_cache_gb=20,
+                 group_dir=None):
+
+        # path models
+        self.path_model_segmentation = fs_home + '/models/synthseg_2.0.h5'
+        self.path_model_parcellation = fs_home + '/models/synthseg_parc_2.0.h5'
+        self.path_model_registration_trained = fs_home + '/models/easyreg_v10_230103.h5'
+
+        # get label lists
+        self.path_label_segmentation = fs_home + '/models/synthseg_segmentation_labels_2.0.npy'
+        self.path_label_parcellation = fs_home + '/models/synthseg_parcellation_labels.npy'
+        labels_segmentation, _ = get_list_labels(label_list=self.path_label_segmentation)
+        self.labels_segmentation, _ = np.unique(labels_segmentation, return_index=True)
+        self.labels_parcellation, _ = np.unique(get_list_labels(self.path_label_parcellation)[0], return_index=True)
+
+        # atlas space, and centroids in atlas space of the labels used to estimate the affine transforms
+        self.atlas_volsize = ATLAS_VOLSIZE
+        self.atlas_aff = ATLAS_AFF
+        self.labels = ATLAS_LABELS
+        self.atlasCOG = ATLAS_COG
+
+        # on-disk caches (optional)
+        self.seg_cache = None if seg_cache_dir is None else FileCache(seg_cache_dir, seg_cache_gb * 1e9)
+        self.affine_cache = None if affine_cache_dir is None else FileCache(affine_cache_dir, affine_cache_gb * 1e9)
+        self._segmentation_models_digest = None
+        self._file_digests = {}
+
+        # registrations of the images of a group to its template (optional, see build_group)
+        self.group = None if group_dir is None else RegistrationGroup(group_dir)
+
+        # reference-side data (image, affine alignment, forward-field grid) of the references shared by several
+        # subjects, computed once and released after the last of their subjects (see share_references)
+        self._reference_subjects = {}
+        self._references = {}
+
+        # networks, built on first use
+        self._segmentation_net = None
+        self._registration_model = None
+        self._lock = threading.Lock()
+        self.setup_seconds = 0.0
+
+    @property
+    def segmentation_net(self):
+        with self._lock:
+            if self._segmentation_net is None:
+                print('   Setting up segmentation net')
+                t0 = time.time()
+                self._segmentation_net = build_seg_model(model_file_segmentation=self.path_model_segmentation,
+                                                         model_file_parcellation=self.path_model_parcellation,
+                                                         labels_segmentation=self.labels_segmentation,
+                                                         labels_parcellation=self.labels_parcellation)
+                self.setup_seconds += time.time() - t0
+        return self._segmentation_net
+
+    @property
+    def registration_model(self):
+        with self._lock:
+            if self._registration_model is None:
+                print('  Setting up registration net')
+                t0 = time.time()
+                self._registration_model = build_reg_model(model_file=self.path_model_registration_trained,
+                                                           atlas_volsize=self.atlas_volsize)
+                self.setup_seconds += time.time() - t0
+        return self._registration_model
+
+    def segmentation_key(self, path_image, args):
+        # cache key of the segmentation of an image: hash of the image file, of the SynthSeg models and label lists,
+        # and of the options that change the segmentation
+        with self._lock:
+            if self._segmentation_models_digest is None:
+                self._segmentation_models_digest = hash_files([self.path_model_segmentation, self.path_model_parcellation,
+                                                               self.path_label_segmentation, self.path_label_parcellation])
+        options = 'synthseg-2.0 autocrop=%s precision=%s tile=%s/%s' % (args.autocrop, args.precision, args.seg_tile, args.seg_tile_overlap)
+        if args.seg_tile is not None:
+            options += ' labels-per-tile'  # tiles are no longer blended (see predict_segmentation)
+        return hash_files([], prefix=(self._segmentation_models_digest + options + self.file_digest(path_image)).encode())
+
+    def alignment_key(self, path_image, path_seg, args):
+        # cache key of the affine alignment of an image to the atlas: hash of the image and segmentation files, and of
+        # the options that change the result (bump the version whenever the affine stage or the atlas changes)
+        options = 'easyreg-affine-v1 precision=%s' % args.precision
+        return hash_files([], prefix=(options + self.file_digest(path_image) + self.file_digest(path_seg)).encode())
+
+    def group_key(self, path_image, path_seg, args):
+        # key of an image in a group: that of its affine alignment, and the hash of the registration model
+        options = 'easyreg-group-v1'
+        return hash_files([], prefix=(options + self.alignment_key(path_image, path_seg, args) +
+                                      self.file_digest(self.path_model_registration_trained)).encode())
+
+    def group_entry(self, path_image, path_seg, args):
+        # path of the entry of the image in the group (see RegistrationGroup), or None if it is not in it
+        if (self.group is None) or (self.group.template_id is None) or (path_seg is None) or (not os.path.exists(path_seg)):
+            return None
+        return self.group.find(self.group_key(path_image, path_seg, args))
+
+    def share_references(self, all_args):
+        # registers subjects about to be run (the batch, or a chunk of it in a worker), so that the data of the
+        # references of more than one of them are shared until the last of them is released
+        counts = {}
+        for args in all_args:
+            key = self.reference_key(args)
+            counts[key] = counts.get(key, 0) + 1
+        with self._lock:
+            for key, n in counts.items():
+                if n > 1:
+                    self._reference_subjects[key] = self._reference_subjects.get(key, 0) + n
+
+    @staticmethod
+    def reference_key(args):
+        # everything the reference-side data depend on: reference image and segmentation, and the options that
+        # change them
+        return (os.path.abspath(args.ref), os.path.abspath(args.ref_seg), args.precision, args.autocrop,
+                args.seg_tile, args.seg_tile_overlap)
+
+    def is_shared_reference(self, args):
+        with self._lock:
+            return self.reference_key(args) in self._reference_subjects
+
+    def shared_reference(self, subject, name, compute):
+        # compute() (some data derived from the reference of the subject, e.g., its image), computed only once, by
+        # the first subject that asks, if the reference is shared by several subjects; the others wait for it. Every
+        # name has its own lock, so waiting for one does not hold up the subjects that need another
+        key = self.reference_key(subject['args'])
+        with self._lock:
+            if key not in self._reference_subjects:
+                slot = None
+            else:
+                slot = self._references.setdefault(key, {}).setdefault(name, {'lock': threading.Lock()})
+        if slot is None:
+            return compute()
+        with slot['lock']:
+            if 'value' not in slot:
+                slot['value'] = compute()
+            return slot['value']
+
+    def release_reference(self, subject):
+        # called once per subject when it is done (or has failed); frees the data of its reference after the last one
+        key = self.reference_key(subject['args'])
+        with self._lock:
+            if key in self._reference_subjects:
+                self._reference_subjects[key] -= 1
+                if self._reference_subjects[key] == 0:
+                    del self._reference_subjects[key]
+                    self._references.pop(key, None)
+
+    def file_digest(self, path):
+        # hash of the contents of a file, remembered for the run (as long as the file does not change)
+        stat = os.stat(path)
+        signature = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+        with self._lock:
+            digest = self._file_digests.get(signature)
+        if digest is None:
+            digest = hash_files([path])
+            with self._lock:
+                self._file_digests[signature] = digest
+        return digest
+
+
+class FileCache:
+    """Content-addressed on-disk cache, which can be shared by worker processes and by concurrent runs. Entries are
+    files named after their key, written atomically, and evicted least recently used first whenever the cache grows
+    over max_bytes. Entries are private copies: they never share their data with the files of the user (which could
+    otherwise be modified through them, or modify them). The size of the cache is counted as entries are added, and
+    the directory is only scanned (which also accounts for the entries of other processes) when that count goes over
+    max_bytes."""
+
+    def __init__(self, directory, max_bytes):
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        mkdir(directory)
+        self.total_bytes = sum(size for _, size, _ in self.entries())
+
+    def path(self, key, suffix):
+        return os.path.join(self.directory, key[:2], key + suffix)
+
+    def get(self, key, suffix):
+        # path of the entry, or None if not cached
+        path = self.path(key, suffix)
+        try:
+            os.utime(path)  # mark as recently used
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, suffix, source):
+        # stores a copy of the file source, and evicts old entries if needed
+        path = self.path(key, suffix)
+        mkdir(os.path.dirname(path))
+        copy_file(source, path)
+        self.added(path)
+
+    def write(self, key, suffix, save):
+        # stores the file written by save(file object), and evicts old entries if needed
+        path = self.path(key, suffix)
+        mkdir(os.path.dirname(path))
+        tmp_path = temporary_path(path)
+        with open(tmp_path, 'wb') as f:
+            save(f)
+        os.replace(tmp_path, path)
+        self.added(path)
+
+    def added(self, path):
+        # counts a new entry, and evicts old entries once the count goes over max_bytes
+        try:
+            size = os.path.getsize(path)
+        except FileNotFoundError:  # evicted by someone else
+            return
+        with self._lock:
+            self.total_bytes += size
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        # (time of last use, size, path) of every entry
+        entries = []
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if not file.startswith('.tmp_'):
+                    try:
+                        stat = os.stat(os.path.join(root, file))
+                    except FileNotFoundError:  # evicted by someone else
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(root, file)))
+        return entries
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(entry[1] for entry in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.total_bytes = total
+
+
+class RegistrationGroup:
+    """Registrations of the images of a group to a common template on the atlas grid, written by build_group. Every
+    image has an entry <key>.npz (see EasyRegContext.group_key) with its affine transform M to the atlas, and the
+    displacement fields (in atlas voxels) from its atlas-space volume to the template and back. Two images of the
+    group are then registered by composing their fields (see compose_fields) instead of running the CNN. Entries
+    from earlier versions of the group, i.e., written for another template, are ignored."""
+
+    def __init__(self, directory):
+
+        self.directory = directory
+        self.template_id = None
+        mkdir(directory)
+        try:
+            with np.load(os.path.join(directory, 'template.npz'), allow_pickle=False) as template:
+                self.template_id = str(template['id'])
+        except FileNotFoundError:  # the group has not been built yet
+            pass
+
+    def path(self, name):
+        return os.path.join(self.directory, name + '.npz')
+
+    def find(self, key):
+        # path of the entry of the image with this key, or None if it is not in the group
+        if self.template_id is None:
+            return None
+        try:
+            with np.load(self.path(key), allow_pickle=False) as entry:
+                if str(entry['template']) != self.template_id:
+                    return None
+        except FileNotFoundError:
+            return None
+        return self.path(key)
+
+    def transform(self, path):
+        with np.load(path, allow_pickle=False) as entry:
+            return entry['M']
+
+    def field(self, path, name):
+        # 'to_template' or 'from_template' displacement field of an entry
+        with np.load(path, allow_pickle=False) as entry:
+            return as_torch(entry[name])
+
+    def write(self, name, **arrays):
+        # writes (atomically) the entry, template or temporary file name
+        path = self.path(name)
+        tmp_path = temporary_path(path)
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+
+def copy_file(source, path):
+    # atomically makes the file path a copy of source
+    tmp_path = temporary_path(path)
+    try:
+        shutil.copyfile(source, tmp_path)
+    except OSError:  # e.g., source evicted in the meantime, or out of space
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    os.replace(tmp_path, path)
+
+
+def temporary_path(path):
+    # name under which path is written before being renamed into place (unique to the process and thread)
+    return os.path.join(os.path.dirname(path), '.tmp_%d_%d_%s' % (os.getpid(), threading.get_ident(), os.path.basename(path)))
+
+
+def volume_suffix(path):
+    return '.nii.gz' if path.endswith('.nii.gz') else os.path.splitext(path)[1]
+
+
+def hash_files(paths, prefix=b''):
+    digest = hashlib.sha256(prefix)
+    for path in paths:
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+def count_cache(subject, name, hit):
+    # hit / miss counts of the caches, reported in the batch summary
+    counts = subject.setdefault('cache', {}).setdefault(name, [0, 0])
+    counts[0 if hit else 1] += 1
+
+
 def get_list_labels(label_list=None, save_label_list=None, FS_sort=False):
 
     # load label list if previously computed
@@ -544,28 +1548,46 @@ def load_array_if_path(var, load_as_numpy=True):
     return var
 
 
+def native_array(data):
+    # array (or array proxy) in its on-disk data type, in native byte order, and with unsigned types that torch cannot
+    # do arithmetic with (uint16, uint32) widened to signed ones. No copy is made when none of these apply
+
+    volume = np.asanyarray(data)
+    if not volume.dtype.isnative:
+        volume = volume.astype(volume.dtype.newbyteorder('='))
+    if volume.dtype == np.uint16:
+        volume = volume.astype(np.int32)
+    elif volume.dtype == np.uint32:
+        volume = volume.astype(np.int64)
+
+    return volume
+
+
 def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=None):
 
     assert path_volume.endswith(('.nii', '.nii.gz', '.mgz', '.npz')), 'Unknown data file: %s' % path_volume
 
+    # with dtype=None, the data is returned in its on-disk type (see native_array); uncompressed files are memory-mapped
     if path_volume.endswith(('.nii', '.nii.gz', '.mgz')):
-        x = nib.load(path_volume)
-        if squeeze:
-            volume = np.squeeze(x.get_fdata())
+        x = nib.load(path_volume, mmap='c')
+        if (dtype is not None) and ('float' in dtype):
+            volume = x.get_fdata(dtype=dtype)
         else:
-            volume = x.get_fdata()
+            volume = native_array(x.dataobj)
+        if squeeze:
+            volume = np.squeeze(volume)
         aff = x.affine
         header = x.header
     else:  # npz
-        volume = np.load(path_volume)['vol_data']
+        volume = native_array(np.load(path_volume)['vol_data'])
         if squeeze:
             volume = np.squeeze(volume)
         aff = np.eye(4)
         header = nib.Nifti1Header()
     if dtype is not None:
-        if 'int' in dtype:
+        if ('int' in dtype) and (not np.issubdtype(volume.dtype, np.integer)):
             volume = np.round(volume)
-        volume = volume.astype(dtype=dtype)
+        volume = volume.astype(dtype=dtype, copy=False)
 
     # align image to reference affine matrix
     if aff_ref is not None:
@@ -580,9 +1602,9 @@ def load_volume(path_volume, im_only=True, squeeze=True, dtype=None, aff_ref=Non
 
 
 
-def preprocess(path_image, n_levels=5, crop=None, min_pad=None, path_resample=None, autocrop=False):
+def preprocess(path_image, n_levels=5, crop=None, min_pad=None, path_resample=None, autocrop=False, dtype='float32'):
     # read image and corresponding info
-    im, _, aff, n_dims, n_channels, h, im_res = get_volume_info(path_image, True)
+    im, _, aff, n_dims, n_channels, h, im_res = get_volume_info(path_image, True, dtype=dtype)
     if n_dims < 3:
         sf.system.fatal('input should have 3 dimensions, had %s' % n_dims)
     elif n_dims == 4 and n_channels == 1:
@@ -653,39 +1675,90 @@ def resample_volume(volume, aff, new_vox_size, interpolation='linear'):
     sigmas = 0.25 / factor
     sigmas[factor > 1] = 0  # don't blur if upsampling
 
-    volume_filt = gaussian_filter(volume, sigmas)
-
     # volume2 = zoom(volume_filt, factor, order=1, mode='reflect', prefilter=False)
-    x = np.arange(0, volume_filt.shape[0])
-    y = np.arange(0, volume_filt.shape[1])
-    z = np.arange(0, volume_filt.shape[2])
-
     start = - (factor - 1) / (2 * factor)
     step = 1.0 / factor
-    stop = start + step * np.ceil(volume_filt.shape * factor)
-
-    xi = np.arange(start=start[0], stop=stop[0], step=step[0])
-    yi = np.arange(start=start[1], stop=stop[1], step=step[1])
-    zi = np.arange(start=start[2], stop=stop[2], step=step[2])
-    xi[xi < 0] = 0
-    yi[yi < 0] = 0
-    zi[zi < 0] = 0
-    xi[xi > (volume_filt.shape[0] - 1)] = volume_filt.shape[0] - 1
-    yi[yi > (volume_filt.shape[1] - 1)] = volume_filt.shape[1] - 1
-    zi[zi > (volume_filt.shape[2] - 1)] = volume_filt.shape[2] - 1
-
-    xig, yig, zig = np.meshgrid(xi, yi, zi, indexing='ij', sparse=False)
-    xig = torch.tensor(xig, device='cpu')
-    yig = torch.tensor(yig, device='cpu')
-    zig = torch.tensor(zig, device='cpu')
-    volume2 = fast_3D_interp_torch(torch.tensor(volume_filt, device='cpu'), xig, yig, zig, 'linear')
+    stop = start + step * np.ceil(volume.shape * factor)
+
+    # the new grid is axis-aligned with the old one, so blurring and trilinear interpolation are separable: they are
+    # done one axis at a time, each pass on the (already resampled along the previous axes) output of the previous one
+    volume2 = volume
+    for axis in range(3):
+        if sigmas[axis] > 0:
+            volume2 = blur_axis(volume2, sigmas[axis], axis)
+        xi = np.arange(start=start[axis], stop=stop[axis], step=step[axis])
+        xi[xi < 0] = 0
+        xi[xi > (volume.shape[axis] - 1)] = volume.shape[axis] - 1
+        volume2 = interpolate_axis(volume2, xi.astype(volume.dtype), axis)
 
     aff2 = aff.copy()
     for c in range(3):
         aff2[:-1, c] = aff2[:-1, c] / factor[c]
     aff2[:-1, -1] = aff2[:-1, -1] - np.matmul(aff2[:-1, :-1], 0.5 * (factor - 1))
 
-    return volume2.numpy(), aff2
+    return volume2, aff2
+
+
+def blur_axis(volume, sigma, axis, threads=None):
+    # 1-D Gaussian blur along one axis of a volume, with up to threads threads (see map_slabs). The volume is split
+    # into slabs along another axis, and each slab is filtered into its part of the output in its own thread (scipy
+    # releases the GIL while filtering). Every filtered line lies within one slab, so the result is the same as that
+    # of a single gaussian_filter1d call
+    if volume.size < 2 ** 20:
+        return gaussian_filter1d(volume, sigma, axis=axis)
+
+    split = 1 if axis == 0 else 0
+    output = np.empty_like(volume)
+
+    def blur(start, stop):
+        slab = (slice(None),) * split + (slice(start, stop),)
+        gaussian_filter1d(volume[slab], sigma, axis=axis, output=output[slab])
+
+    map_slabs(blur, volume.shape[split], threads)
+
+    return output
+
+
+def map_slabs(function, n, threads=None):
+    # calls function(start, stop) on consecutive slabs [start, stop) that cover range(n), up to threads of them at the
+    # same time, in the thread pool shared by all the preprocessing. By default, threads is the share of the budget of
+    # set_num_threads of each of the threads that preprocess at the same time (see set_preprocessing_threads)
+    if threads is None:
+        threads = max(1, (_num_threads or 1) // _preprocessing_threads)
+    n_slabs = min(threads, n)
+    if n_slabs < 2:
+        function(0, n)
+        return
+
+    global _preprocessing_pool
+    with _preprocessing_lock:
+        if _preprocessing_pool is None:
+            _preprocessing_pool = concurrent.futures.ThreadPoolExecutor(max_workers=_num_threads or 1,
+                                                                        thread_name_prefix='preprocessing')
+        pool = _preprocessing_pool
+    bounds = np.linspace(0, n, n_slabs + 1).astype(int)
+    futures = [pool.submit(function, bounds[i], bounds[i + 1]) for i in range(n_slabs)]
+    for future in futures:
+        future.result()
+
+
+def interpolate_axis(volume, coordinates, axis):
+    # 1-D linear interpolation along one axis of a volume, at the given voxel coordinates. The arithmetic is that of
+    # InterpPlan (so three passes give its trilinear interpolation), including that samples not strictly inside
+    # (0, n - 1] are set to zero, e.g., the first plane when its coordinate is clamped to 0
+    n = volume.shape[axis]
+    X = as_torch(volume)
+    coordinates = as_torch(coordinates)
+    floor = torch.floor(coordinates).long().clamp_(0, n - 1)
+    ceil = (floor + 1).clamp_(max=n - 1)
+    wc = coordinates - floor
+    wf = 1 - wc
+    shape = [1] * X.dim()
+    shape[axis] = -1
+    Y = torch.index_select(X, axis, floor) * wf.reshape(shape) + torch.index_select(X, axis, ceil) * wc.reshape(shape)
+    Y[(slice(None),) * axis + (~((coordinates > 0) & (coordinates <= n - 1)),)] = 0
+
+    return Y.numpy()
 
 def find_closest_number_divisible_by_m(n, m, answer_type='lower'):
     if n % m == 0:
@@ -705,9 +1778,9 @@ def find_closest_number_divisible_by_m(n, m, answer_type='lower'):
 
 
 
-def get_volume_info(path_volume, return_volume=False, aff_ref=None, max_channels=10):
+def get_volume_info(path_volume, return_volume=False, aff_ref=None, max_channels=10, dtype=None):
 
-    im, aff, header = load_volume(path_volume, im_only=False)
+    im, aff, header = load_volume(path_volume, im_only=False, dtype=dtype)
 
     # understand if image is multichannel
     im_shape = list(im.shape)
@@ -802,9 +1875,25 @@ def build_seg_model(model_file_segmentation,
                 labels_segmentation,
                 labels_parcellation):
 
+    load_frameworks()
+
     if not os.path.isfile(model_file_segmentation):
         sf.system.fatal("The provided model path does not exist.")
 
+    segmentation_net, parcellation_net, net = seg_model_architecture(labels_segmentation, labels_parcellation)
+    segmentation_net.load_weights(model_file_segmentation, by_name=True)
+    parcellation_net.load_weights(model_file_parcellation, by_name=True)
+
+    return net
+
+
+def seg_model_architecture(labels_segmentation, labels_parcellation):
+    # the network of build_seg_model, with randomly initialized weights, and the parts of it that the segmentation
+    # and parcellation model files are loaded into (by layer name): the segmentation U-Net, and everything up to the
+    # parcellation U-Net
+
+    load_frameworks()
+
     # get labels
     n_labels_seg = len(labels_segmentation)
 
@@ -819,7 +1908,7 @@ def build_seg_model(model_file_segmentation,
                nb_conv_per_level=2,
                batch_norm=-1,
                name='unet')
-    net.load_weights(model_file_segmentation, by_name=True)
+    segmentation_net = net
     input_image = net.inputs[0]
     name_segm_prediction_layer = 'unet_prediction'
 
@@ -853,7 +1942,7 @@ def build_seg_model(model_file_segmentation,
                batch_norm=-1,
                name='unet_parc',
                input_model=net)
-    net.load_weights(model_file_parcellation, by_name=True)
+    parcellation_net = net
 
     # smooth predictions
     last_tensor = net.output
@@ -861,7 +1950,93 @@ def build_seg_model(model_file_segmentation,
     last_tensor = GaussianBlur(sigma=0.5)(last_tensor)
     net = keras.Model(inputs=net.inputs, outputs=[net.get_layer(name_segm_prediction_layer).output, last_tensor])
 
-    return net
+    return segmentation_net, parcellation_net, net
+
+def predict_segmentation(net, image, tile_size=None, overlap=32):
+    """Runs the segmentation network of build_seg_model on a preprocessed image, and returns the posteriors of the
+    segmentation and of the parcellation. With tile_size, the network runs on overlapping tiles of (at most)
+    tile_size^3 voxels, and the posteriors of each tile are reduced right away to per-voxel labels (see
+    reduce_posteriors); every voxel keeps those of the tile in which it is the most central (i.e., with the largest
+    blending weight), so neither the activations nor the outputs grow with the number of labels times the field of
+    view. The tiled result is ((foreground, segmentation index, parcellation index), None), for postprocess_lean."""
+
+    if tile_size is None:
+        return net.predict(image)
+
+    shape = image.shape[1:4]
+    starts = [tile_starts(n, tile_size, overlap) for n in shape]
+    weights = [tile_weights(min(n, tile_size), overlap if len(s) > 1 else 0) for n, s in zip(shape, starts)]
+    best_weight = np.zeros(shape, dtype='float32')
+    labels = None
+    for i in starts[0]:
+        for j in starts[1]:
+            for k in starts[2]:
+                tile = tuple(slice(start, start + len(w)) for start, w in zip([i, j, k], weights))
+                post_seg, post_parc = net.predict(image[(slice(None),) + tile], verbose=0)
+                reduced = reduce_posteriors(post_seg[0].astype('float32', copy=False),
+                                            post_parc[0].astype('float32', copy=False))
+                if labels is None:
+                    labels = [np.zeros(shape, dtype=r.dtype) for r in reduced]
+                w = weights[0][:, None, None] * weights[1][None, :, None] * weights[2][None, None, :]
+                closer = w > best_weight[tile]
+                for volume, r in zip(labels, reduced):
+                    np.copyto(volume[tile], r, where=closer)
+                np.copyto(best_weight[tile], w, where=closer)
+
+    return tuple(volume[np.newaxis] for volume in labels), None
+
+
+def tile_starts(n, tile_size, overlap):
+    # first voxels of the tiles along an axis of n voxels; the last tile ends at the last voxel
+    if n <= tile_size:
+        return [0]
+    return list(range(0, n - tile_size, tile_size - overlap)) + [n - tile_size]
+
+
+def tile_weights(n, overlap):
+    # blending weights along an axis of a tile of n voxels: linear ramps over the overlap at both ends (always > 0)
+    ramp = np.minimum(np.arange(1, n + 1), np.arange(n, 0, -1)) / (overlap + 1)
+    return np.minimum(ramp, 1).astype('float32')
+
+
+def build_reg_model(model_file, atlas_volsize):
+
+    load_frameworks()
+
+    cnn, model = reg_model_architecture(atlas_volsize)
+    cnn.load_weights(model_file, by_name=True)
+    model.load_weights(model_file)
+
+    return model
+
+
+def reg_model_architecture(atlas_volsize):
+    # the network of build_reg_model, with randomly initialized weights, and the voxelmorph network in it
+
+    load_frameworks()
+
+    source = tf.keras.Input(shape=(*atlas_volsize, 1))
+    target = tf.keras.Input(shape=(*atlas_volsize, 1))
+
+    config = {'name': 'vxm_dense', 'fill_value': None, 'input_model': None, 'unet_half_res': True, 'trg_feats': 1,
+     'src_feats': 1, 'use_probs': False, 'bidir': False, 'int_downsize': 2, 'int_steps': 10,
+     'nb_unet_conv_per_level': 1, 'unet_feat_mult': 1, 'nb_unet_levels': None,
+     'nb_unet_features': [[256, 256, 256, 256], [256, 256, 256, 256, 256, 256]], 'inshape': atlas_volsize}
+    cnn = vxm.networks.VxmDense(**config)
+    # both directions go through the U-Net together: [source, target] and [target, source] stacked along the batch axis
+    moving = KL.Lambda(lambda x: tf.concat([x[0], x[1]], axis=0))([source, target])
+    fixed = KL.Lambda(lambda x: tf.concat([x[1], x[0]], axis=0))([source, target])
+    svf = cnn([moving, fixed])[1]
+    pos_svf = KL.Lambda(lambda x: 0.5 * x[0][:tf.shape(x[1])[0]] - 0.5 * x[0][tf.shape(x[1])[0]:])([svf, source])
+    neg_svf = KL.Lambda(lambda x: -x)(pos_svf)
+    pos_def_small = vxm.layers.VecInt(method='ss', int_steps=10)(pos_svf)
+    neg_def_small = vxm.layers.VecInt(method='ss', int_steps=10)(neg_svf)
+    pos_def = vxm.layers.RescaleTransform(2)(pos_def_small)
+    neg_def = vxm.layers.RescaleTransform(2)(neg_def_small)
+    model = tf.keras.Model(inputs=[source, target],
+                                  outputs=[pos_def, neg_def])
+
+    return cnn, model
 
 def unet(nb_features,
          input_shape,
@@ -1185,7 +2360,12 @@ def conv_dec(nb_features,
     return model
 
 def postprocess(post_patch_seg, post_patch_parc, shape, pad_idx, crop_idx,
-                labels_segmentation, labels_parcellation, aff, im_res):
+                labels_segmentation, labels_parcellation, aff, im_res, lean=False):
+
+    # registration only needs the hard segmentation (see postprocess_lean)
+    if lean:
+        return postprocess_lean(post_patch_seg, post_patch_parc, shape, pad_idx, crop_idx,
+                                labels_segmentation, labels_parcellation, aff), None, None
 
     # get posteriors
     post_patch_seg = np.squeeze(post_patch_seg)
@@ -1245,8 +2425,86 @@ def postprocess(post_patch_seg, post_patch_parc, shape, pad_idx, crop_idx,
 
     return seg, posteriors, volumes
 
-def save_volume(volume, aff, header, path, res=None, dtype=None, n_dims=3):
+def postprocess_lean(post_patch_seg, post_patch_parc, shape, pad_idx, crop_idx,
+                     labels_segmentation, labels_parcellation, aff):
+    """Same hard segmentation (with cortical parcels) as postprocess, without the posteriors and volumes. Works in
+    float32 and in place on the posteriors given (which are modified), masks them by broadcasting instead of stacking
+    copies of the masks, and only normalizes the parcellation posteriors of the cortical voxels. The posteriors may
+    also come already reduced to per-voxel labels, as returned by the tiled predict_segmentation."""
+
+    if post_patch_parc is None:
+        # labels of reduce_posteriors: only the largest connected component needs the whole volume
+        foreground, seg_index, parc_index = [crop_volume_with_idx(np.squeeze(volume), pad_idx, n_dims=3, return_copy=False)
+                                             for volume in post_patch_seg]
+        foreground = get_largest_connected_component(foreground)
+        seg_patch = labels_segmentation[np.where(foreground, seg_index, 0)].astype('int32')
+        mask = (seg_patch == 3) | (seg_patch == 42)
+        seg_patch[mask] = labels_parcellation[parc_index[mask]].astype('int32')
+        return paste_segmentation(seg_patch, shape, crop_idx, aff)
+
+    # get posteriors
+    post_patch_seg = np.squeeze(post_patch_seg).astype('float32', copy=False)
+    post_patch_seg = crop_volume_with_idx(post_patch_seg, pad_idx, n_dims=3, return_copy=False)
+
+    # keep biggest connected component
+    tmp_post_patch_seg = post_patch_seg[..., 1:]
+    post_patch_seg_mask = np.sum(tmp_post_patch_seg, axis=-1) > 0.25
+    post_patch_seg_mask = get_largest_connected_component(post_patch_seg_mask)
+    np.copyto(tmp_post_patch_seg, 0, where=np.logical_not(post_patch_seg_mask)[..., np.newaxis])
+
+    # reset posteriors to zero outside the largest connected component of each topological class
+    np.copyto(tmp_post_patch_seg, 0, where=tmp_post_patch_seg <= 0.2)
+
+    # get hard segmentation
+    post_patch_seg /= np.sum(post_patch_seg, axis=-1)[..., np.newaxis]
+    seg_patch = labels_segmentation[post_patch_seg.argmax(-1).astype('int32')].astype('int32')
+    del post_patch_seg, tmp_post_patch_seg
+
+    # parcellation, only needed in the cortex (where the background posterior is zeroed)
+    post_patch_parc = np.squeeze(post_patch_parc)
+    post_patch_parc = crop_volume_with_idx(post_patch_parc, pad_idx, n_dims=3, return_copy=False)
+    mask = (seg_patch == 3) | (seg_patch == 42)
+    post_patch_parc = post_patch_parc[mask].astype('float32', copy=False)
+    post_patch_parc[:, 0] = 0
+    post_patch_parc /= np.sum(post_patch_parc, axis=-1)[..., np.newaxis]
+    seg_patch[mask] = labels_parcellation[post_patch_parc.argmax(-1).astype('int32')].astype('int32')
+
+    return paste_segmentation(seg_patch, shape, crop_idx, aff)
+
+
+def reduce_posteriors(post_seg, post_parc):
+    # the per-voxel part of postprocess_lean, on float32 posteriors [..., n_labels] (which are modified): the mask of
+    # voxels whose non-background posteriors add up to more than 0.25, the index (in labels_segmentation) of the hard
+    # segmentation, valid within the largest connected component of that mask (outside, it is the background), and
+    # the index (in labels_parcellation) of the cortical parcel
+    foreground = np.sum(post_seg[..., 1:], axis=-1) > 0.25
+    np.copyto(post_seg[..., 1:], 0, where=post_seg[..., 1:] <= 0.2)
+    post_seg /= np.sum(post_seg, axis=-1)[..., np.newaxis]
+    post_parc[..., 0] = 0
+    post_parc /= np.sum(post_parc, axis=-1)[..., np.newaxis]
+    return foreground, post_seg.argmax(-1).astype('int16'), post_parc.argmax(-1).astype('int16')
+
+
+def paste_segmentation(seg_patch, shape, crop_idx, aff):
+    # paste patch back to matrix of original image size
+    if crop_idx is not None:
+        seg = np.zeros(shape=shape, dtype='int32')
+        seg[crop_idx[0]:crop_idx[3], crop_idx[1]:crop_idx[4], crop_idx[2]:crop_idx[5]] = seg_patch
+    else:
+        seg = seg_patch
+
+    # align prediction back to first orientation
+    return align_volume_to_ref(seg, aff=np.eye(4), aff_ref=aff, n_dims=3, return_copy=False)
+
+
+def save_volume(volume, aff, header, path, res=None, dtype=None, n_dims=3, atomic=False):
     mkdir(os.path.dirname(path))
+    if atomic:
+        # write next to the target and rename, so that concurrent readers never see a partially written file
+        tmp_path = os.path.join(os.path.dirname(path), '.tmp_%d_%d_%s' % (os.getpid(), threading.get_ident(), os.path.basename(path)))
+        save_volume(volume, aff, header, tmp_path, res=res, dtype=dtype, n_dims=n_dims)
+        os.replace(tmp_path, path)
+        return
     if '.npz' in path:
         np.savez_compressed(path, vol_data=volume)
     else:
@@ -1279,7 +2537,8 @@ def mkdir(path_dir):
             path_dir = path_dir[:-1]
         if not os.path.isdir(path_dir):
             list_dir_to_create = [path_dir]
-            while not os.path.isdir(os.path.dirname(list_dir_to_create[-1])):
+            # (a relative path ends at '', the working directory)
+            while os.path.dirname(list_dir_to_create[-1]) != '' and not os.path.isdir(os.path.dirname(list_dir_to_create[-1])):
                 list_dir_to_create.append(os.path.dirname(list_dir_to_create[-1]))
             for dir_to_create in reversed(list_dir_to_create):
                 os.mkdir(dir_to_create)
@@ -1310,126 +2569,215 @@ def getM(ref, mov):
     return M
 
 
-def fast_3D_interp_torch(X, II, JJ, KK, mode):
-    if mode=='nearest':
-        IIr = torch.round(II).long()
-        JJr = torch.round(JJ).long()
-        KKr = torch.round(KK).long()
-        IIr[IIr < 0] = 0
-        JJr[JJr < 0] = 0
-        KKr[KKr < 0] = 0
-        IIr[IIr > (X.shape[0] - 1)] = (X.shape[0] - 1)
-        JJr[JJr > (X.shape[1] - 1)] = (X.shape[1] - 1)
-        KKr[KKr > (X.shape[2] - 1)] = (X.shape[2] - 1)
-        Y = X[IIr, JJr, KKr]
-    elif mode=='linear':
-        ok = (II>0) & (JJ>0) & (KK>0) & (II<=X.shape[0]-1) & (JJ<=X.shape[1]-1) & (KK<=X.shape[2]-1)
-        IIv = II[ok]
-        JJv = JJ[ok]
-        KKv = KK[ok]
-
-        fx = torch.floor(IIv).long()
-        cx = fx + 1
-        cx[cx > (X.shape[0] - 1)] = (X.shape[0] - 1)
-        wcx = IIv - fx
-        wfx = 1 - wcx
-
-        fy = torch.floor(JJv).long()
-        cy = fy + 1
-        cy[cy > (X.shape[1] - 1)] = (X.shape[1] - 1)
-        wcy = JJv - fy
-        wfy = 1 - wcy
-
-        fz = torch.floor(KKv).long()
-        cz = fz + 1
-        cz[cz > (X.shape[2] - 1)] = (X.shape[2] - 1)
-        wcz = KKv - fz
-        wfz = 1 - wcz
-
-        c000 = X[fx, fy, fz]
-        c100 = X[cx, fy, fz]
-        c010 = X[fx, cy, fz]
-        c110 = X[cx, cy, fz]
-        c001 = X[fx, fy, cz]
-        c101 = X[cx, fy, cz]
-        c011 = X[fx, cy, cz]
-        c111 = X[cx, cy, cz]
-
-        c00 = c000 * wfx + c100 * wcx
-        c01 = c001 * wfx + c101 * wcx
-        c10 = c010 * wfx + c110 * wcx
-        c11 = c011 * wfx + c111 * wcx
-
-        c0 = c00 * wfy + c10 * wcy
-        c1 = c01 * wfy + c11 * wcy
-
-        c = c0 * wfz + c1 * wcz
-
-        Y = torch.zeros(II.shape, device='cpu')
-        Y[ok] = c.float()
+def get_label_centroids(seg, labels, min_voxels=50):
+    """Median voxel coordinates of every label in a single pass over the segmentation.
+    Returns a 4 x n_labels matrix of homogeneous coordinates (zeros for labels with min_voxels voxels or fewer)
+    and the 0/1 vector of labels with enough voxels, i.e., the same as looping over np.where / np.median per label."""
 
-    else:
-        sf.system.fatal('mode must be linear or nearest')
+    nlab = len(labels)
+    shape = seg.shape
+
+    # index of each voxel in the label list (-1 for voxels not in it)
+    lut = np.full(max(int(np.max(seg)), int(np.max(labels))) + 1, -1, dtype='int64')
+    lut[labels] = np.arange(nlab)
+    seg_idx = lut[np.maximum(seg, 0).ravel()]
+    seg_idx[seg.ravel() < 0] = -1
+    vox = np.flatnonzero(seg_idx >= 0)
+    lab = seg_idx[vox]
+    coords = np.unravel_index(vox, shape)
+    counts = np.bincount(lab, minlength=nlab)
+
+    # medians from per-axis histograms: the k-th smallest coordinate of a label is the first bin whose cumulative
+    # count exceeds k; the median is the average of the elements of rank floor((n-1)/2) and floor(n/2)
+    COG = np.zeros([4, nlab])
+    rank_low = (counts - 1) // 2
+    rank_high = counts // 2
+    for d in range(3):
+        hist = np.bincount(lab * shape[d] + coords[d], minlength=nlab * shape[d]).reshape([nlab, shape[d]])
+        cumhist = np.cumsum(hist, axis=1)
+        low = np.sum(cumhist <= rank_low[:, np.newaxis], axis=1)
+        high = np.sum(cumhist <= rank_high[:, np.newaxis], axis=1)
+        COG[d, :] = 0.5 * (low + high)
+
+    ok = (counts > min_voxels).astype('float64')
+    COG[:, ok == 0] = 0
+    COG[3, ok > 0] = 1
+
+    return COG, ok
 
-    return Y
 
+def as_torch(array, dtype=None):
+    # zero-copy handoff from numpy to torch where ownership allows: only arrays with negative strides are copied (and
+    # the tensor is converted if a different dtype is requested)
+
+    if any(stride < 0 for stride in array.strides):
+        array = array.copy()
+    tensor = torch.from_numpy(array)
+
+    return tensor if dtype is None else tensor.to(dtype)
+
+
+def affine_coordinates(affine, shape, start=0, stop=None, dtype=torch.float32):
+    # Voxel coordinates (II2, JJ2, KK2) = affine * (II, JJ, KK) of the grid of the given shape, optionally only for the
+    # slab [start, stop) along the first axis. Computed by broadcasting the per-axis terms, which avoids building the
+    # full (int64) meshgrids and the float64 products
+
+    affine = np.asarray(affine, dtype=np.float64)
+    stop = shape[0] if stop is None else min(stop, shape[0])
+    axes = [np.arange(start, stop), np.arange(shape[1]), np.arange(shape[2])]
+    coordinates = []
+    for row in range(3):
+        terms = [torch.tensor(affine[row, axis] * axes[axis], dtype=dtype) for axis in range(3)]
+        terms[2] += float(affine[row, 3])
+        coordinates.append((terms[0][:, None, None] + terms[1][None, :, None]) + terms[2][None, None, :])
+
+    return coordinates
+
+
+def fast_3D_interp_torch(X, II, JJ, KK, mode):
+    # one-off interpolation: the floors, weights and mask are computed one chunk of voxels at a time (see InterpPlan)
+    if mode not in ['linear', 'nearest']:
+        sf.system.fatal('mode must be linear or nearest')
+
+    return InterpPlan(II, JJ, KK, X.shape[:3], precompute=False).interpolate(X, mode)
 
 
 def fast_3D_interp_field_torch(X, II, JJ, KK):
 
-    ok = (II > 0) & (JJ > 0) & (KK > 0) & (II <= X.shape[0] - 1) & (JJ <= X.shape[1] - 1) & (KK <= X.shape[2] - 1)
-    IIv = II[ok]
-    JJv = JJ[ok]
-    KKv = KK[ok]
+    return InterpPlan(II, JJ, KK, X.shape[:3], precompute=False).interpolate(X, 'linear')
+
+
+def compose_fields(first, second):
+    # displacement field (in voxels, on the grid of first) of following first and then second: x -> y = x + first(x)
+    # -> y + second(y). Where y falls outside the grid of second, its displacement is taken to be zero
+    II, JJ, KK = affine_coordinates(np.eye(4), first.shape[:3], dtype=first.dtype)
+    second = fast_3D_interp_field_torch(second, II + first[..., 0], JJ + first[..., 1], KK + first[..., 2])
+
+    return first + second
+
+
+class InterpPlan:
+    """Interpolation plan: the (clamped) floor indices, the trilinear weights and the validity mask of the voxel
+    coordinates (II, JJ, KK) into volumes of a given shape. Computed once, and applied to any number of volumes of
+    that shape, with linear or nearest interpolation, e.g., to an image and its segmentation when they share the
+    same affine. A plan only pays off when it is reused: with precompute=False, nothing is stored but the
+    coordinates, and the floors, weights and mask are computed for each chunk of voxels as it is interpolated (which
+    is what fast_3D_interp_torch and fast_3D_interp_field_torch do)."""
+
+    def __init__(self, II, JJ, KK, shape, chunk_size=2 ** 18, precompute=True):
+
+        self.shape = tuple(shape)
+        self.out_shape = tuple(II.shape)
+        self.chunk_size = chunk_size
+        self.size = II.numel()
+        self.dtype = II.dtype
+        self.coordinates = [II.reshape(-1), JJ.reshape(-1), KK.reshape(-1)]
+        self.floors = self.weights = self.ok = None
+        if precompute:
+            floors, self.weights, self.ok = self._chunk(0, self.size)
+            self.floors = [floor.int() for floor in floors]
+            self.coordinates = None
+
+    def _chunk(self, start, stop):
+        # (clamped) floor indices, trilinear weights and validity mask of the voxels start:stop, from the plan or
+        # computed from the coordinates. Voxels outside the volume are clamped to valid indices (and zeroed in linear
+        # interpolation)
+        if self.ok is not None:
+            return ([floor[start:stop].long() for floor in self.floors], [weight[start:stop] for weight in self.weights],
+                    self.ok[start:stop])
+
+        floors = []
+        weights = []
+        ok = None
+        for coordinates, n in zip(self.coordinates, self.shape):
+            coordinates = coordinates[start:stop]
+            inside = (coordinates > 0) & (coordinates <= n - 1)
+            ok = inside if ok is None else ok & inside
+            floor = torch.floor(coordinates).long().clamp_(0, n - 1)
+            weights.append(coordinates - floor)
+            floors.append(floor)
+        return floors, weights, ok
+
+    def interpolate(self, X, mode):
+        # linear: trilinear interpolation, in the precision of the coordinates (or of X, if higher), with the voxels
+        # outside the volume set to zero. nearest: nearest neighbour (rounding half to even, like torch.round), with
+        # the voxels outside the volume taking the value at the closest border, in the data type of X. Volumes with
+        # channels (last) are interpolated all at once, from the memory of X in any dense layout (see flat_view)
+
+        nc = X.shape[3] if len(X.shape) == 4 else 1
+        Xf, strides = flat_view(X if len(X.shape) == 4 else X[..., None])
+        channels = torch.arange(nc) * strides[3]
+        if mode == 'linear':
+            Y = torch.empty([self.size, nc], dtype=torch.promote_types(X.dtype, self.dtype))
+        else:
+            Y = torch.empty([self.size, nc], dtype=X.dtype)
+
+        for start in range(0, self.size, self.chunk_size):
+            stop = start + self.chunk_size
+            floors, weights, ok = self._chunk(start, stop)
+            if mode == 'linear':
+                Y[start:stop] = self._linear_chunk(Xf, strides, channels, floors, weights, ok)
+            else:
+                index = channels
+                for d in range(3):
+                    floor = floors[d]
+                    weight = weights[d]
+                    closest = floor + ((weight > 0.5) | ((weight == 0.5) & (floor % 2 == 1))).long()
+                    index = index + (closest.clamp_(max=self.shape[d] - 1) * strides[d])[:, None]
+                Y[start:stop] = Xf[index]
+
+        Y = Y.reshape(*self.out_shape, nc)
+        if len(X.shape) == 3:
+            Y = Y[..., 0]
 
-    fx = torch.floor(IIv).long()
-    cx = fx + 1
-    cx[cx > (X.shape[0] - 1)] = (X.shape[0] - 1)
-    wcx = IIv - fx
-    wfx = 1 - wcx
+        return Y
 
-    fy = torch.floor(JJv).long()
-    cy = fy + 1
-    cy[cy > (X.shape[1] - 1)] = (X.shape[1] - 1)
-    wcy = JJv - fy
-    wfy = 1 - wcy
+    def _linear_chunk(self, Xf, strides, channels, floors, weights, ok):
 
-    fz = torch.floor(KKv).long()
-    cz = fz + 1
-    cz[cz > (X.shape[2] - 1)] = (X.shape[2] - 1)
-    wcz = KKv - fz
-    wfz = 1 - wcz
+        f = []
+        c = []
+        wc = []
+        wf = []
+        for d in range(3):
+            floor = floors[d]
+            f.append(floor * strides[d])
+            c.append((floor + 1).clamp_(max=self.shape[d] - 1) * strides[d])
+            wc.append(weights[d][:, None])
+            wf.append(1 - wc[d])
 
-    Y = torch.zeros([*II.shape, 3], device='cpu')
-    for channel in range(3):
+        fxfy = (f[0] + f[1])[:, None] + channels
+        cxfy = (c[0] + f[1])[:, None] + channels
+        fxcy = (f[0] + c[1])[:, None] + channels
+        cxcy = (c[0] + c[1])[:, None] + channels
+        fz = f[2][:, None]
+        cz = c[2][:, None]
 
-        Xc = X[:, :, :, channel]
+        c00 = Xf[fxfy + fz] * wf[0] + Xf[cxfy + fz] * wc[0]
+        c01 = Xf[fxfy + cz] * wf[0] + Xf[cxfy + cz] * wc[0]
+        c10 = Xf[fxcy + fz] * wf[0] + Xf[cxcy + fz] * wc[0]
+        c11 = Xf[fxcy + cz] * wf[0] + Xf[cxcy + cz] * wc[0]
 
-        c000 = Xc[fx, fy, fz]
-        c100 = Xc[cx, fy, fz]
-        c010 = Xc[fx, cy, fz]
-        c110 = Xc[cx, cy, fz]
-        c001 = Xc[fx, fy, cz]
-        c101 = Xc[cx, fy, cz]
-        c011 = Xc[fx, cy, cz]
-        c111 = Xc[cx, cy, cz]
+        c0 = c00 * wf[1] + c10 * wc[1]
+        c1 = c01 * wf[1] + c11 * wc[1]
 
-        c00 = c000 * wfx + c100 * wcx
-        c01 = c001 * wfx + c101 * wcx
-        c10 = c010 * wfx + c110 * wcx
-        c11 = c011 * wfx + c111 * wcx
+        Y = c0 * wf[2] + c1 * wc[2]
+        Y.masked_fill_(~ok[:, None], 0)
 
-        c0 = c00 * wfy + c10 * wcy
-        c1 = c01 * wfy + c11 * wcy
+        return Y
 
-        c = c0 * wfz + c1 * wcz
 
-        Yc = torch.zeros(II.shape, device='cpu')
-        Yc[ok] = c.float()
+def flat_view(X):
+    # 1D view of the memory of a (dense) tensor, whatever its layout (e.g., Fortran-ordered arrays from nibabel), and the
+    # strides to index it with. Tensors that are not dense (e.g., strided slices) are copied first
 
-        Y[:, :, :, channel] = Yc
+    expected = 1
+    for d in sorted(range(X.dim()), key=lambda d: X.stride(d)):
+        if X.shape[d] > 1 and X.stride(d) != expected:
+            X = X.contiguous()
+            break
+        expected *= X.shape[d]
 
-    return Y
+    return X.as_strided([X.numel()], [1]), X.stride()
 
 
 def crop_volume_with_idx(volume, crop_idx, aff=None, n_dims=None, return_copy=True):
@@ -1559,24 +2907,48 @@ def crop_volume(volume, cropping_margin=None, cropping_shape=None, aff=None, ret
 
 
 
-def rescale_volume(volume, new_min=0, new_max=255, min_percentile=2., max_percentile=98., use_positive_only=False):
+def rescale_volume(volume, new_min=0, new_max=255, min_percentile=2., max_percentile=98., use_positive_only=False,
+                   threads=None):
 
-    # select only positive intensities
-    new_volume = volume.copy()
-    intensities = new_volume[new_volume > 0] if use_positive_only else new_volume.flatten()
+    # large volumes are copied, clipped and rescaled in parallel slabs (see map_slabs)
+    if volume.size < 2 ** 20:
+        threads = 1
+
+    # select only positive intensities (in a copy, which np.percentile may reorder). The order of the intensities does
+    # not matter, so they are copied in memory order
+    if use_positive_only:
+        intensities = volume[volume > 0]
+    else:
+        flat = volume.ravel(order='K')
+        intensities = np.empty_like(flat)
+        map_slabs(lambda start, stop: np.copyto(intensities[start:stop], flat[start:stop]), flat.size, threads)
+
+    # define min and max intensities in original image for normalisation. Both percentiles come from a single
+    # np.percentile call, which finds the order statistics it needs by partial partitioning (selection) of the
+    # intensities in place, and interpolates them linearly as usual
+    percentiles = np.percentile(intensities, [min_percentile, max_percentile], overwrite_input=True)
+    robust_min = np.min(intensities) if min_percentile == 0 else percentiles[0]
+    robust_max = np.max(intensities) if max_percentile == 100 else percentiles[1]
+    del intensities
 
-    # define min and max intensities in original image for normalisation
-    robust_min = np.min(intensities) if min_percentile == 0 else np.percentile(intensities, min_percentile)
-    robust_max = np.max(intensities) if max_percentile == 100 else np.percentile(intensities, max_percentile)
+    # avoid dividing by zero
+    if robust_min == robust_max:
+        return np.zeros(volume.shape, dtype=np.result_type(volume, robust_min, robust_max))
 
-    # trim values outside range
-    new_volume = np.clip(new_volume, robust_min, robust_max)
+    # trim values outside range, and rescale image (in place)
+    new_volume = np.empty(volume.shape, dtype=np.result_type(volume, robust_min, robust_max))
 
-    # rescale image
-    if robust_min != robust_max:
-        return new_min + (new_volume - robust_min) / (robust_max - robust_min) * (new_max - new_min)
-    else:  # avoid dividing by zero
-        return np.zeros_like(new_volume)
+    def rescale(start, stop):
+        slab = new_volume[start:stop]
+        np.clip(volume[start:stop], robust_min, robust_max, out=slab)
+        slab -= robust_min
+        slab /= (robust_max - robust_min)
+        slab *= (new_max - new_min)
+        slab += new_min
+
+    map_slabs(rescale, volume.shape[0], threads)
+
+    return new_volume
 
 
 
@@ -1795,117 +3167,120 @@ def get_mapping_lut(source, dest=None):
     return lut
 
 
-class GaussianBlur(KL.Layer):
-    """Applies gaussian blur to an input image."""
-
-    def __init__(self, sigma, random_blur_range=None, use_mask=False, **kwargs):
-        self.sigma = reformat_to_list(sigma)
-        assert np.all(np.array(self.sigma) >= 0), 'sigma should be superior or equal to 0'
-        self.use_mask = use_mask
-
-        self.n_dims = None
-        self.n_channels = None
-        self.blur_range = random_blur_range
-        self.stride = None
-        self.separable = None
-        self.kernels = None
-        self.convnd = None
-        super(GaussianBlur, self).__init__(**kwargs)
-
-    def get_config(self):
-        config = super().get_config()
-        config["sigma"] = self.sigma
-        config["random_blur_range"] = self.blur_range
-        config["use_mask"] = self.use_mask
-        return config
-
-    def build(self, input_shape):
-
-        # get shapes
-        if self.use_mask:
-            assert len(input_shape) == 2, 'please provide a mask as second layer input when use_mask=True'
-            self.n_dims = len(input_shape[0]) - 2
-            self.n_channels = input_shape[0][-1]
-        else:
-            self.n_dims = len(input_shape) - 2
-            self.n_channels = input_shape[-1]
-
-        # prepare blurring kernel
-        self.stride = [1]*(self.n_dims+2)
-        self.sigma = reformat_to_list(self.sigma, length=self.n_dims)
-        self.separable = np.linalg.norm(np.array(self.sigma)) > 5
-        if self.blur_range is None:  # fixed kernels
-            self.kernels = gaussian_kernel(self.sigma, separable=self.separable)
-        else:
+def define_keras_layers():
+    # the layers subclass keras.layers.Layer, so they can only be defined once Keras is imported (see load_frameworks)
+
+    global GaussianBlur, ConvertLabels
+
+    class GaussianBlur(KL.Layer):
+        """Applies gaussian blur to an input image."""
+
+        def __init__(self, sigma, random_blur_range=None, use_mask=False, **kwargs):
+            self.sigma = reformat_to_list(sigma)
+            assert np.all(np.array(self.sigma) >= 0), 'sigma should be superior or equal to 0'
+            self.use_mask = use_mask
+
+            self.n_dims = None
+            self.n_channels = None
+            self.blur_range = random_blur_range
+            self.stride = None
+            self.separable = None
             self.kernels = None
+            self.convnd = None
+            super(GaussianBlur, self).__init__(**kwargs)
+
+        def get_config(self):
+            config = super().get_config()
+            config["sigma"] = self.sigma
+            config["random_blur_range"] = self.blur_range
+            config["use_mask"] = self.use_mask
+            return config
+
+        def build(self, input_shape):
+
+            # get shapes
+            if self.use_mask:
+                assert len(input_shape) == 2, 'please provide a mask as second layer input when use_mask=True'
+                self.n_dims = len(input_shape[0]) - 2
+                self.n_channels = input_shape[0][-1]
+            else:
+                self.n_dims = len(input_shape) - 2
+                self.n_channels = input_shape[-1]
+
+            # prepare blurring kernel
+            self.stride = [1]*(self.n_dims+2)
+            self.sigma = reformat_to_list(self.sigma, length=self.n_dims)
+            self.separable = np.linalg.norm(np.array(self.sigma)) > 5
+            if self.blur_range is None:  # fixed kernels
+                self.kernels = gaussian_kernel(self.sigma, separable=self.separable)
+            else:
+                self.kernels = None
 
-        # prepare convolution
-        self.convnd = getattr(tf.nn, 'conv%dd' % self.n_dims)
+            # prepare convolution
+            self.convnd = getattr(tf.nn, 'conv%dd' % self.n_dims)
 
-        self.built = True
-        super(GaussianBlur, self).build(input_shape)
+            self.built = True
+            super(GaussianBlur, self).build(input_shape)
 
-    def call(self, inputs, **kwargs):
+        def call(self, inputs, **kwargs):
 
-        if self.use_mask:
-            image = inputs[0]
-            mask = tf.cast(inputs[1], 'bool')
-        else:
-            image = inputs
-            mask = None
+            if self.use_mask:
+                image = inputs[0]
+                mask = tf.cast(inputs[1], 'bool')
+            else:
+                image = inputs
+                mask = None
 
-        # redefine the kernels at each new step when blur_range is activated
-        if self.blur_range is not None:
-            self.kernels = gaussian_kernel(self.sigma, blur_range=self.blur_range, separable=self.separable)
+            # redefine the kernels at each new step when blur_range is activated
+            if self.blur_range is not None:
+                self.kernels = gaussian_kernel(self.sigma, blur_range=self.blur_range, separable=self.separable)
 
-        if self.separable:
-            for k in self.kernels:
-                if k is not None:
-                    image = tf.concat([self.convnd(tf.expand_dims(image[..., n], -1), k, self.stride, 'SAME')
+            if self.separable:
+                for k in self.kernels:
+                    if k is not None:
+                        image = tf.concat([self.convnd(tf.expand_dims(image[..., n], -1), k, self.stride, 'SAME')
+                                           for n in range(self.n_channels)], -1)
+                        if self.use_mask:
+                            maskb = tf.cast(mask, 'float32')
+                            maskb = tf.concat([self.convnd(tf.expand_dims(maskb[..., n], -1), k, self.stride, 'SAME')
+                                               for n in range(self.n_channels)], -1)
+                            image = image / (maskb + keras.backend.epsilon())
+                            image = tf.where(mask, image, tf.zeros_like(image))
+            else:
+                if any(self.sigma):
+                    image = tf.concat([self.convnd(tf.expand_dims(image[..., n], -1), self.kernels, self.stride, 'SAME')
                                        for n in range(self.n_channels)], -1)
                     if self.use_mask:
                         maskb = tf.cast(mask, 'float32')
-                        maskb = tf.concat([self.convnd(tf.expand_dims(maskb[..., n], -1), k, self.stride, 'SAME')
+                        maskb = tf.concat([self.convnd(tf.expand_dims(maskb[..., n], -1), self.kernels, self.stride, 'SAME')
                                            for n in range(self.n_channels)], -1)
                         image = image / (maskb + keras.backend.epsilon())
                         image = tf.where(mask, image, tf.zeros_like(image))
-        else:
-            if any(self.sigma):
-                image = tf.concat([self.convnd(tf.expand_dims(image[..., n], -1), self.kernels, self.stride, 'SAME')
-                                   for n in range(self.n_channels)], -1)
-                if self.use_mask:
-                    maskb = tf.cast(mask, 'float32')
-                    maskb = tf.concat([self.convnd(tf.expand_dims(maskb[..., n], -1), self.kernels, self.stride, 'SAME')
-                                       for n in range(self.n_channels)], -1)
-                    image = image / (maskb + keras.backend.epsilon())
-                    image = tf.where(mask, image, tf.zeros_like(image))
-
-        return image
-
 
-class ConvertLabels(KL.Layer):
+            return image
 
-    def __init__(self, source_values, dest_values=None, **kwargs):
-        self.source_values = source_values
-        self.dest_values = dest_values
-        self.lut = None
-        super(ConvertLabels, self).__init__(**kwargs)
 
-    def get_config(self):
-        config = super().get_config()
-        config["source_values"] = self.source_values
-        config["dest_values"] = self.dest_values
-        return config
+    class ConvertLabels(KL.Layer):
 
-    def build(self, input_shape):
-        self.lut = tf.convert_to_tensor(get_mapping_lut(self.source_values, dest=self.dest_values), dtype='int32')
-        self.built = True
-        super(ConvertLabels, self).build(input_shape)
+        def __init__(self, source_values, dest_values=None, **kwargs):
+            self.source_values = source_values
+            self.dest_values = dest_values
+            self.lut = None
+            super(ConvertLabels, self).__init__(**kwargs)
 
-    def call(self, inputs, **kwargs):
-        return tf.gather(self.lut, tf.cast(inputs, dtype='int32'))
+        def get_config(self):
+            config = super().get_config()
+            config["source_values"] = self.source_values
+            config["dest_values"] = self.dest_values
+            return config
 
+        def build(self, input_shape):
+            self.lut = tf.convert_to_tensor(get_mapping_lut(self.source_values, dest=self.dest_values), dtype='int32')
+            self.built = True
+            super(ConvertLabels, self).build(input_shape)
 
+        def call(self, inputs, **kwargs):
+            return tf.gather(self.lut, tf.cast(inputs, dtype='int32'))
 
 
 # execute script
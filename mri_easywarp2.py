@@ -11,21 +11,21 @@ def main():
     parser = argparse.ArgumentParser(description="EasyReg (warping code): deep learning registration simple and easy", epilog='\n')
 
     # input/outputs
-    parser.add_argument("--i", help="Input image")
-    parser.add_argument("--o", help="Output (deformed) image")
+    parser.add_argument("--i", nargs='+', help="Input image(s)")
+    parser.add_argument("--o", nargs='+', help="Output (deformed) image(s), one per input")
+    parser.add_argument("--list", help="(optional) Text file with one input per line: input output [nearest]")
     parser.add_argument("--field", help="Deformation field")
-    parser.add_argument("--nearest", action="store_true", help="(optional) Use nearest neighbor (rather than linear) interpolation")
+    parser.add_argument("--nearest", nargs='*', help="(optional) Use nearest neighbor (rather than linear) interpolation; for all inputs, or only for the inputs listed after the flag")
     parser.add_argument("--threads", type=int, default=1, help="(optional) Number of cores to be used. Default is 1. You can use -1 to use all available cores")
+    parser.add_argument("--tile_size", type=int, default=None, help="(optional) Warp the output grid in slabs of this many voxels along the last (slowest-varying on disk) axis, so that only one slab of the field is in memory at a time")
+    parser.add_argument("--max_mem", type=float, default=None, help="(optional) Memory budget in GB; sets the slab size (see --tile_size) accordingly")
 
     # parse commandline
     args = parser.parse_args()
 
     #############
 
-    if args.i is None:
-        sf.system.fatal('Input image must be provided')
-    if args.o is None:
-        sf.system.fatal('Output (deformed) image must be provided')
+    jobs = get_jobs(args)
     if args.field is None:
         sf.system.fatal('Deformation field must be provided')
 
@@ -41,29 +41,24 @@ def main():
     torch.set_num_threads(args.threads)
 
     print('Reading deformation field')
-    field_buffer, field_aff, field_h = load_volume(args.field, im_only=False, squeeze=True, dtype=None)
-    if len(field_buffer.shape) !=4:
+    field_proxy, field_aff, field_h = load_volume_proxy(args.field)
+    field_shape = [d for d in field_proxy.shape if d != 1]
+    if len(field_shape) !=4:
         sf.system.fatal('field must be 4D array')
-    if field_buffer.shape[3] != 3:
+    if field_shape[3] != 3:
         sf.system.fatal('field must have 3 frames')
 
-    print('Reading input image')
-    input_buffer, input_aff, input_h = load_volume(args.i, im_only=False, squeeze=True, dtype=None)
-
-    print('Deforming (interpolating)')
-    affine = torch.tensor(np.linalg.inv(input_aff), device='cpu')
-    field_buffer = torch.tensor(field_buffer, device='cpu')
-    II = affine[0, 0] * field_buffer[:,:,:,0]  + affine[0, 1] * field_buffer[:,:,:,1]  + affine[0, 2] * field_buffer[:,:,:,2]  + affine[0, 3]
-    JJ = affine[1, 0] * field_buffer[:,:,:,0]  + affine[1, 1] * field_buffer[:,:,:,1]  + affine[1, 2] * field_buffer[:,:,:,2]  + affine[1, 3]
-    KK = affine[2, 0] * field_buffer[:,:,:,0]  + affine[2, 1] * field_buffer[:,:,:,1]  + affine[2, 2] * field_buffer[:,:,:,2]  + affine[2, 3]
+    # inputs on the same grid (affine and shape) share the voxel coordinates, which are computed once for all of them
+    groups = {}
+    for input_path, output_path, nearest in jobs:
+        input_proxy, input_aff, _ = load_volume_proxy(input_path)
+        key = (input_aff.tobytes(), tuple(d for d in input_proxy.shape if d != 1)[:3])
+        groups.setdefault(key, []).append((input_path, output_path, nearest))
 
-    if args.nearest:
-        Y = fast_3D_interp_torch(torch.tensor(input_buffer, device='cpu', requires_grad=False), II, JJ, KK, 'nearest')
-    else:
-        Y = fast_3D_interp_torch(torch.tensor(input_buffer, device='cpu', requires_grad=False), II, JJ, KK, 'linear')
-
-    print('Saving to disk')
-    save_volume(Y.numpy(), field_aff, field_h, args.o)
+    # when the field is not tiled, it is only decoded once, for all the groups
+    field_cache = {}
+    for group in groups.values():
+        warp_group(group, field_proxy, field_shape, field_aff, field_h, args.tile_size, args.max_mem, field_cache)
 
     print('All done!')
 
@@ -73,28 +68,125 @@ def main():
 # Auxiliary functions #
 #######################
 
+def get_jobs(args):
+    # (input, output, nearest) for every input given with --i / --o and in the --list file
+
+    inputs = [] if args.i is None else args.i
+    outputs = [] if args.o is None else args.o
+    if len(inputs) != len(outputs):
+        sf.system.fatal('Please provide one output (deformed) image per input image')
+    if args.nearest is None:
+        jobs = [(i, o, False) for i, o in zip(inputs, outputs)]
+    else:
+        for path in args.nearest:
+            if path not in inputs:
+                sf.system.fatal('%s was given to --nearest but is not an input image' % path)
+        jobs = [(i, o, (len(args.nearest) == 0) or (i in args.nearest)) for i, o in zip(inputs, outputs)]
+
+    if args.list is not None:
+        with open(args.list) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) == 0:
+                    continue
+                if (len(fields) not in [2, 3]) or (len(fields) == 3 and fields[2] != 'nearest'):
+                    sf.system.fatal('Lines of %s must read: input output [nearest]' % args.list)
+                jobs.append((fields[0], fields[1], (len(fields) == 3) or (args.nearest is not None and len(args.nearest) == 0)))
+
+    if len(jobs) == 0:
+        sf.system.fatal('Input image must be provided')
+
+    return jobs
+
+
+def warp_group(jobs, field_proxy, field_shape, field_aff, field_h, tile_size, max_mem, field_cache):
+    # warps inputs that are all on the same grid: the field is read and the voxel coordinates are computed once per
+    # slab, and used for all of them
+
+    inputs = []
+    for input_path, _, _ in jobs:
+        print('Reading input image %s' % input_path)
+        input_buffer, input_aff, input_h = load_volume(input_path, im_only=False, squeeze=True, dtype=None)
+        inputs.append(torch.as_tensor(input_buffer, device='cpu'))
+        del input_buffer
+
+    # the output grid is walked in slabs along the last axis (a single slab unless --tile_size / --max_mem): NIfTI and
+    # MGZ store volumes in Fortran order, so a slab of the field is then a contiguous run of each frame on disk
+    outputs = [np.zeros([*field_shape[:3], *X.shape[3:]], dtype=np.float32) for X in inputs]
+    if tile_size is None and max_mem is not None:
+        fixed = sum(X.numpy().nbytes + Y.nbytes for X, Y in zip(inputs, outputs))
+        tile_size = get_tile_size(max_mem * 1e9 - fixed, field_shape, sum(Y[0, 0, 0].size for Y in outputs))
+    elif tile_size is None:
+        tile_size = field_shape[2]
+    tile_size = max(1, min(tile_size, field_shape[2]))
+    if tile_size < field_shape[2]:
+        print('Deforming (interpolating) in slabs of %d voxels' % tile_size)
+    else:
+        print('Deforming (interpolating)')
+
+    affine = torch.tensor(np.linalg.inv(input_aff), device='cpu')
+    for start in range(0, field_shape[2], tile_size):
+        stop = min(start + tile_size, field_shape[2])
+        if (start, stop) in field_cache:
+            field_buffer = field_cache[(start, stop)]
+        else:
+            field_buffer = native_array(field_proxy[:, :, start:stop]).reshape([*field_shape[:2], stop - start, 3])
+            field_buffer = torch.as_tensor(field_buffer, device='cpu')
+            if stop - start == field_shape[2]:
+                field_cache[(start, stop)] = field_buffer
+        II = affine[0, 0] * field_buffer[:,:,:,0]  + affine[0, 1] * field_buffer[:,:,:,1]  + affine[0, 2] * field_buffer[:,:,:,2]  + affine[0, 3]
+        JJ = affine[1, 0] * field_buffer[:,:,:,0]  + affine[1, 1] * field_buffer[:,:,:,1]  + affine[1, 2] * field_buffer[:,:,:,2]  + affine[1, 3]
+        KK = affine[2, 0] * field_buffer[:,:,:,0]  + affine[2, 1] * field_buffer[:,:,:,1]  + affine[2, 2] * field_buffer[:,:,:,2]  + affine[2, 3]
+        del field_buffer
+
+        for X, Y, (_, _, nearest) in zip(inputs, outputs, jobs):
+            Y[:, :, start:stop] = fast_3D_interp_torch(X, II, JJ, KK, 'nearest' if nearest else 'linear').numpy()
+        del II, JJ, KK
+
+    for Y, (_, output_path, _) in zip(outputs, jobs):
+        print('Saving %s to disk' % output_path)
+        save_volume(Y, field_aff, field_h, output_path)
+
+def native_array(data):
+    # array (or array proxy) in its on-disk data type, in native byte order, and with unsigned types that torch cannot
+    # do arithmetic with (uint16, uint32) widened to signed ones. No copy is made when none of these apply
+
+    volume = np.asanyarray(data)
+    if not volume.dtype.isnative:
+        volume = volume.astype(volume.dtype.newbyteorder('='))
+    if volume.dtype == np.uint16:
+        volume = volume.astype(np.int32)
+    elif volume.dtype == np.uint32:
+        volume = volume.astype(np.int64)
+
+    return volume
+
+
 def load_volume(path_volume, im_only=True, squeeze=True, dtype=None):
 
     assert path_volume.endswith(('.nii', '.nii.gz', '.mgz', '.npz')), 'Unknown data file: %s' % path_volume
 
+    # with dtype=None, the data is returned in its on-disk type (see native_array); uncompressed files are memory-mapped
     if path_volume.endswith(('.nii', '.nii.gz', '.mgz')):
-        x = nib.load(path_volume)
-        if squeeze:
-            volume = np.squeeze(x.get_fdata())
+        x = nib.load(path_volume, mmap='c')
+        if (dtype is not None) and ('float' in dtype):
+            volume = x.get_fdata(dtype=dtype)
         else:
-            volume = x.get_fdata()
+            volume = native_array(x.dataobj)
+        if squeeze:
+            volume = np.squeeze(volume)
         aff = x.affine
         header = x.header
     else:  # npz
-        volume = np.load(path_volume)['vol_data']
+        volume = native_array(np.load(path_volume)['vol_data'])
         if squeeze:
             volume = np.squeeze(volume)
         aff = np.eye(4)
         header = nib.Nifti1Header()
     if dtype is not None:
-        if 'int' in dtype:
+        if ('int' in dtype) and (not np.issubdtype(volume.dtype, np.integer)):
             volume = np.round(volume)
-        volume = volume.astype(dtype=dtype)
+        volume = volume.astype(dtype=dtype, copy=False)
 
     if im_only:
         return volume
@@ -102,6 +194,33 @@ def load_volume(path_volume, im_only=True, squeeze=True, dtype=None):
         return volume, aff, header
 
 
+def load_volume_proxy(path_volume):
+    # like load_volume, but returns an array proxy: the data is only read from disk when (slices of) it are accessed
+
+    assert path_volume.endswith(('.nii', '.nii.gz', '.mgz', '.npz')), 'Unknown data file: %s' % path_volume
+
+    if path_volume.endswith(('.nii', '.nii.gz', '.mgz')):
+        x = nib.load(path_volume)
+        return x.dataobj, x.affine, x.header
+    else:  # npz
+        return np.load(path_volume)['vol_data'], np.eye(4), nib.Nifti1Header()
+
+
+def get_tile_size(budget, field_shape, channels):
+    # number of slabs (along the last axis) of the output grid that fit in the memory budget (in bytes): one slab
+    # needs the field (in its on-disk type, at most float64), the three coordinate volumes, a couple of temporaries
+    # and the float32 interpolated values. The kernels work on chunks of voxels of bounded size, which we leave some
+    # room for
+
+    bytes_per_voxel = 3 * 8 + 3 * 8 + 2 * 8 + 4 * channels
+    budget = budget - 2 ** 18 * 256
+    tile_size = int(budget // (bytes_per_voxel * field_shape[0] * field_shape[1]))
+    if tile_size < 1:
+        print('Warning: the input and output volumes alone exceed the memory budget; using slabs of 1 voxel')
+
+    return tile_size
+
+
 def save_volume(volume, aff, header, path):
     mkdir(os.path.dirname(path))
     if '.npz' in path:
@@ -140,84 +259,107 @@ def fast_3D_interp_torch(X, II, JJ, KK, mode):
         JJr = torch.round(JJ[ok]).long()
         KKr = torch.round(KK[ok]).long()
 
+        # all the channels are gathered together from the memory of X (in any dense layout, see flat_view)
+        nc = X.shape[3] if len(X.shape) == 4 else 1
+        Xf, strides = flat_view(X if len(X.shape) == 4 else X[..., None])
+        c = Xf[(IIr * strides[0] + JJr * strides[1] + KKr * strides[2])[:, None] + torch.arange(nc) * strides[3]]
+        Y = torch.zeros([*II.shape, nc], device='cpu')
+        Y[ok] = c.float()
         if len(X.shape) == 3:
-            c = X[IIr, JJr, KKr]
-            Y = torch.zeros(II.shape, device='cpu')
-            Y[ok] = c.float()
-        elif len(X.shape) == 4:
-            Y = torch.zeros([*II.shape, X.shape[3]], device='cpu')
-            for channel in range(X.shape[3]):
-                Xc = X[:, :, :, channel]
-                c = Xc[IIr, JJr, KKr]
-                Yc = torch.zeros(II.shape, device='cpu')
-                Yc[ok] = c.float()
-                Y[:, :, :, channel] = Yc
-        
-    elif mode=='linear':
-        ok = (II>0) & (JJ>0) & (KK>0) & (II<=X.shape[0]-1) & (JJ<=X.shape[1]-1) & (KK<=X.shape[2]-1)
-        IIv = II[ok]
-        JJv = JJ[ok]
-        KKv = KK[ok]
-
-        fx = torch.floor(IIv).long()
-        cx = fx + 1
-        cx[cx > (X.shape[0] - 1)] = (X.shape[0] - 1)
-        wcx = IIv - fx
-        wfx = 1 - wcx
-
-        fy = torch.floor(JJv).long()
-        cy = fy + 1
-        cy[cy > (X.shape[1] - 1)] = (X.shape[1] - 1)
-        wcy = JJv - fy
-        wfy = 1 - wcy
+            Y = Y[..., 0]
 
-        fz = torch.floor(KKv).long()
-        cz = fz + 1
-        cz[cz > (X.shape[2] - 1)] = (X.shape[2] - 1)
-        wcz = KKv - fz
-        wfz = 1 - wcz
-
-        if len(X.shape) == 3:
-            X = X[..., None]
-
-        Y = torch.zeros([*II.shape, X.shape[3]], device='cpu')
-        for channel in range(X.shape[3]):
-            Xc = X[:, :, :, channel]
+    elif mode=='linear':
+        Y = fast_3D_interp_linear_torch(X, II, JJ, KK)
 
-            c000 = Xc[fx, fy, fz]
-            c100 = Xc[cx, fy, fz]
-            c010 = Xc[fx, cy, fz]
-            c110 = Xc[cx, cy, fz]
-            c001 = Xc[fx, fy, cz]
-            c101 = Xc[cx, fy, cz]
-            c011 = Xc[fx, cy, cz]
-            c111 = Xc[cx, cy, cz]
+    else:
+        sf.system.fatal('mode must be linear or nearest')
 
-            c00 = c000 * wfx + c100 * wcx
-            c01 = c001 * wfx + c101 * wcx
-            c10 = c010 * wfx + c110 * wcx
-            c11 = c011 * wfx + c111 * wcx
+    return Y
 
-            c0 = c00 * wfy + c10 * wcy
-            c1 = c01 * wfy + c11 * wcy
 
-            c = c0 * wfz + c1 * wcz
+def flat_view(X):
+    # 1D view of the memory of a (dense) tensor, whatever its layout (e.g., Fortran-ordered arrays from nibabel), and the
+    # strides to index it with. Tensors that are not dense (e.g., strided slices) are copied first
+
+    expected = 1
+    for d in sorted(range(X.dim()), key=lambda d: X.stride(d)):
+        if X.shape[d] > 1 and X.stride(d) != expected:
+            X = X.contiguous()
+            break
+        expected *= X.shape[d]
+
+    return X.as_strided([X.numel()], [1]), X.stride()
+
+
+def fast_3D_interp_linear_torch(X, II, JJ, KK, chunk_size=2 ** 18):
+    # Trilinear interpolation of a 3D volume, or of a 4D volume with the channels last. The flat indices and weights
+    # of the 8 neighbours are computed once per voxel and all the channels are gathered together from the memory of
+    # X (in any dense layout, see flat_view), one chunk of voxels at a time, straight into the (float32) output.
+    # Voxels sampled outside the volume are set to zero
+
+    nx, ny, nz = X.shape[:3]
+    nc = X.shape[3] if len(X.shape) == 4 else 1
+    Xf, strides = flat_view(X if len(X.shape) == 4 else X[..., None])
+    channels = torch.arange(nc) * strides[3]
+    IIf = II.reshape(-1)
+    JJf = JJ.reshape(-1)
+    KKf = KK.reshape(-1)
+    Y = torch.empty([IIf.shape[0], nc], dtype=torch.float32, device='cpu')
+
+    for start in range(0, IIf.shape[0], chunk_size):
+        IIv = IIf[start:start + chunk_size]
+        JJv = JJf[start:start + chunk_size]
+        KKv = KKf[start:start + chunk_size]
+        ok = (IIv > 0) & (JJv > 0) & (KKv > 0) & (IIv <= nx - 1) & (JJv <= ny - 1) & (KKv <= nz - 1)
+
+        # outside voxels are clamped to valid indices for the gather, and zeroed at the end
+        fx = torch.floor(IIv).long().clamp_(0, nx - 1)
+        cx = (fx + 1).clamp_(max=nx - 1)
+        wcx = (IIv - fx)[:, None]
+        wfx = 1 - wcx
 
-            Yc = torch.zeros(II.shape, device='cpu')
-            Yc[ok] = c.float()
-            Y[:, :, :, channel] = Yc
+        fy = torch.floor(JJv).long().clamp_(0, ny - 1)
+        cy = (fy + 1).clamp_(max=ny - 1)
+        wcy = (JJv - fy)[:, None]
+        wfy = 1 - wcy
 
-        if Y.shape[3] == 1:
-            Y = Y[:, :, :, 0]
+        fz = torch.floor(KKv).long().clamp_(0, nz - 1)
+        cz = (fz + 1).clamp_(max=nz - 1)
+        wcz = (KKv - fz)[:, None]
+        wfz = 1 - wcz
 
-    else:
-        sf.system.fatal('mode must be linear or nearest')
+        fx *= strides[0]
+        cx *= strides[0]
+        fy *= strides[1]
+        cy *= strides[1]
+        fz *= strides[2]
+        cz *= strides[2]
+        fxfy = (fx + fy)[:, None] + channels
+        cxfy = (cx + fy)[:, None] + channels
+        fxcy = (fx + cy)[:, None] + channels
+        cxcy = (cx + cy)[:, None] + channels
+        fz = fz[:, None]
+        cz = cz[:, None]
+
+        c00 = Xf[fxfy + fz] * wfx + Xf[cxfy + fz] * wcx
+        c01 = Xf[fxfy + cz] * wfx + Xf[cxfy + cz] * wcx
+        c10 = Xf[fxcy + fz] * wfx + Xf[cxcy + fz] * wcx
+        c11 = Xf[fxcy + cz] * wfx + Xf[cxcy + cz] * wcx
+
+        c0 = c00 * wfy + c10 * wcy
+        c1 = c01 * wfy + c11 * wcy
+
+        c = c0 * wfz + c1 * wcz
+        c.masked_fill_(~ok[:, None], 0)
+        Y[start:start + chunk_size] = c
+
+    Y = Y.reshape(*II.shape, nc)
+    if len(X.shape) == 3:
+        Y = Y[..., 0]
 
     return Y
 
 
-
-
 # execute script
 if __name__ == '__main__':
     main()
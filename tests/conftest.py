@@ -0,0 +1,24 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# the scripts are not a package: make them importable as modules (mri_easyreg_new, mri_easywarp2, ...)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def fs_home(tmp_path):
+    # $FREESURFER_HOME with just the label lists read by EasyRegContext (the networks are never built in the tests)
+    models = tmp_path / 'fs' / 'models'
+    models.mkdir(parents=True)
+    np.save(models / 'synthseg_segmentation_labels_2.0.npy', np.array([0, 2, 3, 4, 41, 42, 43]))
+    np.save(models / 'synthseg_parcellation_labels.npy', np.array([0, 1001, 1002, 2001, 2002]))
+    return str(tmp_path / 'fs')
+
+
+@pytest.fixture
+def context(fs_home):
+    import mri_easyreg_new as easyreg
+    return easyreg.EasyRegContext(fs_home)
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+import mri_easyreg_new as easyreg
+
+
+def loop_centroids(seg, labels, min_voxels=50):
+    # the loop that get_label_centroids replaced (np.where and np.median per label)
+    nlab = len(labels)
+    COG = np.zeros([4, nlab])
+    ok = np.ones(nlab)
+    for l in range(nlab):
+        aux = np.where(seg == labels[l])
+        if len(aux[0]) > min_voxels:
+            COG[0, l] = np.median(aux[0])
+            COG[1, l] = np.median(aux[1])
+            COG[2, l] = np.median(aux[2])
+            COG[3, l] = 1
+        else:
+            ok[l] = 0
+    return COG, ok
+
+
+def synthetic_segmentation(seed):
+    rng = np.random.default_rng(seed)
+    shape = (37, 41, 29)
+    seg = rng.choice([0, 2, 3, 4, 17, 41, 42, 1001, 2035, 77], size=shape, p=[.4, .1, .1, .1, .05, .1, .05, .05, .04, .01])
+    # labels of exactly 50 and 51 voxels (on both sides of the threshold), and single voxels
+    seg[seg == 10] = 0
+    seg.ravel()[rng.choice(seg.size, 50, replace=False)] = 10
+    seg.ravel()[np.flatnonzero(seg.ravel() != 10)[rng.choice(seg.size - 50, 51, replace=False)]] = 11
+    seg[0, 0, 0] = 12
+    seg[-1, -1, -1] = 13
+    seg[5, 6, 7] = -3  # negative values are not labels
+    return seg
+
+
+# 99 is in no segmentation, 77 is not in the label list
+LABELS = np.array([2, 3, 4, 17, 41, 42, 1001, 2035, 10, 11, 12, 13, 99])
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('min_voxels', [50, 0])
+def test_centroids_match_loop(seed, min_voxels):
+    seg = synthetic_segmentation(seed)
+    COG, ok = easyreg.get_label_centroids(seg, LABELS, min_voxels=min_voxels)
+    COG_loop, ok_loop = loop_centroids(seg, LABELS, min_voxels=min_voxels)
+
+    np.testing.assert_array_equal(ok, ok_loop)
+    np.testing.assert_array_equal(COG, COG_loop)
+    assert ok[list(LABELS).index(99)] == 0
+    assert ok[list(LABELS).index(10)] == (0 if min_voxels == 50 else 1) and ok[list(LABELS).index(11)] == 1
+    if min_voxels == 0:  # single voxels are their own centroid
+        np.testing.assert_array_equal(COG[:, list(LABELS).index(12)], [0, 0, 0, 1])
+        np.testing.assert_array_equal(COG[:, list(LABELS).index(13)], [36, 40, 28, 1])
+
+
+def test_centroids_of_atlas_labels():
+    # the labels actually used by the affine stage, on a segmentation where some of them are missing
+    rng = np.random.default_rng(3)
+    labels = easyreg.ATLAS_LABELS
+    seg = rng.choice(np.concatenate([[0], labels[::2]]), size=(48, 52, 44)).astype('int32')
+    COG, ok = easyreg.get_label_centroids(seg, labels)
+    COG_loop, ok_loop = loop_centroids(seg, labels)
+    np.testing.assert_array_equal(ok, ok_loop)
+    np.testing.assert_array_equal(COG, COG_loop)
@@ -0,0 +1,62 @@
+import nibabel as nib
+import numpy as np
+import pytest
+
+import mri_easywarp2 as easywarp
+
+
+def write_inputs(tmp_path):
+    rng = np.random.default_rng(0)
+    aff = np.diag([1.1, 0.9, 1.3, 1])
+    image = rng.random((19, 23, 17)).astype('float32')
+    labels = rng.integers(0, 5, (19, 23, 17)).astype('int32')
+    nib.save(nib.Nifti1Image(image, aff), str(tmp_path / 'image.nii.gz'))
+    nib.save(nib.Nifti1Image(labels, aff), str(tmp_path / 'labels.nii.gz'))
+
+    # field (in RAS) on a different grid, stored 5-D (x, y, z, 1, 3) as from mri_easyreg
+    field_aff = np.diag([1.0, 1.0, 1.0, 1])
+    field_aff[:3, 3] = [0.5, -0.5, 1.0]
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in (21, 18, 20)], indexing='ij'), axis=-1)
+    field = grid @ field_aff[:3, :3].T + field_aff[:3, 3] + rng.normal(0, 0.7, (*grid.shape[:3], 3))
+    nib.save(nib.Nifti1Image(field[:, :, :, np.newaxis, :].astype('float32'), field_aff), str(tmp_path / 'field.nii'))
+
+    return [(str(tmp_path / 'image.nii.gz'), str(tmp_path / 'out_image.nii.gz'), False),
+            (str(tmp_path / 'labels.nii.gz'), str(tmp_path / 'out_labels.nii.gz'), True)]
+
+
+def warp(tmp_path, jobs, tile_size):
+    field_proxy, field_aff, field_h = easywarp.load_volume_proxy(str(tmp_path / 'field.nii'))
+    field_shape = [d for d in field_proxy.shape if d != 1]
+    easywarp.warp_group(jobs, field_proxy, field_shape, field_aff, field_h, tile_size, None, {})
+    return [nib.load(output).get_fdata() for _, output, _ in jobs]
+
+
+@pytest.mark.parametrize('tile_size', [1, 6, 7])
+def test_slabs_match_whole_volume(tmp_path, tile_size):
+    jobs = write_inputs(tmp_path)
+    whole = warp(tmp_path, jobs, None)
+    slabs = warp(tmp_path, jobs, tile_size)
+
+    for expected, result in zip(whole, slabs):
+        assert result.shape == (21, 18, 20)
+        np.testing.assert_array_equal(result, expected)
+    assert len(np.unique(whole[1])) > 1
+
+
+def test_slabs_are_along_the_last_axis(tmp_path):
+    jobs = write_inputs(tmp_path)
+    field_proxy, field_aff, field_h = easywarp.load_volume_proxy(str(tmp_path / 'field.nii'))
+    reads = []
+
+    class RecordingProxy:
+        shape = field_proxy.shape
+
+        def __getitem__(self, index):
+            reads.append(index)
+            return field_proxy[index]
+
+    field_shape = [d for d in field_proxy.shape if d != 1]
+    easywarp.warp_group(jobs, RecordingProxy(), field_shape, field_aff, field_h, 8, None, {})
+
+    assert reads == [(slice(None), slice(None), slice(0, 8)), (slice(None), slice(None), slice(8, 16)),
+                     (slice(None), slice(None), slice(16, 20))]
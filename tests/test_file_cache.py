@@ -0,0 +1,84 @@
+import argparse
+import os
+import time
+
+import mri_easyreg_new as easyreg
+
+
+def write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def cache_context(fs_home, tmp_path, monkeypatch):
+    context = easyreg.EasyRegContext(fs_home, seg_cache_dir=str(tmp_path / 'cache'), seg_cache_gb=1)
+    monkeypatch.setattr(context, 'segmentation_key', lambda path_image, args: 'ab' * 32)
+    return context
+
+
+def test_entries_do_not_share_data_with_user_files(fs_home, tmp_path, monkeypatch):
+    context = cache_context(fs_home, tmp_path, monkeypatch)
+    subject = {'args': argparse.Namespace()}
+    output = str(tmp_path / 'out' / 'seg.nii.gz')
+    write(output, b'segmentation')
+    context.seg_cache.put('ab' * 32, '.nii.gz', output)
+
+    # a hit materializes a copy at the output path of the next subject
+    other_output = str(tmp_path / 'out2' / 'seg.nii.gz')
+    easyreg.fetch_cached_segmentation(context, subject, 'image.nii.gz', other_output)
+    assert read(other_output) == b'segmentation'
+    assert subject['cache'] == {'segmentation': [1, 0]}
+
+    # marking the entry as used does not touch the user files, and editing them does not touch the entry
+    for path in [output, other_output]:
+        os.utime(path, (5, 5))
+    context.seg_cache.get('ab' * 32, '.nii.gz')
+    assert [os.stat(path).st_mtime for path in [output, other_output]] == [5, 5]
+    for path in [output, other_output]:
+        assert not os.path.samefile(path, context.seg_cache.path('ab' * 32, '.nii.gz'))
+        write(path, b'edited by the user')
+    assert read(context.seg_cache.path('ab' * 32, '.nii.gz')) == b'segmentation'
+
+
+def test_entry_evicted_before_the_copy_is_a_miss(fs_home, tmp_path, monkeypatch):
+    context = cache_context(fs_home, tmp_path, monkeypatch)
+    subject = {'args': argparse.Namespace()}
+    # the entry is found, but evicted (by another process) before it is copied
+    monkeypatch.setattr(context.seg_cache, 'get', lambda key, suffix: str(tmp_path / 'cache' / 'gone.nii.gz'))
+    output = str(tmp_path / 'out' / 'seg.nii.gz')
+
+    easyreg.fetch_cached_segmentation(context, subject, 'image.nii.gz', output)
+
+    assert subject['cache'] == {'segmentation': [0, 1]}
+    assert not os.path.exists(output)
+    assert os.listdir(str(tmp_path / 'out')) == []
+
+
+def test_eviction_only_scans_over_the_limit(tmp_path, monkeypatch):
+    directory = str(tmp_path / 'cache')
+    write(os.path.join(directory, 'aa', 'old'), b'x' * 300)
+    os.utime(os.path.join(directory, 'aa', 'old'), (1, 1))
+    cache = easyreg.FileCache(directory, 1000)
+    assert cache.total_bytes == 300
+
+    scans = []
+    entries = cache.entries
+    monkeypatch.setattr(cache, 'entries', lambda: scans.append(1) or entries())
+    now = time.time()
+    for i, key in enumerate(['bb1', 'cc2']):
+        cache.write(key, '.bin', lambda f: f.write(b'y' * 300))
+        os.utime(cache.path(key, '.bin'), (now + i, now + i))
+    assert scans == [] and cache.total_bytes == 900
+
+    # going over the limit evicts the least recently used entries, down to the limit
+    cache.write('dd3', '.bin', lambda f: f.write(b'z' * 300))
+    assert len(scans) == 1
+    assert not os.path.exists(os.path.join(directory, 'aa', 'old'))
+    assert all(os.path.exists(cache.path(key, '.bin')) for key in ['bb1', 'cc2', 'dd3'])
+    assert cache.total_bytes == 900
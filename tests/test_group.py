@@ -0,0 +1,84 @@
+import argparse
+import os
+
+import numpy as np
+import pytest
+import torch
+
+import mri_easyreg_new as easyreg
+
+
+def write_list(path, lines):
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+    return str(path)
+
+
+def test_read_group_lists_lists_every_pair_once(tmp_path):
+    images = write_list(tmp_path / 'images.txt', ['a.nii.gz', 'b.nii.gz', 'a.nii.gz', './b.nii.gz', 'b.nii.gz'])
+    segs = write_list(tmp_path / 'segs.txt', ['a.seg.nii.gz', 'b.seg.nii.gz', 'a.seg.nii.gz', 'b.seg.nii.gz', 'c.seg.nii.gz'])
+
+    assert easyreg.read_group_lists(images, segs) == (['a.nii.gz', 'b.nii.gz', 'b.nii.gz'],
+                                                      ['a.seg.nii.gz', 'b.seg.nii.gz', 'c.seg.nii.gz'])
+
+
+def test_read_group_lists_needs_the_segmentations(tmp_path, capsys):
+    images = write_list(tmp_path / 'images.txt', ['a.nii.gz'])
+    with pytest.raises(SystemExit):
+        easyreg.read_group_lists(images, None)
+    assert '--group_images requires --group_segs' in capsys.readouterr().out
+
+
+def test_build_group_registers_duplicates_once(fs_home, tmp_path, monkeypatch):
+    context = easyreg.EasyRegContext(fs_home, group_dir=str(tmp_path / 'group'))
+    context.atlas_volsize = [4, 5, 6]
+    # the images are read, aligned and keyed by their contents: b and b_copy are the same image
+    contents = {'a': 1.0, 'b': 3.0, 'b_copy': 3.0}
+    monkeypatch.setattr(easyreg, 'load_volume', lambda path, **kwargs: (np.zeros((2, 2, 2)), np.eye(4), None))
+    monkeypatch.setattr(easyreg, 'reference_alignment', lambda subject, context: (
+        np.eye(4), torch.full(context.atlas_volsize, contents[subject['args'].ref])))
+    monkeypatch.setattr(context, 'group_key', lambda image, seg, args: 'key%g' % contents[image])
+    registered = []
+
+    def register_to_template(subjects, template, template_id, context):
+        for subject in subjects:
+            registered.append(subject['args'].ref)
+            context.group.write(subject['key'], template=np.array(template_id), M=np.eye(4))
+
+    monkeypatch.setattr(easyreg, 'register_to_template', register_to_template)
+    all_args = [argparse.Namespace(ref=image, ref_seg=image + '.seg', flo=None, precision='float32')
+                for image in ['a', 'b', 'b_copy']]
+
+    results = easyreg.build_group(all_args, context, reg_batch=2)
+
+    assert [r['ok'] for r in results] == [True, True, True]
+    assert registered == ['a', 'b']
+    with np.load(context.group.path('template')) as template:
+        np.testing.assert_array_equal(template['template'], 2.0)  # the mean of a and b, each counted once
+    assert sorted(os.listdir(context.group.directory)) == ['key1.npz', 'key3.npz', 'template.npz']
+    assert context.group.find('key3') is not None
+
+
+def test_compose_fields():
+    shape = (6, 7, 8)
+    first = torch.zeros(*shape, 3, dtype=torch.float64)
+    first[..., 0] = 1  # one voxel along the first axis
+    second = torch.zeros(*shape, 3, dtype=torch.float64)
+    second[..., 1] = 2
+    second[..., 2] = torch.arange(shape[0], dtype=torch.float64)[:, None, None] / 10
+
+    composed = easyreg.compose_fields(first, second)
+
+    # inside, the displacement of second is taken at x + first(x); outside (or on the first voxel of an axis, see
+    # InterpPlan), it is zero
+    inside = composed[:-1, 1:, 1:]
+    np.testing.assert_allclose(inside[..., 0], 1)
+    np.testing.assert_allclose(inside[..., 1], 2)
+    np.testing.assert_allclose(inside[..., 2], (np.arange(1, shape[0])[:, None, None] / 10) * np.ones((6, 7)))
+    np.testing.assert_allclose(composed[-1], first[-1])
+
+
+def test_group_directory_can_be_relative(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    group = easyreg.RegistrationGroup('group')
+    assert os.path.isdir(tmp_path / 'group') and group.template_id is None
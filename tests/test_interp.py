@@ -0,0 +1,53 @@
+import numpy as np
+import pytest
+import torch
+
+import mri_easyreg_new as easyreg
+
+
+def coordinates(shape, out_shape, seed):
+    # random voxel coordinates, some outside the volume, some on exact .5 ties and on the borders
+    rng = np.random.default_rng(seed)
+    II, JJ, KK = [torch.as_tensor(rng.uniform(-2, n + 1, out_shape)) for n in shape]
+    II[0, 0, :5] = torch.tensor([0.5, 1.5, 0, shape[0] - 1, 2.5], dtype=II.dtype)
+    return II, JJ, KK
+
+
+@pytest.mark.parametrize('channels', [None, 3])
+@pytest.mark.parametrize('mode', ['linear', 'nearest'])
+def test_one_off_interpolation_matches_plan(channels, mode):
+    shape = (13, 11, 9)
+    rng = np.random.default_rng(0)
+    X = rng.random(shape if channels is None else (*shape, channels))
+    X = torch.as_tensor(np.asfortranarray(X))  # as from nibabel
+    II, JJ, KK = coordinates(shape, (7, 8, 10), 1)
+
+    plan = easyreg.InterpPlan(II, JJ, KK, shape, chunk_size=100)
+    lazy = easyreg.InterpPlan(II, JJ, KK, shape, chunk_size=100, precompute=False)
+    expected = plan.interpolate(X, mode)
+
+    assert torch.equal(lazy.interpolate(X, mode), expected)
+    assert torch.equal(easyreg.fast_3D_interp_torch(X, II, JJ, KK, mode), expected)
+    if mode == 'linear':
+        assert torch.equal(easyreg.fast_3D_interp_field_torch(X, II, JJ, KK), expected)
+
+
+def test_one_off_interpolation_stores_no_plan():
+    shape = (13, 11, 9)
+    II, JJ, KK = coordinates(shape, (7, 8, 10), 2)
+
+    lazy = easyreg.InterpPlan(II, JJ, KK, shape, precompute=False)
+    assert lazy.floors is None and lazy.weights is None and lazy.ok is None
+
+    plan = easyreg.InterpPlan(II, JJ, KK, shape)
+    assert plan.coordinates is None and plan.ok.shape == (II.numel(),)
+
+
+def test_nearest_matches_rounding():
+    # the torch.round path that the plans replaced: round half to even, clamp to the borders
+    shape = (13, 11, 9)
+    X = torch.as_tensor(np.random.default_rng(3).integers(0, 50, shape))
+    II, JJ, KK = coordinates(shape, (7, 8, 10), 4)
+
+    index = [torch.round(C).long().clamp_(0, n - 1) for C, n in zip([II, JJ, KK], shape)]
+    assert torch.equal(easyreg.fast_3D_interp_torch(X, II, JJ, KK, 'nearest'), X[index[0], index[1], index[2]])
@@ -0,0 +1,47 @@
+import argparse
+import threading
+
+import mri_easyreg_new as easyreg
+
+
+class StubContext:
+    # the only part of EasyRegContext that run_batch_pipeline uses itself
+
+    def release_reference(self, subject):
+        pass
+
+
+def run_with_timeout(fn, timeout=60):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault('value', fn()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'pipeline did not finish (deadlock?)'
+    return result['value']
+
+
+def test_pipeline_cnn_threads_fill_batches(monkeypatch):
+    # 2 cnn threads with batches of 4 need more than max_in_flight=4 subjects to make progress
+    batches = []
+    lock = threading.Lock()
+
+    def noop_stage(subject, context):
+        pass
+
+    def cnn_stage(subjects, context):
+        with lock:
+            batches.append(len(subjects))
+
+    stages = [(name, cnn_stage if name == 'cnn' else noop_stage) for name, _ in easyreg.PIPELINE_STAGES]
+    monkeypatch.setattr(easyreg, 'PIPELINE_STAGES', stages)
+    all_args = [argparse.Namespace(ref='ref%d' % i, flo='flo%d' % i) for i in range(10)]
+    stage_threads = {name: 1 for name, _ in stages}
+    stage_threads['cnn'] = 2
+
+    results = run_with_timeout(lambda: easyreg.run_batch_pipeline(all_args, StubContext(), stage_threads,
+                                                                  max_in_flight=4, reg_batch=4))
+
+    assert [r['index'] for r in results] == list(range(10))
+    assert all(r['ok'] for r in results)
+    assert sum(batches) == 10
+    assert max(batches) <= 4
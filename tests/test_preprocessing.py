@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+import torch
+from scipy.ndimage import gaussian_filter1d
+
+import mri_easyreg_new as easyreg
+
+
+def baseline_rescale_volume(volume, new_min=0, new_max=255, min_percentile=2., max_percentile=98., use_positive_only=False):
+    # rescale_volume before it was parallelised (two np.percentile calls on a copy, out-of-place arithmetic)
+    new_volume = volume.copy()
+    intensities = new_volume[new_volume > 0] if use_positive_only else new_volume.flatten()
+    robust_min = np.min(intensities) if min_percentile == 0 else np.percentile(intensities, min_percentile)
+    robust_max = np.max(intensities) if max_percentile == 100 else np.percentile(intensities, max_percentile)
+    new_volume = np.clip(new_volume, robust_min, robust_max)
+    if robust_min != robust_max:
+        return new_min + (new_volume - robust_min) / (robust_max - robust_min) * (new_max - new_min)
+    else:
+        return np.zeros_like(new_volume)
+
+
+@pytest.fixture
+def budget():
+    # the thread budget of set_num_threads, restored afterwards
+    threads = torch.get_num_threads()
+    yield easyreg.set_num_threads
+    easyreg.set_preprocessing_threads(1)
+    easyreg.set_num_threads(threads)
+    easyreg._num_threads = None
+
+
+def synthetic_volume(order='C'):
+    rng = np.random.default_rng(0)
+    volume = rng.gamma(2, 30, (131, 97, 89)).astype('float32')  # over 2 ** 20 voxels, so threads are used
+    volume[:10] = 0
+    return np.asarray(volume, order=order)
+
+
+@pytest.mark.parametrize('threads', [1, 3, 8])
+@pytest.mark.parametrize('order', ['C', 'F'])
+@pytest.mark.parametrize('options', [dict(new_min=0, new_max=1, min_percentile=0.5, max_percentile=99.5),
+                                     dict(min_percentile=0, max_percentile=100),
+                                     dict(use_positive_only=True)])
+def test_rescale_volume_matches_baseline(budget, threads, order, options):
+    budget(threads)
+    volume = synthetic_volume(order)
+    expected = baseline_rescale_volume(volume, **options)
+
+    rescaled = easyreg.rescale_volume(volume, **options)
+
+    assert rescaled.dtype == expected.dtype
+    np.testing.assert_array_equal(rescaled, expected)
+    np.testing.assert_array_equal(volume, synthetic_volume(order))  # the input is left alone
+
+
+def test_rescale_volume_constant():
+    volume = np.full((4, 5, 6), 3.0, dtype='float32')
+    np.testing.assert_array_equal(easyreg.rescale_volume(volume), np.zeros_like(volume))
+
+
+@pytest.mark.parametrize('threads', [1, 3, 8])
+def test_blur_axis_matches_gaussian_filter1d(budget, threads):
+    budget(threads)
+    volume = synthetic_volume()
+    for axis in range(3):
+        np.testing.assert_array_equal(easyreg.blur_axis(volume, 1.3, axis), gaussian_filter1d(volume, 1.3, axis=axis))
+
+
+def test_preprocessing_shares_one_pool_and_the_budget(budget):
+    budget(8)
+    calls = []
+    easyreg.map_slabs(lambda start, stop: calls.append((start, stop)), 100)
+    pool = easyreg._preprocessing_pool
+    assert len(calls) == 8 and pool is not None
+
+    # four threads preprocessing at the same time get two threads each, from the same pool
+    easyreg.set_preprocessing_threads(4)
+    calls = []
+    easyreg.map_slabs(lambda start, stop: calls.append((start, stop)), 100)
+    assert sorted(calls) == [(0, 50), (50, 100)]
+    assert easyreg._preprocessing_pool is pool
+
+    # a new budget gets a new pool
+    budget(2)
+    assert easyreg._preprocessing_pool is None
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from scipy.ndimage import gaussian_filter
+
+import mri_easyreg_new as easyreg
+
+
+def trilinear_resample(volume, aff, new_vox_size):
+    # the path that the separable resample_volume replaced (full 3-D blur, meshgrid, and trilinear interpolation)
+    pixdim = np.sqrt(np.sum(aff * aff, axis=0))[:-1]
+    new_vox_size = np.array(new_vox_size)
+    factor = pixdim / new_vox_size
+    sigmas = 0.25 / factor
+    sigmas[factor > 1] = 0  # don't blur if upsampling
+
+    volume_filt = gaussian_filter(volume, sigmas)
+
+    start = - (factor - 1) / (2 * factor)
+    step = 1.0 / factor
+    stop = start + step * np.ceil(volume_filt.shape * factor)
+
+    grid = []
+    for axis in range(3):
+        xi = np.arange(start=start[axis], stop=stop[axis], step=step[axis])
+        xi[xi < 0] = 0
+        xi[xi > (volume_filt.shape[axis] - 1)] = volume_filt.shape[axis] - 1
+        grid.append(xi.astype(volume.dtype))
+    xig, yig, zig = np.meshgrid(*grid, indexing='ij', sparse=False)
+    volume2 = easyreg.fast_3D_interp_torch(easyreg.as_torch(volume_filt), easyreg.as_torch(xig),
+                                           easyreg.as_torch(yig), easyreg.as_torch(zig), 'linear')
+
+    aff2 = aff.copy()
+    for c in range(3):
+        aff2[:-1, c] = aff2[:-1, c] / factor[c]
+    aff2[:-1, -1] = aff2[:-1, -1] - np.matmul(aff2[:-1, :-1], 0.5 * (factor - 1))
+
+    return volume2.numpy(), aff2
+
+
+def rotated_affine(pixdim):
+    angle = 0.3
+    rotation = np.array([[np.cos(angle), -np.sin(angle), 0], [np.sin(angle), np.cos(angle), 0], [0, 0, 1]])
+    aff = np.eye(4)
+    aff[:3, :3] = rotation * np.array(pixdim)
+    aff[:3, 3] = [-20.5, 13.0, 7.25]
+    return aff
+
+
+@pytest.mark.parametrize('pixdim, new_vox_size', [
+    ([1.0, 1.0, 1.0], [0.7, 0.7, 0.7]),  # upsampling
+    ([1.0, 1.0, 1.0], [1.6, 2.0, 1.3]),  # downsampling
+    ([0.9, 0.9, 3.0], [1.0, 1.0, 1.0]),  # anisotropic voxels (thick slices)
+    ([2.5, 1.0, 0.8], [1.0, 1.0, 1.0]),  # mixed up- and downsampling
+])
+def test_resample_volume_matches_trilinear_path(pixdim, new_vox_size):
+    rng = np.random.default_rng(0)
+    volume = rng.random((23, 31, 17)).astype(np.float32) * 100
+    aff = rotated_affine(pixdim)
+
+    expected, expected_aff = trilinear_resample(volume, aff, new_vox_size)
+    resampled, resampled_aff = easyreg.resample_volume(volume, aff, new_vox_size)
+
+    assert resampled.shape == expected.shape
+    assert resampled.dtype == expected.dtype
+    np.testing.assert_allclose(resampled_aff, expected_aff)
+    np.testing.assert_allclose(resampled, expected, rtol=1e-4, atol=1e-3)
@@ -0,0 +1,76 @@
+import numpy as np
+import pytest
+
+import mri_easyreg_new as easyreg
+
+SEG_LABELS = np.array([0, 2, 3, 4, 41, 42, 43])
+PARC_LABELS = np.array([0, 1001, 1002, 2001, 2002])
+
+
+class VoxelwiseNet:
+    # stands in for the SynthSeg network: posteriors that only depend on the intensity of each voxel, so every tile
+    # sees exactly the posteriors of the whole image
+    def __init__(self):
+        self.calls = []
+
+    def predict(self, image, verbose=None):
+        self.calls.append(image.shape)
+        x = image[..., :1]
+        seg = np.exp(-40 * (x - np.linspace(0, 1, len(SEG_LABELS))) ** 2)
+        parc = np.exp(-30 * (x - np.linspace(0.2, 0.9, len(PARC_LABELS))) ** 2)
+        return [(p / p.sum(-1, keepdims=True)).astype('float32') for p in (seg, parc)]
+
+
+def synthetic_image(shape):
+    # two separate blobs (so that the largest connected component matters) over a noisy background
+    rng = np.random.default_rng(0)
+    grid = np.stack(np.meshgrid(*[np.arange(n) for n in shape], indexing='ij'), axis=-1)
+    big = np.exp(-np.sum((grid - np.array(shape) * 0.4) ** 2, -1) / 300)
+    small = np.exp(-np.sum((grid - np.array(shape) * 0.85) ** 2, -1) / 20)
+    image = big + 0.6 * small + rng.normal(0, 0.03, shape)
+    return image[np.newaxis, ..., np.newaxis].astype('float32')
+
+
+def lean_segmentation(predictions, shape):
+    post_seg, post_parc = predictions
+    pad_idx = np.array([0, 0, 0, *shape])
+    return easyreg.postprocess(post_seg, post_parc, shape, pad_idx, None, SEG_LABELS, PARC_LABELS, np.eye(4),
+                               np.ones(3), lean=True)[0]
+
+
+@pytest.mark.parametrize('tile_size, overlap', [(32, 8), (32, 0), (64, 16)])
+def test_tiled_segmentation_matches_whole_image(tile_size, overlap):
+    shape = (70, 45, 38)
+    image = synthetic_image(shape)
+    net = VoxelwiseNet()
+
+    expected = lean_segmentation(net.predict(image), shape)
+    tiled = easyreg.predict_segmentation(net, image, tile_size, overlap)
+    segmentation = lean_segmentation(tiled, shape)
+
+    assert len(np.unique(expected)) > 3
+    np.testing.assert_array_equal(segmentation, expected)
+    # the tiles are reduced to labels: nothing of the size of the posteriors is kept
+    assert all(volume.itemsize <= 2 and volume.shape == (1, *shape) for volume in tiled[0])
+    assert all(max(call[1:4]) <= tile_size for call in net.calls[1:])
+
+
+def test_tiles_keep_the_labels_of_the_most_central_tile():
+    # a network whose answer depends on the tile (its first voxel): the voxels must take that of the tile in which
+    # they are the most central
+    class TileNet:
+        def predict(self, image, verbose=None):
+            seg = np.zeros((*image.shape[:4], len(SEG_LABELS)), dtype='float32')
+            seg[..., 1 + int(image[0, 0, 0, 0, 0])] = 1
+            parc = np.full((*image.shape[:4], len(PARC_LABELS)), 0.2, dtype='float32')
+            return [seg, parc]
+
+    shape = (60, 32, 32)
+    image = np.zeros((1, *shape, 1), dtype='float32')
+    image[0, 28:] = 1  # the second tile along the first axis starts at 28
+    (foreground, seg_index, _), _ = easyreg.predict_segmentation(TileNet(), image, 32, 4)
+
+    assert foreground.all()
+    # tiles [0, 32) and [28, 60) overlap over [28, 32), split between them at its middle
+    np.testing.assert_array_equal(seg_index[0, :30], 1)
+    np.testing.assert_array_equal(seg_index[0, 30:], 2)
@@ -0,0 +1,86 @@
+import argparse
+import threading
+
+import mri_easyreg_new as easyreg
+
+
+def pair_args(ref, flo):
+    return argparse.Namespace(ref=ref, ref_seg=ref + '.seg', flo=flo, flo_seg=flo + '.seg', precision='float32',
+                              autocrop=False, seg_tile=None, seg_tile_overlap=32)
+
+
+def test_shared_reference_computed_once_and_released(context):
+    all_args = [pair_args('ref', 'flo%d' % i) for i in range(3)] + [pair_args('other', 'flo')]
+    context.share_references(all_args)
+    subjects = [{'args': args} for args in all_args]
+    calls = []
+
+    def compute(name):
+        calls.append(name)
+        return len(calls)
+
+    values = [context.shared_reference(subject, 'image', lambda: compute('image')) for subject in subjects]
+    assert values[:3] == [1, 1, 1]  # computed by the first subject of the shared reference only
+    assert values[3] == 2  # a reference of a single subject is not kept
+    assert context.is_shared_reference(all_args[0]) and not context.is_shared_reference(all_args[3])
+
+    for subject in subjects:
+        context.release_reference(subject)
+    assert context._references == {} and context._reference_subjects == {}
+
+
+def test_shared_reference_names_do_not_wait_for_each_other(context):
+    all_args = [pair_args('ref', 'flo%d' % i) for i in range(2)]
+    context.share_references(all_args)
+    first, second = [{'args': args} for args in all_args]
+    context.shared_reference(first, 'image', lambda: 'image')
+
+    started, finish = threading.Event(), threading.Event()
+
+    def slow_alignment():
+        started.set()
+        finish.wait(30)
+        return 'alignment'
+
+    thread = threading.Thread(target=lambda: context.shared_reference(first, 'alignment', slow_alignment))
+    thread.start()
+    started.wait(30)
+    # the alignment is still being computed, but the image is available
+    done = []
+    reader = threading.Thread(target=lambda: done.append(context.shared_reference(second, 'image', lambda: 'again')))
+    reader.start()
+    reader.join(10)
+    finish.set()
+    thread.join(30)
+    assert done == ['image']
+
+
+def test_shard_tasks_keeps_shared_references_together():
+    all_args = [pair_args('ref', 'flo%d' % i) for i in range(10)] + [pair_args('single%d' % i, 'flo') for i in range(5)]
+    tasks = list(enumerate(all_args))
+    chunks = easyreg.shard_tasks(tasks, workers=2, reg_batch=2)
+
+    assert sorted(task[0] for chunk in chunks for task in chunk) == list(range(15))
+    shared = [chunk for chunk in chunks if chunk[0][1].ref == 'ref']
+    assert len(shared) <= 2  # at most one chunk of the shared reference per worker
+    assert all(task[1].ref == 'ref' for chunk in shared for task in chunk)
+    assert all(len(chunk) <= 2 for chunk in chunks if chunk not in shared)
+
+
+def test_worker_chunks_release_their_references(context, monkeypatch):
+    # a worker registers the subjects of each chunk it gets, so its counts go back to zero by the end of the chunk
+    all_args = [pair_args('ref', 'flo%d' % i) for i in range(6)]
+
+    def run_subjects(tasks, context):
+        results = []
+        for i, args in tasks:
+            context.shared_reference({'args': args}, 'image', lambda: 'image')
+            context.release_reference({'args': args})
+            results.append({'index': i})
+        return results
+
+    monkeypatch.setattr(easyreg, '_worker_context', context)
+    monkeypatch.setattr(easyreg, 'run_subjects', run_subjects)
+    for chunk in easyreg.shard_tasks(list(enumerate(all_args)), workers=2, reg_batch=1):
+        easyreg._run_subjects_in_worker((chunk, 1))
+        assert context._references == {} and context._reference_subjects == {}
@@ -0,0 +1,38 @@
+import multiprocessing
+import os
+
+import pytest
+import torch
+
+import mri_easyreg_new as easyreg
+
+
+def test_split_threads():
+    assert easyreg.split_threads(4, 8, 10) == (4, 2)
+    assert easyreg.split_threads(4, 8, 2) == (2, 4)  # no more workers than subjects
+    assert easyreg.split_threads(3, 8, 10) == (3, 2)
+    # no more workers than threads, rather than several workers per thread
+    assert easyreg.split_threads(4, 2, 10) == (2, 1)
+    assert easyreg.split_threads(4, 1, 10) == (1, 1)
+
+
+@pytest.fixture
+def restore_threads():
+    threads = torch.get_num_threads()
+    yield
+    easyreg.set_num_threads(threads)
+    easyreg._num_threads = None
+    easyreg._worker_context = None
+
+
+def test_workers_are_pinned_to_their_share_of_the_cores(fs_home, monkeypatch, restore_threads):
+    pinned = []
+    monkeypatch.setattr(os, 'sched_setaffinity', lambda pid, cores: pinned.append(list(cores)), raising=False)
+    counter = multiprocessing.Value('i', 0)
+
+    # two workers of three threads on seven cores; the third and fourth replace workers that died
+    for _ in range(4):
+        easyreg._init_worker(fs_home, 3, list(range(7)), counter, {})
+
+    assert pinned == [[0, 1, 2], [3, 4, 5], [0, 1, 2], [3, 4, 5]]
+    assert easyreg._worker_context is not None